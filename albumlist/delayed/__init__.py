@@ -1,9 +1,13 @@
+import hashlib
+import inspect
+import json
 import os
+
 import redis
-import uuid
+import requests
 
+from albumlist import metrics
 from config import Config
-from pickle import loads, dumps
 
 
 if 'REDIS_HOST' in os.environ:
@@ -12,6 +16,30 @@ else:
     redis_connection = redis.from_url(os.environ['REDIS_URL'])
 
 
+from albumlist.delayed import jobs  # noqa: E402
+from albumlist.delayed import groups  # noqa: E402
+from albumlist.delayed.broker import Broker  # noqa: E402
+
+
+def _report_group(group):
+    print(f'[queue]: {groups.summary(group)}')
+    if group.get('response_url'):
+        requests.post(group['response_url'], data=json.dumps({'text': groups.summary(group)}))
+
+
+broker = Broker(
+    redis_connection,
+    Config.REDIS_QUEUE_KEY,
+    lanes=Config.JOB_QUEUE_WEIGHTS,
+    max_attempts=Config.JOB_MAX_ATTEMPTS,
+    retry_backoff=Config.JOB_RETRY_BACKOFF,
+    retry_max_delay=Config.JOB_RETRY_MAX_DELAY,
+    heartbeat_ttl=Config.WORKER_HEARTBEAT_TTL,
+    on_group_finished=_report_group,
+)
+metrics.register_queue_gauges(broker)
+
+
 class DelayedResult(object):
     def __init__(self, key):
         self.key = key
@@ -22,16 +50,131 @@ class DelayedResult(object):
         if self._return_value is None:
             rv = redis_connection.get(self.key)
             if rv is not None:
-                self._return_value = loads(rv)
+                self._return_value = jobs.loads_value(rv)
         return self._return_value
 
 
-def queue_func(f):
-    def delay(*args, **kwargs):
+def _dedup_key_func(f, dedup):
+    """
+    A function of a call's arguments that returns its deduplication key:
+    dedup=True uses all of the arguments, a tuple of argument names uses
+    just those (an empty tuple allows one pending job per task), and a
+    callable is used as is.
+    """
+    if callable(dedup):
+        return dedup
+    signature = inspect.signature(f)
+
+    def key(*args, **kwargs):
+        bound = signature.bind(*args, **kwargs)
+        bound.apply_defaults()
+        values = bound.arguments if dedup is True else {name: bound.arguments[name] for name in dedup}
+        return hashlib.sha1(jobs.dumps_value(sorted(values.items()))).hexdigest() if values else '*'
+    return key
+
+
+def queue_func(f=None, queue=jobs.DEFAULT_QUEUE, dedup=None, dedup_window=None, retry=False):
+    """
+    Give f a delay(*args, **kwargs) that queues a call to it on the given
+    queue, and a delay_on(queue, *args, **kwargs) for callers that need a
+    different one. Use as @queue_func or @queue_func(queue='bulk').
+
+    With dedup, a call is coalesced with a pending call that has the same
+    deduplication key (see _dedup_key_func) and returns that call's result,
+    until the pending job finishes or dedup_window seconds have passed.
+
+    With retry, a job that raises is retried with backoff (see
+    Broker.fail). Only use it for tasks that are safe to run again, which
+    rules out any that have already posted to Slack before raising.
+    """
+    if f is None:
+        return lambda f: queue_func(f, queue=queue, dedup=dedup, dedup_window=dedup_window, retry=retry)
+    jobs.register_task(f)
+    dedup_key = _dedup_key_func(f, dedup) if dedup not in (None, False) else None
+    window = dedup_window or Config.JOB_DEDUP_WINDOW
+
+    def delay_on(lane, *args, **kwargs):
         qkey = Config.REDIS_QUEUE_KEY
-        key = f'{qkey}:result:{uuid.uuid4()}'
-        s = dumps((f, key, args, kwargs))
-        redis_connection.rpush(qkey, s)
-        return DelayedResult(key)
+        job = jobs.Job(f.__name__, args, kwargs, queue=lane, retry=retry)
+        job.result_key = f'{qkey}:result:{job.id}'
+        key = dedup_key(*args, **kwargs) if dedup_key else None
+        if key:
+            job.dedup_key = broker.dedup_key(f.__name__, key)
+        payload = job.dumps()
+        if job.dedup_key:
+            existing = broker.claim(job, window)
+            if existing is not None:
+                print(f'[queue]: {f.__name__} is already queued, coalescing')
+                return DelayedResult(existing)
+        try:
+            broker.enqueue(payload, lane=lane)
+        except Exception:
+            broker.release(job)
+            raise
+        metrics.JOBS_QUEUED.inc(f.__name__, lane)
+        return DelayedResult(job.result_key)
+
+    def delay(*args, **kwargs):
+        return delay_on(queue, *args, **kwargs)
     f.delay = delay
+    f.delay_on = delay_on
+    f.queue = queue
+    f.dedup_key = dedup_key
+    f.dedup_window = window
+    f.retry = retry
     return f
+
+
+def map_chunked(f, items, *args, chunk_size=50, queue=None, description=None, report_url=None, **kwargs):
+    """
+    Queue f(chunk, *args, **kwargs) for each chunk of chunk_size items as
+    one job group, with the payloads pushed in a single pipelined round
+    trip, and return the group id.
+
+    Chunks whose deduplication key is already held by a pending job are
+    skipped. The chunk jobs don't store return values. When the last job
+    of the group has finished, a summary of the group is posted to
+    report_url if given (see groups.summary).
+    """
+    items = list(items)
+    lane = queue or f.queue
+    chunk_jobs = []
+    for i in range(0, len(items), chunk_size):
+        chunk_args = [items[i:i + chunk_size]] + list(args)
+        job = jobs.Job(f.__name__, chunk_args, kwargs, queue=lane, retry=f.retry)
+        if f.dedup_key:
+            key = f.dedup_key(*chunk_args, **kwargs)
+            if key:
+                job.dedup_key = broker.dedup_key(f.__name__, key)
+        chunk_jobs.append(job)
+    for job in chunk_jobs:
+        # check payload sizes before claiming any dedup keys
+        job.dumps()
+    claims = [job for job in chunk_jobs if job.dedup_key]
+    if claims:
+        claimed = broker.claim_many(claims, f.dedup_window)
+        skipped = len(claims) - len(claimed)
+        if skipped:
+            print(f'[queue]: {skipped} chunks of {f.__name__} are already queued, coalescing')
+        chunk_jobs = [job for job in chunk_jobs if not job.dedup_key] + claimed
+    else:
+        skipped = 0
+    group_id = broker.groups.start(
+        f.__name__,
+        len(chunk_jobs) + skipped,
+        items=len(items),
+        skipped=skipped,
+        description=description,
+        response_url=report_url,
+    )
+    for job in chunk_jobs:
+        job.group = group_id
+    try:
+        broker.enqueue_many([job.dumps() for job in chunk_jobs], lane=lane)
+    except Exception:
+        for job in chunk_jobs:
+            broker.release(job)
+        raise
+    metrics.JOBS_QUEUED.inc(f.__name__, lane, amount=len(chunk_jobs))
+    print(f'[queue]: queued {len(chunk_jobs)} jobs of {f.__name__} as job group {group_id}')
+    return group_id
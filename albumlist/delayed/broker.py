@@ -0,0 +1,332 @@
+import collections
+import os
+import random
+import socket
+import time
+
+from albumlist.delayed import jobs
+from albumlist.delayed.groups import JobGroups
+
+
+# move due retries back onto the queue atomically so a crash can't lose them
+PROMOTE_SCRIPT = """
+local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+for _, payload in ipairs(due) do
+    redis.call('ZREM', KEYS[1], payload)
+    redis.call('LPUSH', KEYS[2], payload)
+end
+return #due
+"""
+
+# move a payload from one list to the back (or with ARGV[3] = 'front', the
+# front) of another as a possibly rewritten payload, only if it was still in
+# the first list
+MOVE_SCRIPT = """
+if redis.call('LREM', KEYS[1], 1, ARGV[1]) > 0 then
+    if ARGV[3] == 'front' then
+        redis.call('RPUSH', KEYS[2], ARGV[2])
+    else
+        redis.call('LPUSH', KEYS[2], ARGV[2])
+    end
+    return 1
+end
+return 0
+"""
+
+# release a deduplication key only if it still belongs to the given job
+RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+def worker_id():
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+class Broker:
+    """
+    Reliable delivery of queued jobs across weighted lanes, with retries,
+    dead letters and requeueing of jobs left by dead workers.
+    """
+
+    def __init__(self, redis_connection, queue, lanes=None, max_attempts=5, retry_backoff=10,
+                 retry_max_delay=3600, heartbeat_ttl=60, on_group_finished=None):
+        self.redis = redis_connection
+        self.queue = queue
+        # lane -> weight, highest priority first
+        self.lanes = collections.OrderedDict(lanes or [('interactive', 6), (jobs.DEFAULT_QUEUE, 3), ('bulk', 1)])
+        if jobs.DEFAULT_QUEUE not in self.lanes:
+            raise ValueError(f'the {jobs.DEFAULT_QUEUE} lane is required')
+        self._rng = random.Random()
+        self.max_attempts = max_attempts
+        self.retry_backoff = retry_backoff
+        self.retry_max_delay = retry_max_delay
+        self.heartbeat_ttl = heartbeat_ttl
+        self.dead_key = f'{queue}:dead'
+        self.workers_key = f'{queue}:workers'
+        self.crashes_key = f'{queue}:crashes'
+        self._promote = redis_connection.register_script(PROMOTE_SCRIPT)
+        self._move = redis_connection.register_script(MOVE_SCRIPT)
+        self._release = redis_connection.register_script(RELEASE_SCRIPT)
+        self.groups = JobGroups(redis_connection, queue, on_finished=on_group_finished)
+
+    def lane_key(self, lane):
+        # the default lane keeps the original queue key
+        return self.queue if lane == jobs.DEFAULT_QUEUE else f'{self.queue}:{lane}'
+
+    def retry_key(self, lane):
+        return f'{self.lane_key(lane)}:retry'
+
+    def processing_key(self, worker_id):
+        return f'{self.queue}:processing:{worker_id}'
+
+    def heartbeat_key(self, worker_id):
+        return f'{self.queue}:heartbeat:{worker_id}'
+
+    def enqueue(self, payload, lane=jobs.DEFAULT_QUEUE):
+        if lane not in self.lanes:
+            raise jobs.JobError(f'unknown queue {lane}')
+        self.redis.lpush(self.lane_key(lane), payload)
+
+    def enqueue_many(self, payloads, lane=jobs.DEFAULT_QUEUE, batch_size=500):
+        if lane not in self.lanes:
+            raise jobs.JobError(f'unknown queue {lane}')
+        pipe = self.redis.pipeline(transaction=False)
+        for i in range(0, len(payloads), batch_size):
+            pipe.lpush(self.lane_key(lane), *payloads[i:i + batch_size])
+        pipe.execute()
+
+    def _lane_order(self):
+        lanes = [lane for lane, weight in self.lanes.items() if weight > 0]
+        first = self._rng.choices(lanes, weights=[self.lanes[lane] for lane in lanes])[0]
+        return [first] + [lane for lane in lanes if lane != first]
+
+    def dequeue(self, worker_id, timeout=1):
+        """
+        Move the next job from a lane onto the worker's processing list and
+        return it, trying the lanes in weighted random order. If they are all
+        empty, wait up to timeout seconds for an interactive job.
+        """
+        processing_key = self.processing_key(worker_id)
+        for lane in self._lane_order():
+            payload = self.redis.rpoplpush(self.lane_key(lane), processing_key)
+            if payload is not None:
+                return payload
+        return self.redis.brpoplpush(self.lane_key(next(iter(self.lanes))), processing_key, timeout)
+
+    def ack(self, worker_id, payload, job=None):
+        self.redis.lrem(self.processing_key(worker_id), payload, 1)
+        if job is not None:
+            self._finished(job, ok=True)
+
+    def _finished(self, job, ok):
+        self.release(job)
+        if job.group:
+            self.groups.job_done(job.group, ok=ok)
+
+    def dedup_key(self, task, key):
+        return f'{self.queue}:dedup:{task}:{key}'
+
+    def claim(self, job, window):
+        """
+        Claim job.dedup_key for the job for up to window seconds. Returns
+        None if the job should be queued, or the result key of the pending
+        job it duplicates.
+        """
+        while True:
+            if self.redis.set(job.dedup_key, self._claim_value(job), nx=True, ex=window):
+                return None
+            existing = self.redis.get(job.dedup_key)
+            if existing is not None:
+                return existing.decode('utf-8')
+            # released in the meantime, so try again
+
+    def claim_many(self, claims, window):
+        """
+        Claim the dedup keys of many jobs with one round trip, returning the
+        jobs that were not already pending.
+        """
+        pipe = self.redis.pipeline(transaction=False)
+        for job in claims:
+            pipe.set(job.dedup_key, self._claim_value(job), nx=True, ex=window)
+        return [job for job, claimed in zip(claims, pipe.execute()) if claimed]
+
+    @staticmethod
+    def _claim_value(job):
+        return job.result_key or job.id
+
+    def release(self, job):
+        if job.dedup_key:
+            self._release(keys=[job.dedup_key], args=[self._claim_value(job)])
+
+    def retry_delay(self, attempts):
+        delay = min(self.retry_max_delay, self.retry_backoff * 2 ** (attempts - 1))
+        return delay * random.uniform(0.8, 1.2)
+
+    def fail(self, worker_id, payload, job, error):
+        """
+        Schedule a retry of a job that raised, or bury it if its task doesn't
+        allow retries or it has used up its attempts. Returns True if the job
+        was buried.
+        """
+        job.attempts += 1
+        job.error = str(error)[:500]
+        pipe = self.redis.pipeline()
+        pipe.lrem(self.processing_key(worker_id), payload, 1)
+        buried = not job.retry or job.attempts >= self.max_attempts
+        if buried:
+            pipe.lpush(self.dead_key, job.dumps(max_size=0))
+        else:
+            pipe.zadd(self.retry_key(self._lane(job)), job.dumps(max_size=0),
+                      time.time() + self.retry_delay(job.attempts))
+        pipe.execute()
+        if buried:
+            self._finished(job, ok=False)
+        return buried
+
+    def bury(self, worker_id, payload):
+        """
+        Move a payload that can't be decoded straight to the dead-letter list.
+        """
+        self._move(keys=[self.processing_key(worker_id), self.dead_key], args=[payload, payload, 'back'])
+
+    def requeue(self, worker_id, payload):
+        """
+        Put a job the worker took but couldn't start back at the front of its lane.
+        """
+        try:
+            lane_key = self.lane_key(self._lane(jobs.Job.loads(payload)))
+        except jobs.JobError:
+            lane_key = self.queue
+        return self._move(keys=[self.processing_key(worker_id), lane_key], args=[payload, payload, 'front'])
+
+    def _lane(self, job):
+        # jobs queued on a lane that has since been removed run on the default one
+        return job.queue if job.queue in self.lanes else jobs.DEFAULT_QUEUE
+
+    def promote_due_retries(self, limit=100):
+        now = time.time()
+        return sum(
+            self._promote(keys=[self.retry_key(lane), self.lane_key(lane)], args=[now, limit])
+            for lane in self.lanes
+        )
+
+    def heartbeat(self, worker_id):
+        pipe = self.redis.pipeline()
+        pipe.set(self.heartbeat_key(worker_id), int(time.time()), ex=self.heartbeat_ttl)
+        pipe.sadd(self.workers_key, worker_id)
+        pipe.execute()
+
+    def retire(self, worker_id):
+        self.requeue_processing(worker_id)
+        pipe = self.redis.pipeline()
+        pipe.delete(self.heartbeat_key(worker_id))
+        pipe.srem(self.workers_key, worker_id)
+        pipe.execute()
+
+    def requeue_processing(self, worker_id):
+        """
+        Put a worker's unacknowledged jobs back at the front of their lanes,
+        burying any that have now been interrupted max_attempts times.
+        """
+        processing_key = self.processing_key(worker_id)
+        requeued = 0
+        while True:
+            payload = self.redis.lindex(processing_key, -1)
+            if payload is None:
+                return requeued
+            try:
+                job = jobs.Job.loads(payload)
+            except jobs.JobError:
+                moved = self._move(keys=[processing_key, self.queue], args=[payload, payload, 'front'])
+            else:
+                crashes = self.redis.hincrby(self.crashes_key, job.id, 1)
+                self.redis.expire(self.crashes_key, 60 * 60 * 24)
+                if crashes >= self.max_attempts:
+                    job.attempts = crashes
+                    job.error = 'the worker stopped while running this job'
+                    moved = self._move(keys=[processing_key, self.dead_key],
+                                       args=[payload, job.dumps(max_size=0), 'back'])
+                    if moved:
+                        self._finished(job, ok=False)
+                else:
+                    moved = self._move(keys=[processing_key, self.lane_key(self._lane(job))],
+                                       args=[payload, payload, 'front'])
+            requeued += moved
+
+    def reclaim(self, live_worker_id=None):
+        """
+        Requeue the jobs of workers whose heartbeat has expired. Returns the
+        number of jobs requeued.
+        """
+        requeued = 0
+        for worker_id in self.redis.smembers(self.workers_key):
+            worker_id = worker_id.decode('utf-8')
+            if worker_id == live_worker_id or self.redis.exists(self.heartbeat_key(worker_id)):
+                continue
+            requeued += self.requeue_processing(worker_id)
+            self.redis.srem(self.workers_key, worker_id)
+        return requeued
+
+    def dead_letters(self, limit=10):
+        """
+        The most recently buried jobs (or raw payloads that couldn't be
+        decoded), newest first, and the total number of dead letters.
+        """
+        entries = []
+        for payload in self.redis.lrange(self.dead_key, 0, limit - 1):
+            try:
+                entries.append(jobs.Job.loads(payload))
+            except jobs.JobError:
+                entries.append(payload)
+        return entries, self.redis.llen(self.dead_key)
+
+    def requeue_dead(self, limit=None):
+        """
+        Put the oldest `limit` dead letters (or all of them) back on the
+        queue with their attempts reset. Returns the number requeued.
+        """
+        requeued = 0
+        while limit is None or requeued < limit:
+            payloads = self.redis.lrange(self.dead_key, -1, -1)
+            if not payloads:
+                break
+            payload = payloads[0]
+            try:
+                job = jobs.Job.loads(payload)
+                job.attempts, job.error = 0, None
+                self.redis.hdel(self.crashes_key, job.id)
+                new_payload, lane_key = job.dumps(max_size=0), self.lane_key(self._lane(job))
+            except jobs.JobError:
+                new_payload, lane_key = payload, self.queue
+            if self._move(keys=[self.dead_key, lane_key], args=[payload, new_payload, 'back']):
+                requeued += 1
+        return requeued
+
+    def stats(self):
+        pipe = self.redis.pipeline()
+        for lane in self.lanes:
+            pipe.llen(self.lane_key(lane))
+            pipe.zcard(self.retry_key(lane))
+        pipe.llen(self.dead_key)
+        pipe.smembers(self.workers_key)
+        results = pipe.execute()
+        # the set keeps dead workers until a live one reclaims them, so count unexpired heartbeats
+        pipe = self.redis.pipeline(transaction=False)
+        for worker_id in results[-1]:
+            pipe.exists(self.heartbeat_key(worker_id.decode('utf-8')))
+        workers = sum(1 for alive in pipe.execute() if alive)
+        lanes = {
+            lane: {'queued': results[2 * i], 'retrying': results[2 * i + 1]}
+            for i, lane in enumerate(self.lanes)
+        }
+        return {
+            'queued': sum(lane['queued'] for lane in lanes.values()),
+            'retrying': sum(lane['retrying'] for lane in lanes.values()),
+            'dead': results[-2],
+            'workers': workers,
+            'lanes': lanes,
+        }
@@ -0,0 +1,120 @@
+import time
+import uuid
+
+
+class JobGroups:
+    """
+    Progress tracking for a set of jobs queued together, kept in a Redis
+    hash per group: its name and description, how many jobs it has and how
+    many succeeded, failed (were buried) or were skipped as duplicates of
+    pending jobs, when it started and finished, and where to post its
+    completion report.
+
+    on_finished(group) is called once per group, by whichever process
+    counts its last job.
+    """
+
+    COUNTERS = ('total', 'items', 'succeeded', 'failed', 'skipped')
+
+    def __init__(self, redis_connection, prefix, ttl=60 * 60 * 24 * 7, on_finished=None, keep_recent=100):
+        self.redis = redis_connection
+        self.prefix = prefix
+        self.ttl = ttl
+        self.on_finished = on_finished
+        self.keep_recent = keep_recent
+        self.recent_key = f'{prefix}:groups'
+
+    def key(self, group_id):
+        return f'{self.prefix}:group:{group_id}'
+
+    def start(self, name, total, items=0, skipped=0, description='', response_url=None):
+        group_id = uuid.uuid4().hex[:12]
+        key = self.key(group_id)
+        now = time.time()
+        fields = {
+            'name': name,
+            'description': description or name,
+            'total': total,
+            'items': items,
+            'succeeded': 0,
+            'failed': 0,
+            'skipped': skipped,
+            'started': now,
+        }
+        if response_url:
+            fields['response_url'] = response_url
+        pipe = self.redis.pipeline()
+        pipe.hmset(key, fields)
+        pipe.expire(key, self.ttl)
+        pipe.zadd(self.recent_key, group_id, now)
+        pipe.zremrangebyrank(self.recent_key, 0, -self.keep_recent - 1)
+        pipe.execute()
+        if skipped >= total:
+            self._finish(group_id)
+        return group_id
+
+    def job_done(self, group_id, ok=True):
+        """
+        Count a job in the group as succeeded or failed, and return True if
+        it was the last one.
+        """
+        key = self.key(group_id)
+        pipe = self.redis.pipeline()
+        pipe.hincrby(key, 'succeeded' if ok else 'failed', 1)
+        pipe.hmget(key, 'total', 'succeeded', 'failed', 'skipped')
+        _, (total, succeeded, failed, skipped) = pipe.execute()
+        if total is None:
+            # expired, or started by a release that didn't count outcomes
+            return False
+        if int(succeeded or 0) + int(failed or 0) + int(skipped or 0) >= int(total):
+            return self._finish(group_id)
+        return False
+
+    def _finish(self, group_id):
+        # only the job that finishes the group sets the finish time and reports
+        if not self.redis.hsetnx(self.key(group_id), 'finished', time.time()):
+            return False
+        if self.on_finished:
+            group = self.get(group_id)
+            try:
+                self.on_finished(group)
+            except Exception as e:
+                print(f'[queue]: failed to report job group {group_id}: {e}')
+        return True
+
+    def get(self, group_id):
+        values = self.redis.hgetall(self.key(group_id))
+        if not values:
+            return None
+        group = {k.decode('utf-8'): v.decode('utf-8') for k, v in values.items()}
+        for field in self.COUNTERS:
+            group[field] = int(group.get(field, 0))
+        for field in ('started', 'finished'):
+            group[field] = float(group[field]) if group.get(field) else None
+        group['id'] = group_id
+        group['processed'] = group['succeeded'] + group['failed']
+        group['pending'] = max(0, group['total'] - group['processed'] - group['skipped'])
+        group['elapsed'] = (group['finished'] or time.time()) - group['started']
+        group['per_second'] = group['processed'] / group['elapsed'] if group['elapsed'] > 0 else 0.0
+        return group
+
+    def recent(self, limit=20):
+        """
+        The most recently started groups that haven't expired, newest first.
+        """
+        group_ids = self.redis.zrevrange(self.recent_key, 0, limit - 1)
+        groups = (self.get(group_id.decode('utf-8')) for group_id in group_ids)
+        return [group for group in groups if group is not None]
+
+
+def summary(group):
+    """
+    A one line report of a job group for Slack.
+    """
+    icon = ':white_check_mark:' if not group['failed'] else ':red_circle:'
+    state = 'Finished' if group['finished'] else 'Running'
+    items = f' ({group["items"]} items)' if group['items'] else ''
+    return (f'{icon} {state} {group["description"]}{items}: '
+            f'{group["succeeded"]} of {group["total"]} jobs succeeded, {group["failed"]} failed, '
+            f'{group["skipped"]} skipped as already queued, {group["pending"]} pending, '
+            f'in {group["elapsed"]:.0f}s ({group["per_second"]:.2f} jobs/s) [job group {group["id"]}]')
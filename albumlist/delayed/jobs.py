@@ -0,0 +1,226 @@
+import json
+import pickle
+import time
+import uuid
+from datetime import datetime
+
+from config import Config
+
+
+JOB_FORMAT_VERSION = 1
+
+DEFAULT_QUEUE = 'default'
+
+# task name -> function, filled in by queue_func
+TASKS = {}
+# name -> function or method that may be passed to a task as an argument
+REFERENCES = {}
+
+
+class JobError(Exception):
+    pass
+
+
+class JobTooLarge(JobError):
+    pass
+
+
+def reference_name(f):
+    return f'{f.__module__}.{f.__qualname__}'
+
+
+def register_task(f):
+    if TASKS.get(f.__name__, f) is not f:
+        raise JobError(f'task {f.__name__} is already registered')
+    TASKS[f.__name__] = f
+    register_reference(f)
+    return f
+
+
+def register_reference(*fs):
+    """
+    Allow functions to be passed as task arguments (scrape functions and
+    callbacks, for example). Only registered functions can be decoded.
+    """
+    for f in fs:
+        REFERENCES[reference_name(f)] = f
+    return fs[0] if len(fs) == 1 else fs
+
+
+def _default(obj):
+    if callable(obj) and hasattr(obj, '__qualname__'):
+        name = reference_name(obj)
+        if REFERENCES.get(name) is not obj:
+            raise TypeError(f'{name} is not registered as a job reference')
+        return {'$fn': name}
+    if isinstance(obj, datetime):
+        return {'$dt': obj.isoformat()}
+    if isinstance(obj, (set, frozenset)):
+        return list(obj)
+    if isinstance(obj, BaseException):
+        return {'$error': f'{type(obj).__name__}: {obj}'}
+    from albumlist.models.albums import Album
+    if isinstance(obj, Album):
+        return {'$album': {
+            'id': obj.album_id,
+            'name': obj.album_name,
+            'artist': obj.album_artist,
+            'url': obj.album_url,
+            'img': obj.album_image,
+            'available': obj.available,
+            'channel': obj.channel,
+            'added': obj.added,
+            'released': obj.released,
+            'tags_json': obj.tags,
+            'users_json': obj.users,
+            'reviews_json': obj.reviews,
+        }}
+    raise TypeError(f'cannot encode {type(obj).__name__} in a job')
+
+
+def _object_hook(d):
+    if len(d) != 1:
+        return d
+    if '$fn' in d:
+        try:
+            return REFERENCES[d['$fn']]
+        except KeyError:
+            raise JobError(f'unknown job reference {d["$fn"]}')
+    if '$dt' in d:
+        return _parse_datetime(d['$dt'])
+    if '$album' in d:
+        from albumlist.models.albums import Album
+        return Album(**d['$album'])
+    if '$error' in d:
+        return JobError(d['$error'])
+    return d
+
+
+def _parse_datetime(value):
+    for datetime_format in ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S'):
+        try:
+            return datetime.strptime(value, datetime_format)
+        except ValueError:
+            continue
+    raise JobError(f'invalid datetime {value}')
+
+
+def dumps_value(value):
+    return json.dumps(value, default=_default, separators=(',', ':')).encode('utf-8')
+
+
+def loads_value(data):
+    return json.loads(data.decode('utf-8') if isinstance(data, bytes) else data, object_hook=_object_hook)
+
+
+class Job:
+    """
+    A queued call of a registered task, stored in Redis as a small JSON
+    envelope: {"v": version, "id": ..., "task": name, "args": [...],
+    "kwargs": {...}, "rk": result key, "t": enqueue time}, plus the queue
+    if it isn't the default one, its deduplication key and job group if it
+    has them, whether it may be retried if it raises, and the number of
+    failed attempts and the last error once it has failed.
+    """
+
+    __slots__ = ('id', 'task', 'args', 'kwargs', 'result_key', 'enqueued', 'version', 'attempts', 'error', 'queue',
+                 'dedup_key', 'group', 'retry')
+
+    def __init__(self, task, args=(), kwargs=None, result_key=None, id=None, enqueued=None,
+                 version=JOB_FORMAT_VERSION, attempts=0, error=None, queue=DEFAULT_QUEUE, dedup_key=None,
+                 group=None, retry=False):
+        self.id = id or uuid.uuid4().hex
+        self.task = task
+        self.args = list(args)
+        self.kwargs = kwargs or {}
+        self.result_key = result_key
+        self.enqueued = enqueued or time.time()
+        self.version = version
+        self.attempts = attempts
+        self.error = error
+        self.queue = queue
+        self.dedup_key = dedup_key
+        self.group = group
+        self.retry = retry
+
+    @property
+    def func(self):
+        try:
+            return TASKS[self.task]
+        except KeyError:
+            raise JobError(f'unknown task {self.task}')
+
+    def to_dict(self):
+        d = {
+            'v': JOB_FORMAT_VERSION,
+            'id': self.id,
+            'task': self.task,
+            'args': self.args,
+            'kwargs': self.kwargs,
+            'rk': self.result_key,
+            't': self.enqueued,
+        }
+        if self.queue != DEFAULT_QUEUE:
+            d['q'] = self.queue
+        if self.dedup_key:
+            d['dk'] = self.dedup_key
+        if self.group:
+            d['g'] = self.group
+        if self.retry:
+            d['r'] = 1
+        if self.attempts:
+            d['a'] = self.attempts
+        if self.error:
+            d['e'] = self.error
+        return d
+
+    def dumps(self, max_size=None):
+        try:
+            payload = dumps_value(self.to_dict())
+        except TypeError as e:
+            raise JobError(f'cannot encode {self.task}: {e}')
+        max_size = Config.JOB_MAX_PAYLOAD_BYTES if max_size is None else max_size
+        if max_size and len(payload) > max_size:
+            raise JobTooLarge(f'{self.task} payload is {len(payload)} bytes (max {max_size})')
+        return payload
+
+    @classmethod
+    def from_dict(cls, d):
+        if d.get('v') != JOB_FORMAT_VERSION:
+            raise JobError(f'unsupported job format version {d.get("v")}')
+        return cls(
+            d['task'],
+            args=d.get('args', []),
+            kwargs=d.get('kwargs', {}),
+            result_key=d.get('rk'),
+            id=d.get('id'),
+            enqueued=d.get('t'),
+            version=d['v'],
+            attempts=d.get('a', 0),
+            error=d.get('e'),
+            queue=d.get('q', DEFAULT_QUEUE),
+            dedup_key=d.get('dk'),
+            group=d.get('g'),
+            retry=bool(d.get('r')),
+        )
+
+    @classmethod
+    def loads(cls, payload):
+        if payload[:1] == b'\x80':
+            return cls._from_pickle(payload)
+        try:
+            d = loads_value(payload)
+        except ValueError as e:
+            raise JobError(f'invalid job payload: {e}')
+        if not isinstance(d, dict):
+            raise JobError('invalid job payload')
+        return cls.from_dict(d)
+
+    @classmethod
+    def _from_pickle(cls, payload):
+        # jobs queued by the previous release before it was deployed
+        try:
+            func, key, args, kwargs = pickle.loads(payload)
+        except Exception as e:
+            raise JobError(f'invalid pickled job: {e}')
+        return cls(register_task(func).__name__, args=args, kwargs=kwargs, result_key=key, version=0)
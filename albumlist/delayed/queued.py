@@ -1,4 +1,5 @@
 import ast
+import collections
 import csv
 import io
 import json
@@ -9,49 +10,97 @@ import slacker
 
 from albumlist import delayed
 from albumlist.models import DatabaseError
-from albumlist.models import albums as albums_model, list as list_model
-from albumlist.scrapers import NotFoundError
-from albumlist.scrapers import bandcamp
+from albumlist.models import albums as albums_model, channels as channels_model, list as list_model
+from albumlist.models import restore as restore_model
+from albumlist.scrapers import FetchError, NotFoundError
+from albumlist.scrapers import bandcamp, fetch
 from albumlist.views import build_my_list_attachment
 
 
-@delayed.queue_func
-def deferred_scrape_channel(scrape_function, callback, channel_id, slack_token, channel_name=None, response_url=None):
+# scrape functions and callbacks that the views pass to the jobs below
+delayed.jobs.register_reference(
+    bandcamp.scrape_bandcamp_album_ids_from_messages,
+    bandcamp.scrape_bandcamp_album_ids_from_url,
+    bandcamp.scrape_bandcamp_album_ids_from_url_forced,
+    list_model.add_to_list,
+    list_model.add_many_to_list,
+)
+
+
+CHANNEL_HISTORY_PAGE_SIZE = 1000
+
+
+def _iter_channel_history(slack, channel_id, oldest=None):
+    """
+    Pages of messages from a channel newer than oldest, newest page first.
+    """
+    latest = None
+    while True:
+        response = slack.channels.history(channel_id, latest=latest, oldest=oldest,
+                                          count=CHANNEL_HISTORY_PAGE_SIZE)
+        if not response.successful:
+            raise slacker.Error(response.error)
+        messages = response.body.get('messages', [])
+        if messages:
+            yield messages
+        if not messages or not response.body.get('has_more'):
+            break
+        # messages come newest first, so page backwards from the oldest one seen
+        latest = messages[-1]['ts']
+
+
+@delayed.queue_func(queue='bulk', dedup=('channel_id', 'full'))
+def deferred_scrape_channel(scrape_function, callback, channel_id, slack_token, channel_name=None,
+                            response_url=None, full=False):
+    """
+    Add albums posted to a channel since it was last scraped (or all of them if
+    full is set), then record the newest message seen so the next scrape only
+    fetches messages after it.
+    """
+    channel_name = channel_name or channel_id
     try:
-        slack = slacker.Slacker(slack_token)
-        if response_url:
-            requests.post(response_url,
-                          data=json.dumps({'text': f'Getting channel history for {channel_name or channel_id}...'}))
-        response = slack.channels.history(channel_id)
+        if full:
+            channels_model.reset_channel_cursor(channel_id)
+        oldest = channels_model.get_channel_cursor(channel_id)
+    except DatabaseError as e:
+        print('[db]: failed to get channel cursor')
+        print(f'[db]: {e}')
+        oldest = None
+    slack = slacker.Slacker(slack_token)
+    if response_url:
+        requests.post(response_url, data=json.dumps({'text': f'Getting channel history for {channel_name}...'}))
+    album_ids, newest_ts, n_messages = set(), None, 0
+    try:
+        for messages in _iter_channel_history(slack, channel_id, oldest=oldest):
+            n_messages += len(messages)
+            if newest_ts is None:
+                newest_ts = messages[0]['ts']
+            album_ids.update(scrape_function(messages))
     except (KeyError, slacker.Error) as e:
         message = 'There was an error accessing the Slack API'
         if response_url:
             requests.post(response_url, data=json.dumps({'text': message}))
         raise e
-    if response.successful:
-        messages = response.body.get('messages', [])
-        if response_url:
-            requests.post(response_url, data=json.dumps({'text': f'Scraping {channel_name or channel_id}...'}))
-        album_ids = scrape_function(messages)
-        new_album_ids = list_model.check_for_new_list_ids(album_ids)
-        try:
-            if new_album_ids:
-                callback(new_album_ids)
-                print(f'[scraper]: {len(new_album_ids)} new albums found and added to the list')
-                deferred_process_all_album_details.delay(None)
-        except DatabaseError as e:
-            message = 'failed to update list'
-            print(f'[db]: failed to perform {callback.__name__}')
-            print(f'[db]: {e}')
-        else:
-            message = f'Finished checking for new albums: {len(new_album_ids)} found in {channel_name or channel_id}'
+    print(f'[scraper]: {n_messages} new messages in {channel_name}')
+    try:
+        new_album_ids = [(album_id, ) for album_id in flask.current_app.list_membership.new_ids(album_ids)]
+        if new_album_ids:
+            callback(new_album_ids)
+            print(f'[scraper]: {len(new_album_ids)} new albums found and added to the list')
+            deferred_process_all_album_details.delay(response_url)
+        if newest_ts is not None:
+            channels_model.set_channel_cursor(channel_id, newest_ts)
+    except DatabaseError as e:
+        message = 'failed to update list'
+        print(f'[db]: failed to perform {callback.__name__}')
+        print(f'[db]: {e}')
     else:
-        message = f'failed to get channel history for {channel_name or channel_id}'
+        message = f'Finished checking for new albums: {len(new_album_ids)} found in {channel_name}'
     if response_url:
         requests.post(response_url, data=json.dumps({'text': message}))
 
 
-@delayed.queue_func
+@delayed.queue_func(queue='interactive', dedup=('url', 'callback'))
 def deferred_consume(url, scrape_function, callback, channel='', tags=None, slack_token=None, response_url=None):
     try:
         album_id = scrape_function(url)
@@ -61,7 +110,7 @@ def deferred_consume(url, scrape_function, callback, channel='', tags=None, slac
         if slack_token:
             slack = slacker.Slacker(slack_token)
         try:
-            if album_id not in list_model.get_list():
+            if not flask.current_app.list_membership.contains(album_id):
                 try:
                     callback(album_id)
                 except DatabaseError as e:
@@ -91,12 +140,11 @@ def deferred_consume(url, scrape_function, callback, channel='', tags=None, slac
             print(f'[db]: {e}')
 
 
-@delayed.queue_func
+@delayed.queue_func(queue='bulk')
 def deferred_consume_artist_albums(artist_url, response_url=None):
     try:
-        existing_albums = list_model.get_list()
         artist_albums = bandcamp.scrape_bandcamp_album_ids_from_artist_page(artist_url)
-        new_album_ids = [album_id for album_id in artist_albums if album_id not in existing_albums]
+        new_album_ids = flask.current_app.list_membership.new_ids(artist_albums)
         if response_url and new_album_ids:
             requests.post(response_url,
                           data=json.dumps({'text': f':full_moon: found {len(new_album_ids)} new albums to process...'}))
@@ -113,7 +161,7 @@ def deferred_consume_artist_albums(artist_url, response_url=None):
         for new_album_id in new_album_ids:
             try:
                 list_model.add_to_list(new_album_id)
-                deferred_process_album_details.delay(str(new_album_id))
+                deferred_process_album_details.delay_on('bulk', str(new_album_id))
             except DatabaseError as e:
                 print(f'[db]: failed to update list with {new_album_id} from {artist_url}')
                 print(f'[db]: {e}')
@@ -122,7 +170,7 @@ def deferred_consume_artist_albums(artist_url, response_url=None):
                           data=json.dumps({'text': f':full_moon_with_face: done processing artist albums'}))
 
 
-@delayed.queue_func
+@delayed.queue_func(queue='interactive', retry=True)
 def deferred_process_tags(album_id, tags):
     tags = [tag[1:].lower() if tag.startswith('#') else tag.lower() for tag in tags]
     try:
@@ -134,7 +182,7 @@ def deferred_process_tags(album_id, tags):
         print(f'[scraper]: tagged {album_id} with "{tags}"')
 
 
-@delayed.queue_func
+@delayed.queue_func(queue='interactive', retry=True)
 def deferred_process_users(album_id, users):
     try:
         albums_model.set_album_users(album_id, users)
@@ -145,35 +193,32 @@ def deferred_process_users(album_id, users):
         print(f'[scraper]: set {album_id} with users "{users}"')
 
 
-@delayed.queue_func
+@delayed.queue_func(queue='bulk', dedup=())
 def deferred_process_all_album_details(response_url=None):
     try:
         if response_url:
             requests.post(response_url, data=json.dumps({'text': 'Process started...'}))
-        for album_id in albums_model.check_for_new_albums():
-            deferred_process_album_details.delay(album_id)
+        delayed.map_chunked(deferred_process_albums_details, albums_model.check_for_new_albums(),
+                            chunk_size=PAGE_DETAILS_BATCH_SIZE, description='album details',
+                            report_url=response_url)
     except DatabaseError as e:
         print('[db]: failed to check for new album details')
         print(f'[db]: {e}')
-        message = 'failed to process all album details...'
-    else:
-        message = 'Processed all album details'
-    if response_url:
-        requests.post(response_url, data=json.dumps({'text': message}))
+        if response_url:
+            requests.post(response_url, data=json.dumps({'text': 'failed to process all album details...'}))
 
 
-@delayed.queue_func
+@delayed.queue_func(queue='interactive')
 def deferred_clear_cache(response_url=None):
     flask.current_app.cache.clear()
     if response_url:
         requests.post(response_url, data=json.dumps({'text': 'Cache cleared'}))
 
 
-@delayed.queue_func
+@delayed.queue_func(queue='interactive')
 def deferred_delete(album_id, response_url=None):
     try:
         albums_model.delete_from_list_and_albums(album_id)
-        flask.current_app.cache.delete(f'alb-{album_id}')
     except DatabaseError as e:
         print(f'[db]: failed to delete album details for {album_id}')
         print(f'[db]: {e}')
@@ -185,7 +230,7 @@ def deferred_delete(album_id, response_url=None):
         requests.post(response_url, data=json.dumps({'text': message}))
 
 
-@delayed.queue_func
+@delayed.queue_func(queue='interactive')
 def deferred_delete_review(album_id, array_element, response_url=None):
     response = {
         'response_type': 'ephemeral',
@@ -203,7 +248,8 @@ def deferred_delete_review(album_id, array_element, response_url=None):
         requests.post(response_url, data=json.dumps(response))
 
 
-@delayed.queue_func
+# not deduplicated: until the album has been scraped it re-queues itself while its own job is still pending
+@delayed.queue_func(queue='interactive')
 def deferred_add_user_to_album(album_url, user_id, response_url=None):
     response = {
         'attachments': build_my_list_attachment(),
@@ -235,7 +281,7 @@ def deferred_add_user_to_album(album_url, user_id, response_url=None):
         requests.post(response_url, data=json.dumps(response))
 
 
-@delayed.queue_func
+@delayed.queue_func(queue='interactive')
 def deferred_remove_user_from_album(album_id, user_id, response_url=None):
     response = {
         'attachments': build_my_list_attachment(),
@@ -255,7 +301,7 @@ def deferred_remove_user_from_album(album_id, user_id, response_url=None):
         requests.post(response_url, data=json.dumps(response))
 
 
-@delayed.queue_func
+@delayed.queue_func(queue='interactive')
 def deferred_remove_user_from_all_albums(user_id, response_url=None):
     response = {
         'attachments': build_my_list_attachment(),
@@ -276,7 +322,7 @@ def deferred_remove_user_from_all_albums(user_id, response_url=None):
 
 
 
-@delayed.queue_func
+@delayed.queue_func(queue='interactive')
 def deferred_add_review_to_album(album_url, user_id, review, response_url=None):
     response = {
         'replace_original': False,
@@ -306,14 +352,12 @@ def deferred_add_review_to_album(album_url, user_id, review, response_url=None):
         requests.post(response_url, data=json.dumps(response))
 
 
-@delayed.queue_func
+@delayed.queue_func(queue='interactive', dedup=('album_id',))
 def deferred_process_album_details(album_id, channel='', slack_token=None):
     try:
         album, artist, url = bandcamp.scrape_bandcamp_album_details_from_id(album_id)
         albums_model.add_to_albums(album_id, artist, album, url, channel=channel)
-        deferred_process_album_cover.delay(album_id)
-        deferred_process_album_tags.delay(album_id)
-        deferred_process_album_released.delay(album_id)
+        deferred_process_album_page_details.delay([album_id])
     except DatabaseError as e:
         print(f'[db]: failed to add album details for {album_id}')
         print(f'[db]: {e}')
@@ -332,29 +376,54 @@ def deferred_process_album_details(album_id, channel='', slack_token=None):
                               f':full_moon_with_face: processed album details for "*{album}*" by *{artist}*')
 
 
-@delayed.queue_func
+@delayed.queue_func(queue='bulk', dedup=True, retry=True)
+def deferred_process_albums_details(album_ids):
+    """
+    Scrape and save the details of a batch of albums, then queue one job to
+    scrape their pages.
+    """
+    details = bandcamp.scrape_bandcamp_album_details_from_ids(album_ids)
+    rows = [
+        (album_id, album_details[1], album_details[0], album_details[2], '')
+        for album_id, album_details in details.items()
+        if album_details
+    ]
+    try:
+        added = albums_model.add_many_to_albums(rows)
+    except DatabaseError as e:
+        print(f'[db]: failed to add album details for {len(rows)} albums')
+        print(f'[db]: {e}')
+        raise
+    if added:
+        deferred_process_album_page_details.delay_on('bulk', added)
+    print(f'[scraper]: processed album details for {len(added)} of {len(album_ids)} albums')
+
+
+@delayed.queue_func(queue='bulk')
 def deferred_add_new_album_details(album_object):
     try:
-        if album_object.album_id not in list_model.get_list():
+        if not flask.current_app.list_membership.contains(album_object.album_id):
             list_model.add_to_list(album_object.album_id)
         if albums_model.get_album_details(album_object.album_id) is None:
             album_object.save()
         if album_object.added:
             albums_model.update_album_added(album_object.album_id, album_object.added.isoformat())
+        fields = ['released']
         if not album_object.album_image:
-            deferred_process_album_cover.delay(album_object.album_id)
-        if album_object.tags is not None:
-            if isinstance(album_object.tags, str):
-                album_object.tags = ast.literal_eval(album_object.tags)
-            deferred_process_tags.delay(album_object.album_id, album_object.tags)
+            fields.append('img')
+        tags, users = album_object.tags, album_object.users
+        if tags is not None:
+            if isinstance(tags, str):
+                tags = ast.literal_eval(tags)
+            deferred_process_tags.delay(album_object.album_id, tags)
         else:
-            deferred_process_album_tags.delay(album_object.album_id)
-        if album_object.users is not None:
-            if isinstance(album_object.users, str):
-                album_object.users = ast.literal_eval(album_object.users)
-            deferred_process_users.delay(album_object.album_id, album_object.users)
+            fields.append('tags')
+        if users is not None:
+            if isinstance(users, str):
+                users = ast.literal_eval(users)
+            deferred_process_users.delay(album_object.album_id, users)
         deferred_check_album_url.delay(album_object.album_id)
-        deferred_process_album_released.delay(album_object.album_id)
+        deferred_process_album_page_details.delay([album_object.album_id], fields)
     except DatabaseError as e:
         print(f'[db]: failed to add new album details for [{album_object.album_id}] {album_object.album_name} by {album_object.album_artist}')
         print(f'[db]: {e}')
@@ -362,153 +431,169 @@ def deferred_add_new_album_details(album_object):
         print(f'[db]: added new album details for [{album_object.album_id}] {album_object.album_name} by {album_object.album_artist}')
 
 
-@delayed.queue_func
-def deferred_process_album_cover(album_id):
-    try:
-        album = albums_model.get_album_details(album_id)
-        album_cover_url = bandcamp.scrape_bandcamp_album_cover_url_from_url(album.album_url)
-        albums_model.add_img_to_album(album_id, album_cover_url)
-    except DatabaseError as e:
-        print(f'[db]: failed to add album cover for {album_id}')
-        print(f'[db]: {e}')
-    except NotFoundError as e:
-        print(f'[scraper]: failed to find album art for {album_id}')
-        print(f'[scraper]: {e}')
-    except (TypeError, ValueError):
-        pass
-    else:
-        print(f'[scraper]: processed cover for {album_id}')
+PAGE_DETAILS_FIELDS = ('img', 'tags', 'released')
+PAGE_DETAILS_BATCH_SIZE = 25
+CHECK_URLS_BATCH_SIZE = 50
 
 
-@delayed.queue_func
-def deferred_process_album_tags(album_id):
+@delayed.queue_func(dedup=True, retry=True)
+def deferred_process_album_page_details(album_ids, fields=PAGE_DETAILS_FIELDS):
+    """
+    Fetch each album page once and write back whichever of its cover (img),
+    tags and release date are listed in fields with a single batched UPDATE.
+    """
+    if not album_ids:
+        return
     try:
-        album = albums_model.get_album_details(album_id)
-        tags = bandcamp.scrape_bandcamp_tags_from_url(album.album_url)
+        albums = list(albums_model.get_album_details_from_ids(tuple(album_ids)))
+    except DatabaseError as e:
+        print(f'[db]: failed to get album details for {len(album_ids)} albums')
+        print(f'[db]: {e}')
+        return
+    pages = bandcamp.scrape_bandcamp_album_page_details_from_urls(album.album_url for album in albums)
+    details = []
+    for album in albums:
+        if pages.get(album.album_url) is None:
+            print(f'[scraper]: failed to find album page for {album.album_id}')
+            continue
+        img, tags, released = pages[album.album_url]
         if tags:
-            deferred_process_tags.delay(album_id, tags)
+            tags = [tag[1:].lower() if tag.startswith('#') else tag.lower() for tag in tags]
+        details.append((
+            album.album_id,
+            img if 'img' in fields else None,
+            tags if 'tags' in fields else None,
+            released if 'released' in fields else None,
+        ))
+    try:
+        albums_model.update_album_page_details(details)
     except DatabaseError as e:
-        print(f'[db]: failed to get album details for {album_id}')
+        print(f'[db]: failed to update page details for {len(details)} albums')
         print(f'[db]: {e}')
-    except (TypeError, ValueError):
-        pass
     else:
-        print(f'[scraper]: processed tags for {album_id}')
+        print(f'[scraper]: processed {", ".join(fields)} for {len(details)} of {len(album_ids)} albums')
 
 
-@delayed.queue_func
+@delayed.queue_func(retry=True)
+def deferred_process_album_cover(album_id):
+    deferred_process_album_page_details([album_id], ('img',))
+
+
+@delayed.queue_func(retry=True)
+def deferred_process_album_tags(album_id):
+    deferred_process_album_page_details([album_id], ('tags',))
+
+
+@delayed.queue_func(retry=True)
 def deferred_process_album_released(album_id):
-    try:
-        album = albums_model.get_album_details(album_id)
-        date = bandcamp.scrape_bandcamp_album_released_from_url(album.album_url)
-        if date:
-            albums_model.add_released_to_album(album_id, date)
-            print(f'[scraper]: added release date {date} to {album_id}')
-    except DatabaseError as e:
-        print(f'[db]: failed to get album details for {album_id}')
-        print(f'[db]: {e}')
-    except (TypeError, ValueError):
-        pass
-    else:
-        print(f'[scraper]: processed release date for {album_id}')
+    deferred_process_album_page_details([album_id], ('released',))
 
 
-@delayed.queue_func
-def deferred_process_all_album_covers(response_url=None):
+def _process_all_album_page_details(get_albums, fields, response_url, description):
     try:
         if response_url:
             requests.post(response_url, data=json.dumps({'text': 'Process started...'}))
-        for album in albums_model.get_albums_without_covers():
-            deferred_process_album_cover.delay(album.album_id)
+        album_ids = [album.album_id for album in get_albums()]
+        delayed.map_chunked(deferred_process_album_page_details, album_ids, fields,
+                            chunk_size=PAGE_DETAILS_BATCH_SIZE, queue='bulk',
+                            description=f'album {description}', report_url=response_url)
     except DatabaseError as e:
         print('[db]: failed to get all album details')
         print(f'[db]: {e}')
-        message = 'failed to process all album details...'
-    else:
-        message = 'Processed all album covers'
-    if response_url:
-        requests.post(response_url, data=json.dumps({'text': message}))
+        if response_url:
+            requests.post(response_url, data=json.dumps({'text': f'failed to process all album {description}...'}))
 
 
-@delayed.queue_func
+@delayed.queue_func(queue='bulk', dedup=())
+def deferred_process_all_album_covers(response_url=None):
+    _process_all_album_page_details(albums_model.get_albums_without_covers, ('img',), response_url, 'covers')
+
+
+@delayed.queue_func(queue='bulk', dedup=())
 def deferred_process_all_album_tags(response_url=None):
-    try:
-        if response_url:
-            requests.post(response_url, data=json.dumps({'text': 'Process started...'}))
-        for album in albums_model.get_albums():
-            deferred_process_album_tags.delay(album.album_id)
-    except DatabaseError as e:
-        print('[db]: failed to get all album details')
-        print(f'[db]: {e}')
-        message = 'failed to process all album details...'
-    else:
-        message = 'Processed all album tags'
-    if response_url:
-        requests.post(response_url, data=json.dumps({'text': message}))
+    _process_all_album_page_details(albums_model.get_albums, ('tags',), response_url, 'tags')
 
 
-@delayed.queue_func
+@delayed.queue_func(queue='bulk', dedup=())
 def deferred_process_all_album_released(response_url=None):
-    try:
-        if response_url:
-            requests.post(response_url, data=json.dumps({'text': 'Process started...'}))
-        for album in albums_model.get_albums():
-            deferred_process_album_released.delay(album.album_id)
-    except DatabaseError as e:
-        print('[db]: failed to get all album details')
-        print(f'[db]: {e}')
-        message = 'failed to process all album release dates...'
-    else:
-        message = 'Processed all album release dates'
-    if response_url:
-        requests.post(response_url, data=json.dumps({'text': message}))
+    _process_all_album_page_details(albums_model.get_albums, ('released',), response_url, 'release dates')
 
 
-@delayed.queue_func
-def deferred_check_album_url(album_id, check_for_new_url=True):
-    try:
-        album = albums_model.get_album_details(album_id)
-        response = requests.head(album.album_url)
-        if response.ok and not album.available:
-            print(f'[scraper]: [{album_id}] {album.album_name} by {album.album_artist} is now available')
-            albums_model.update_album_availability(album_id, True)
+def _check_album_url(album, response, check_for_new_url=True):
+    album_id = album.album_id
+    if response.ok and not album.available:
+        print(f'[scraper]: [{album_id}] {album.album_name} by {album.album_artist} is now available')
+        albums_model.update_album_availability(album_id, True)
 
-        elif response.status_code > 400:
+    elif response.status_code > 400:
 
-            if check_for_new_url:
-                try:
-                    _, _, album_url = bandcamp.scrape_bandcamp_album_details_from_id(album_id)
-                    if album_url != album.album_url:
-                        print(f'[scraper] alternative album URL found at {album_url} for {album_id}')
-                        albums_model.update_album_url(album_id, album_url)
-                        return
-                except TypeError:
-                    print(f'[scraper] no alternative URL found for {album_id}')
-                except DatabaseError as e:
-                    print(f'[db]: failed to update album URL for {album_id}')
-                    print(f'[db]: {e}')
+        if check_for_new_url:
+            try:
+                _, _, album_url = bandcamp.scrape_bandcamp_album_details_from_id(album_id)
+                if album_url != album.album_url:
+                    print(f'[scraper] alternative album URL found at {album_url} for {album_id}')
+                    albums_model.update_album_url(album_id, album_url)
+                    return
+            except TypeError:
+                print(f'[scraper] no alternative URL found for {album_id}')
+            except DatabaseError as e:
+                print(f'[db]: failed to update album URL for {album_id}')
+                print(f'[db]: {e}')
+
+        if album.available:
+            albums_model.update_album_availability(album_id, False)
+            message = f'[{album_id}] {album.album_name} by {album.album_artist} is no longer available'
+            print(f'[scraper]: {message}')
 
-            if album.available:
-                albums_model.update_album_availability(album_id, False)
-                message = f'[{album_id}] {album.album_name} by {album.album_artist} is no longer available'
-                print(f'[scraper]: {message}')
 
+@delayed.queue_func(dedup=True, retry=True)
+def deferred_check_album_url(album_id, check_for_new_url=True):
+    try:
+        album = albums_model.get_album_details(album_id)
+        _check_album_url(album, fetch.head(album.album_url), check_for_new_url)
     except DatabaseError as e:
         print('[db]: failed to update album after check')
         print(f'[db]: {e}')
-    except (TypeError, ValueError):
+    except FetchError as e:
+        print(f'[scraper]: {e}')
+    except (TypeError, ValueError, AttributeError):
         pass
     else:
         print(f'[scraper]: checked availability for {album_id}')
 
 
-@delayed.queue_func
+@delayed.queue_func(queue='bulk', dedup=True, retry=True)
+def deferred_check_album_urls(album_ids, check_for_new_url=True):
+    """
+    Check a batch of album URLs with concurrent HEAD requests.
+    """
+    try:
+        albums = {album.album_url: album for album in albums_model.get_album_details_from_ids(tuple(album_ids))}
+    except DatabaseError as e:
+        print('[db]: failed to get albums to check')
+        print(f'[db]: {e}')
+        return
+    for album_url, response in fetch.fetch_many(albums, method='HEAD'):
+        album = albums[album_url]
+        if isinstance(response, FetchError):
+            print(f'[scraper]: {response}')
+            continue
+        try:
+            _check_album_url(album, response, check_for_new_url)
+        except DatabaseError as e:
+            print('[db]: failed to update album after check')
+            print(f'[db]: {e}')
+    print(f'[scraper]: checked availability for {len(albums)} albums')
+
+
+@delayed.queue_func(queue='bulk', dedup=())
 def deferred_check_all_album_urls(response_url=None):
     try:
         if response_url:
             requests.post(response_url, data=json.dumps({'text': 'Check started...'}))
-        for album_id in albums_model.get_album_ids():
-            deferred_check_album_url.delay(album_id)
+        delayed.map_chunked(deferred_check_album_urls, albums_model.get_album_ids(),
+                            chunk_size=CHECK_URLS_BATCH_SIZE, description='album url checks',
+                            report_url=response_url)
     except DatabaseError as e:
         print('[db]: failed to check for new album details')
         print(f'[db]: {e}')
@@ -516,37 +601,55 @@ def deferred_check_all_album_urls(response_url=None):
             requests.post(response_url, data=json.dumps({'text': 'failed to check all album urls'}))
 
 
-@delayed.queue_func
+ATTRIBUTION_BATCH_SIZE = 50
+
+
+def _attribute_album_url(slack, album):
+    response = slack.search.all(album.album_url)
+    if response.successful:
+        for match in response.body['messages']['matches']:
+            user = match['user']
+            if user:
+                albums_model.add_user_to_album(album.album_id, user)
+                print(f'[scraper]: added {user} to {album.album_id}')
+            elif 'previous' in match and album.album_url in match['previous']['text']:
+                albums_model.add_user_to_album(album.album_id, match['previous']['user'])
+                print(f'[scraper]: added {match["previous"]["user"]} to {album.album_id}')
+            elif 'previous2' in match and album.album_url in match['previous2']['text']:
+                albums_model.add_user_to_album(album.album_id, match['previous2']['user'])
+                print(f'[scraper]: added {match["previous2"]["user"]} to {album.album_id}')
+
+
+@delayed.queue_func(dedup=('album_id',), retry=True)
 def deferred_attribute_album_url(album_id, slack_token):
+    deferred_attribute_album_urls([album_id], slack_token)
+
+
+@delayed.queue_func(queue='bulk', dedup=('album_ids',), retry=True)
+def deferred_attribute_album_urls(album_ids, slack_token):
+    slack = slacker.Slacker(slack_token)
     try:
-        album = albums_model.get_album_details(album_id)
-        album_url = album.album_url
-        slack = slacker.Slacker(slack_token)
-        response = slack.search.all(album_url)
-        if response.successful:
-            for match in response.body['messages']['matches']:
-                user = match['user']
-                if user:
-                    albums_model.add_user_to_album(album_id, user)
-                    print(f'[scraper]: added {user} to {album_id}')
-                elif 'previous' in match and album_url in match['previous']['text']:
-                    albums_model.add_user_to_album(album_id, match['previous']['user'])
-                    print(f'[scraper]: added {match["previous"]["user"]} to {album_id}')
-                elif 'previous2' in match and album_url in match['previous2']['text']:
-                    albums_model.add_user_to_album(album_id, match['previous2']['user'])
-                    print(f'[scraper]: added {match["previous2"]["user"]} to {album_id}')
-    except (DatabaseError, KeyError) as e:
-        print('[db]: failed to attribute users to album')
+        albums = list(albums_model.get_album_details_from_ids(tuple(album_ids)) or [])
+    except DatabaseError as e:
+        print('[db]: failed to attribute users to albums')
         print(f'[db]: {e}')
+        return
+    for album in albums:
+        try:
+            _attribute_album_url(slack, album)
+        except (DatabaseError, KeyError) as e:
+            print('[db]: failed to attribute users to album')
+            print(f'[db]: {e}')
 
 
-@delayed.queue_func
+@delayed.queue_func(queue='bulk', dedup=())
 def deferred_attribute_users_to_all_album_urls(slack_token, response_url=None):
     try:
         if response_url:
             requests.post(response_url, data=json.dumps({'text': 'Attribution started...'}))
-        for album_id in albums_model.get_album_ids():
-            deferred_attribute_album_url.delay(album_id, slack_token)
+        delayed.map_chunked(deferred_attribute_album_urls, albums_model.get_album_ids(), slack_token,
+                            chunk_size=ATTRIBUTION_BATCH_SIZE, description='album attribution',
+                            report_url=response_url)
     except DatabaseError as e:
         print('[db]: failed to start attribution process')
         print(f'[db]: {e}')
@@ -566,13 +669,67 @@ def deferred_ping_albumlistbot():
         print(f'[ping]: unable to reach albumlist bot: {response.status_code}')
 
 
-@delayed.queue_func
-def deferred_fetch_and_restore(url_to_csv):
-    response = requests.get(url_to_csv)
-    if response.ok and csv.Sniffer().has_header(response.text):
-        f = io.StringIO(response.text)
-        reader = csv.DictReader(f)
-        for album_details in reader:
-            deferred_add_new_album_details.delay(albums_model.Album.from_dict(album_details))
-    else:
-        print('[restore]: failed to get csv')
+RESTORE_BATCH_SIZE = 5000
+RESTORE_MAX_INVALID_REPORTED = 5
+
+
+@delayed.queue_func(queue='bulk', dedup=('url_to_csv',))
+def deferred_fetch_and_restore(url_to_csv, response_url=None):
+    """
+    Stream an albums dump and restore it with restore_model.restore_albums,
+    then scrape only what the restored albums are missing.
+    """
+    def report(text):
+        print(f'[restore]: {text}')
+        if response_url:
+            requests.post(response_url, data=json.dumps({'text': text}))
+
+    try:
+        response = requests.get(url_to_csv, stream=True, timeout=(5, 60))
+    except requests.RequestException as e:
+        report(f'failed to get csv: {e}')
+        return
+    if not response.ok:
+        report(f'failed to get csv: {response.status_code}')
+        return
+    response.raw.decode_content = True
+    reader = csv.DictReader(io.TextIOWrapper(response.raw, encoding='utf-8', newline=''))
+    if not reader.fieldnames or 'id' not in reader.fieldnames:
+        report('failed to restore: csv has no id column')
+        return
+    invalid = []
+
+    def valid_rows():
+        for line_number, album_details in enumerate(reader, 2):
+            try:
+                yield restore_model.staging_row_from_dict(album_details)
+            except restore_model.InvalidRow as e:
+                invalid.append((line_number, e))
+
+    report('Restoring albums...')
+    try:
+        result = restore_model.restore_albums(
+            valid_rows(),
+            batch_size=RESTORE_BATCH_SIZE,
+            progress=lambda loaded: report(f'loaded {loaded} albums...'),
+        )
+    except (DatabaseError, requests.RequestException, csv.Error, UnicodeDecodeError) as e:
+        report(f'failed to restore albums: {e}')
+        return
+    finally:
+        response.close()
+    for line_number, e in invalid[:RESTORE_MAX_INVALID_REPORTED]:
+        print(f'[restore]: skipped line {line_number}: {e}')
+    missing_fields = collections.defaultdict(list)
+    for album_id, no_img, no_tags, no_released in result['missing_details']:
+        fields = tuple(field for field, missing in zip(PAGE_DETAILS_FIELDS, (no_img, no_tags, no_released)) if missing)
+        missing_fields[fields].append(album_id)
+    for fields, album_ids in missing_fields.items():
+        delayed.map_chunked(deferred_process_album_page_details, album_ids, fields,
+                            chunk_size=PAGE_DETAILS_BATCH_SIZE, queue='bulk',
+                            description=f'restored album {", ".join(fields)}', report_url=response_url)
+    if result['missing_albums']:
+        deferred_process_all_album_details.delay(response_url)
+    report(f'Restored {result["loaded"]} albums: {result["added_to_list"]} added to the list, '
+           f'{len(result["missing_details"])} to scrape for missing details, '
+           f'{result["missing_albums"]} without album details, {len(invalid)} invalid rows skipped')
@@ -0,0 +1,263 @@
+import collections
+import functools
+import os
+import signal
+import threading
+import time
+from concurrent import futures
+from concurrent.futures.process import BrokenProcessPool
+
+import redis
+
+from albumlist import metrics
+from albumlist.delayed import jobs, redis_connection
+from albumlist.delayed.broker import worker_id
+from albumlist.scrapers import fetch
+
+
+OK, FAILED, INVALID = 'ok', 'failed', 'invalid'
+
+Outcome = collections.namedtuple('Outcome', 'worker_name status error duration task waited')
+
+
+def execute(payload, rv_ttl):
+    """
+    Run a single queued job and store its return value.
+
+    Returns an Outcome with the name of the thread or process it ran on,
+    whether it succeeded, failed or couldn't be decoded, the error if any,
+    how long it took, and its task and how long it waited in the queue, so
+    the worker can acknowledge or retry it and record metrics. Metrics are
+    recorded by the worker rather than here so that they aren't lost in
+    the child processes of a process pool.
+    """
+    from application import application
+
+    started = time.monotonic()
+    worker_name = _worker_name()
+    try:
+        job = jobs.Job.loads(payload)
+        func = job.func
+    except Exception as e:
+        print(f'[daemon]: {worker_name} failed to decode job: {e}')
+        return Outcome(worker_name, INVALID, str(e), time.monotonic() - started, None, None)
+    waited = max(0.0, time.time() - job.enqueued) if job.enqueued else None
+    status, error = OK, None
+    try:
+        print(f'[daemon]: {worker_name} calling {job.task}')
+        with application.app_context():
+            rv = func(*job.args, **job.kwargs)
+        print(f'[daemon]: {worker_name} completed {job.task}')
+    except Exception as e:
+        print(f'[daemon]: {worker_name} {job.task} failed: {e}')
+        status, error = FAILED, f'{type(e).__name__}: {e}'
+        rv = e
+    if rv is not None and job.result_key:
+        try:
+            redis_connection.set(job.result_key, jobs.dumps_value(rv), ex=rv_ttl)
+            print(f'[daemon]: stored return value at {job.result_key}')
+        except Exception as e:
+            print(f'[daemon]: failed to store return value at {job.result_key}: {e}')
+    return Outcome(worker_name, status, error, time.monotonic() - started, job.task, waited)
+
+
+def _worker_name():
+    thread = threading.current_thread()
+    if thread is threading.main_thread():
+        return f'pid-{os.getpid()}'
+    return thread.name
+
+
+class WorkerStats:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._started = time.monotonic()
+        self._workers = collections.defaultdict(lambda: {'completed': 0, 'failed': 0, 'busy': 0.0})
+        self.retried = 0
+        self.buried = 0
+
+    def record(self, worker_name, ok, duration):
+        with self._lock:
+            stats = self._workers[worker_name]
+            stats['completed' if ok else 'failed'] += 1
+            stats['busy'] += duration
+
+    def record_failure(self, buried):
+        with self._lock:
+            if buried:
+                self.buried += 1
+            else:
+                self.retried += 1
+
+    def report(self):
+        elapsed = max(time.monotonic() - self._started, 1e-9)
+        with self._lock:
+            return {
+                worker_name: dict(stats, per_second=(stats['completed'] + stats['failed']) / elapsed)
+                for worker_name, stats in sorted(self._workers.items())
+            }
+
+
+class Worker:
+    """
+    Takes jobs from the broker and runs up to `concurrency` of them at once.
+
+    Jobs run on a thread pool by default since the scraper jobs mostly wait
+    on the network; pass pool='process' for CPU bound work. Each job stays
+    on this worker's processing list until it has finished, and jobs that
+    raise are handed back to the broker to retry or bury. A SIGTERM or
+    SIGINT stops the worker from taking new jobs and waits for in-flight
+    jobs to finish.
+    """
+
+    def __init__(self, broker, concurrency=4, pool='thread', rv_ttl=500, poll_timeout=1, report_interval=60):
+        if pool not in ('thread', 'process'):
+            raise ValueError(f'unknown worker pool: {pool}')
+        self.broker = broker
+        self.worker_id = worker_id()
+        self.concurrency = concurrency
+        self.pool = pool
+        self.rv_ttl = rv_ttl
+        self.poll_timeout = poll_timeout
+        self.report_interval = report_interval
+        self.maintenance_interval = max(1, broker.heartbeat_ttl // 3)
+        self.stats = WorkerStats()
+        self._stopping = threading.Event()
+        self._slots = threading.BoundedSemaphore(concurrency)
+        self._last_report = time.monotonic()
+        self._last_maintenance = None
+
+    def _executor(self):
+        if self.pool == 'process':
+            return futures.ProcessPoolExecutor(max_workers=self.concurrency)
+        return futures.ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix='daemon')
+
+    def stop(self, *_):
+        if not self._stopping.is_set():
+            print('[daemon]: stopping, waiting for in-flight jobs to finish...')
+        self._stopping.set()
+
+    def _done(self, payload, future):
+        self._slots.release()
+        try:
+            worker_name, status, error, duration, task, waited = future.result()
+        except Exception as e:
+            # the process running the job died, so fail it like a job that raised
+            worker_name, status, error, duration, task, waited = \
+                'unknown', FAILED, f'{type(e).__name__}: {e}', 0.0, None, None
+        self.stats.record(worker_name, status == OK, duration)
+        self._record_metrics(task or 'unknown', status, duration, waited)
+        try:
+            if status == INVALID:
+                print(f'[daemon]: burying undecodable job: {error}')
+                self.broker.bury(self.worker_id, payload)
+                return
+            job = jobs.Job.loads(payload)
+            if status == OK:
+                self.broker.ack(self.worker_id, payload, job)
+            else:
+                buried = self.broker.fail(self.worker_id, payload, job, error)
+                self.stats.record_failure(buried)
+                if buried:
+                    print(f'[daemon]: {job.task} failed {job.attempts} times, moved to dead letters')
+                else:
+                    print(f'[daemon]: {job.task} failed, retry {job.attempts} scheduled')
+        except (redis.RedisError, jobs.JobError) as e:
+            # left on the processing list, so it will be retried when this worker is reclaimed
+            print(f'[daemon]: failed to settle job: {e}')
+
+    @staticmethod
+    def _record_metrics(task, status, duration, waited):
+        metrics.JOBS_FINISHED.inc(task, status)
+        if status == INVALID:
+            return
+        if waited is not None:
+            metrics.JOB_WAIT.observe(waited, task)
+        metrics.JOB_DURATION.observe(duration, task)
+        if status == FAILED:
+            metrics.JOB_ERRORS.inc(task)
+
+    def _maintain(self, force=False):
+        now = time.monotonic()
+        if not force and self._last_maintenance is not None \
+                and now - self._last_maintenance < self.maintenance_interval:
+            return
+        self._last_maintenance = now
+        try:
+            self.broker.heartbeat(self.worker_id)
+            promoted = self.broker.promote_due_retries()
+            if promoted:
+                print(f'[daemon]: {promoted} jobs due for retry')
+            reclaimed = self.broker.reclaim(live_worker_id=self.worker_id)
+            if reclaimed:
+                print(f'[daemon]: reclaimed {reclaimed} jobs from stopped workers')
+        except redis.RedisError as e:
+            print(f'[daemon]: maintenance failed: {e}')
+
+    def _maybe_report(self, force=False):
+        now = time.monotonic()
+        if force or now - self._last_report >= self.report_interval:
+            self._last_report = now
+            for worker_name, stats in self.stats.report().items():
+                print(f'[daemon]: {worker_name}: {stats["completed"]} completed, {stats["failed"]} failed, '
+                      f'{stats["per_second"]:.2f} jobs/s, {stats["busy"]:.1f}s busy')
+            print(f'[daemon]: {self.stats.retried} retries scheduled, {self.stats.buried} jobs buried')
+            try:
+                print(f'[daemon]: queue: {self.broker.stats()}')
+            except redis.RedisError as e:
+                print(f'[daemon]: failed to get queue stats: {e}')
+            cache_stats = fetch.cache_stats()
+            if cache_stats:
+                print(f'[daemon]: scraper cache: {cache_stats}')
+
+    def run(self):
+        # load the app and register its tasks before forking or starting threads so they share them
+        from application import application  # noqa
+        import albumlist.delayed.queued  # noqa
+
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        # jobs left by a previous run of this worker under the same id
+        requeued = self.broker.requeue_processing(self.worker_id)
+        if requeued:
+            print(f'[daemon]: requeued {requeued} unfinished jobs')
+        self._maintain(force=True)
+        print(f'[daemon]: running {self.concurrency} {self.pool} workers on {self.broker.queue} as {self.worker_id}')
+        executor = self._executor()
+        try:
+            while not self._stopping.is_set():
+                self._maintain()
+                self._maybe_report()
+                if not self._slots.acquire(timeout=self.poll_timeout):
+                    continue
+                try:
+                    payload = self.broker.dequeue(self.worker_id, timeout=self.poll_timeout)
+                except redis.RedisError as e:
+                    print(f'[daemon]: failed to take a job: {e}')
+                    payload = None
+                    time.sleep(self.poll_timeout)
+                if payload is None:
+                    self._slots.release()
+                    continue
+                try:
+                    future = executor.submit(execute, payload, self.rv_ttl)
+                except BrokenProcessPool as e:
+                    # a child process died and the pool can't be used again, so hand the job back
+                    # to run first on the new one
+                    print(f'[daemon]: process pool broken, starting a new one: {e}')
+                    try:
+                        self.broker.requeue(self.worker_id, payload)
+                    except redis.RedisError as e:
+                        # left on the processing list for when this worker restarts
+                        print(f'[daemon]: failed to requeue a job: {e}')
+                    self._slots.release()
+                    executor.shutdown(wait=False)
+                    executor = self._executor()
+                    continue
+                future.add_done_callback(functools.partial(self._done, payload))
+        finally:
+            executor.shutdown(wait=True)
+        self._maybe_report(force=True)
+        self.broker.retire(self.worker_id)
+        print('[daemon]: stopped')
@@ -0,0 +1,131 @@
+import redis
+
+from albumlist.models import events
+
+
+# updates to these fields only change an album's own caches
+PRIVATE_FIELDS = {'users', 'reviews'}
+
+
+class CacheDependencies:
+    """
+    Deletes cached values when the albums, tags or collections they were
+    built from change.
+    """
+
+    def __init__(self, cache, redis_connection, prefix='cache-deps', ttl=60 * 60 * 24 * 2, changed_ttl=60 * 60):
+        self.cache = cache
+        self.redis = redis_connection
+        self.prefix = prefix
+        # longer than any cached value that registers dependencies
+        self.ttl = ttl
+        # longer than any value takes to compute
+        self.changed_ttl = changed_ttl
+        self.generation_key = f'{prefix}:generation'
+        self.reset_key = self.changed_key(self.key('all', '*'))
+        events.subscribe(events.ALBUMS_ADDED, self._albums_added)
+        events.subscribe(events.ALBUMS_UPDATED, self._albums_updated)
+        events.subscribe(events.ALBUMS_DELETED, self._albums_deleted)
+        events.subscribe(events.ALBUMS_RESET, self._albums_reset)
+
+    def key(self, kind, name):
+        return f'{self.prefix}:{kind}:{name}'
+
+    def changed_key(self, dependency):
+        return f'{dependency}:changed'
+
+    def _keys(self, albums=(), tags=(), collections=()):
+        return (
+            [self.key('album', album_id) for album_id in albums] +
+            [self.key('tag', tag) for tag in tags] +
+            [self.key('collection', collection) for collection in collections]
+        )
+
+    def token(self):
+        try:
+            return int(self.redis.get(self.generation_key) or 0)
+        except redis.RedisError as e:
+            print(f'[redis]: cache dependencies unavailable: {e}')
+            return None
+
+    def set(self, key, value, timeout, token, albums=(), tags=(), collections=()):
+        """
+        Cache value under key for timeout seconds until any of the given
+        albums, tags or collections change. Returns whether it was cached.
+        """
+        if token is None:
+            return False
+        dependencies = self._keys(albums, tags, collections)
+        try:
+            pipe = self.redis.pipeline()
+            for dependency in dependencies:
+                pipe.sadd(dependency, key)
+                pipe.expire(dependency, self.ttl)
+            pipe.execute()
+            self.cache.set(key, value, timeout)
+            # an invalidation after this finds the key in the sets, one before it has left its number
+            changed = self.redis.mget([self.reset_key] + [self.changed_key(d) for d in dependencies])
+            if any(generation is not None and int(generation) > token for generation in changed):
+                self.cache.delete(key)
+                return False
+        except redis.RedisError as e:
+            print(f'[redis]: failed to register cache dependencies for {key}: {e}')
+            self.cache.delete(key)
+            return False
+        return True
+
+    def invalidate(self, albums=(), tags=(), collections=()):
+        """
+        Delete the cached values that depend on any of the given albums, tags
+        or collections.
+        """
+        dependencies = self._keys(albums, tags, collections)
+        if not dependencies:
+            return
+        generation = self.redis.incr(self.generation_key)
+        pipe = self.redis.pipeline()
+        for dependency in dependencies:
+            pipe.set(self.changed_key(dependency), generation, ex=self.changed_ttl)
+        pipe.sunion(*dependencies)
+        pipe.delete(*dependencies)
+        keys = pipe.execute()[-2]
+        if keys:
+            self.cache.delete_many(*[key.decode('utf-8') for key in keys])
+
+    def invalidate_all(self):
+        generation = self.redis.incr(self.generation_key)
+        self.redis.set(self.reset_key, generation, ex=self.changed_ttl)
+        for dependency in self.redis.scan_iter(match=self.key('*', '*'), count=1000):
+            if dependency.endswith(b':changed'):
+                continue
+            keys = self.redis.smembers(dependency)
+            self.redis.delete(dependency)
+            if keys:
+                self.cache.delete_many(*[key.decode('utf-8') for key in keys])
+
+    def _albums_added(self, rows):
+        self.invalidate(collections=('albums', 'album-urls', 'search'))
+
+    def _albums_updated(self, album_ids, changes, tags=()):
+        collections = []
+        if set(changes) - PRIVATE_FIELDS:
+            collections.append('albums')
+        if 'available' in changes or 'url' in changes:
+            collections.extend(('album-urls', 'search'))
+        # searches match tags lowercased
+        tags = set(tags or [])
+        tags |= {tag.lower() for tag in tags}
+        self.invalidate(albums=album_ids, tags=tags, collections=collections)
+
+    def _albums_deleted(self, rows):
+        tags = {tag for *_, row_tags in rows for tag in row_tags or []}
+        tags |= {tag.lower() for tag in tags}
+        self.invalidate(
+            albums=[row[0] for row in rows],
+            tags=tags,
+            collections=('albums', 'album-urls', 'search'),
+        )
+
+    def _albums_reset(self):
+        self.invalidate_all()
+
@@ -0,0 +1,133 @@
+import threading
+import time
+
+import redis
+
+from albumlist.models import events
+from albumlist.models import list as list_model
+
+
+# replace the mirror with a rebuilt set, removing the albums deleted since
+# the rebuild started (ARGV[1]) and forgetting deletions older than ARGV[2];
+# if the list was reset since then (KEYS[5] is no longer ARGV[4]) it's left
+# to the next rebuild
+REPLACE_SCRIPT = """
+if (redis.call('GET', KEYS[5]) or '0') ~= ARGV[4] then
+    redis.call('DEL', KEYS[1])
+    return 0
+end
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    redis.call('RENAME', KEYS[1], KEYS[2])
+else
+    redis.call('DEL', KEYS[2])
+end
+for _, album_id in ipairs(redis.call('ZRANGEBYSCORE', KEYS[3], ARGV[1], '+inf')) do
+    redis.call('SREM', KEYS[2], album_id)
+end
+redis.call('ZREMRANGEBYSCORE', KEYS[3], '-inf', ARGV[2])
+redis.call('SET', KEYS[4], 1, 'EX', ARGV[3])
+return 1
+"""
+
+
+class ListMembership:
+    """
+    Whether album ids are in the list, looked up in a Redis mirror of its
+    ids when given a connection and in the list table when that misses.
+    """
+
+    def __init__(self, redis_connection=None, key='list-members', ttl=3600):
+        self.redis = redis_connection
+        self.key = key
+        self.ready_key = f'{key}:ready'
+        self.deleted_key = f'{key}:deleted'
+        self.resets_key = f'{key}:resets'
+        self.ttl = ttl
+        self._rebuild_lock = threading.Lock()
+        self._replace = redis_connection.register_script(REPLACE_SCRIPT) if redis_connection is not None else None
+        events.subscribe(events.LIST_ADDED, self._added)
+        events.subscribe(events.LIST_DELETED, self._deleted)
+        events.subscribe(events.LIST_RESET, self._reset)
+
+    def _mirror(self):
+        if self.redis is None:
+            return False
+        try:
+            if self.redis.exists(self.ready_key):
+                return True
+            with self._rebuild_lock:
+                if not self.redis.exists(self.ready_key):
+                    self.rebuild()
+            return True
+        except redis.RedisError as e:
+            print(f'[redis]: list membership unavailable: {e}')
+            return False
+
+    def rebuild(self, chunk_size=1000):
+        # with some slack for other processes' clocks; removing too many only costs table lookups
+        started = time.time() - 60
+        resets = (self.redis.get(self.resets_key) or b'0').decode('utf-8')
+        album_ids = list_model.get_list()
+        rebuild_key = f'{self.key}:rebuild'
+        pipe = self.redis.pipeline()
+        pipe.delete(rebuild_key)
+        for i in range(0, len(album_ids), chunk_size):
+            pipe.sadd(rebuild_key, *album_ids[i:i + chunk_size])
+        pipe.execute()
+        if self._replace(keys=[rebuild_key, self.key, self.deleted_key, self.ready_key, self.resets_key],
+                         args=[started, started - self.ttl, self.ttl, resets]):
+            print(f'[redis]: rebuilt list membership with {len(album_ids)} albums')
+
+    def contains(self, album_id):
+        album_id = str(album_id)
+        if self._mirror():
+            try:
+                if self.redis.sismember(self.key, album_id):
+                    return True
+            except redis.RedisError as e:
+                print(f'[redis]: list membership unavailable: {e}')
+        return list_model.is_in_list(album_id)
+
+    def new_ids(self, album_ids):
+        """
+        The given album ids that are not in the list yet, in the order given.
+        """
+        album_ids = list(dict.fromkeys(str(album_id) for album_id in album_ids if album_id is not None))
+        if not album_ids:
+            return []
+        if self._mirror():
+            try:
+                pipe = self.redis.pipeline(transaction=False)
+                for album_id in album_ids:
+                    pipe.sismember(self.key, album_id)
+                album_ids = [album_id for album_id, exists in zip(album_ids, pipe.execute()) if not exists]
+            except redis.RedisError as e:
+                print(f'[redis]: list membership unavailable: {e}')
+            if not album_ids:
+                return []
+        existing = list_model.get_existing_list_ids(album_ids)
+        return [album_id for album_id in album_ids if album_id not in existing]
+
+    def _added(self, album_ids):
+        if self.redis is not None and album_ids:
+            self.redis.sadd(self.key, *[str(album_id) for album_id in album_ids])
+
+    def _deleted(self, album_ids):
+        if self.redis is not None and album_ids:
+            album_ids = [str(album_id) for album_id in album_ids]
+            now = time.time()
+            pipe = self.redis.pipeline()
+            pipe.srem(self.key, *album_ids)
+            # so that a rebuild that read the list before this doesn't add them back
+            for album_id in album_ids:
+                pipe.zadd(self.deleted_key, album_id, now)
+            pipe.expire(self.deleted_key, self.ttl)
+            pipe.execute()
+
+    def _reset(self):
+        if self.redis is not None:
+            pipe = self.redis.pipeline()
+            pipe.delete(self.key, self.ready_key)
+            pipe.incr(self.resets_key)
+            pipe.execute()
+
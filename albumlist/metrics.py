@@ -0,0 +1,259 @@
+import bisect
+import collections
+import hmac
+import socketserver
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+
+    kind = 'counter'
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.label_names = tuple(labels)
+        self._lock = threading.Lock()
+        self._values = collections.defaultdict(int)
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] += amount
+
+    def samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        for label_values, value in values:
+            yield self.name, _labels(self.label_names, label_values), value
+
+
+class Histogram:
+    """
+    Cumulative bucket counts, sum and count of observations per label set,
+    like a Prometheus client histogram.
+    """
+
+    kind = 'histogram'
+
+    def __init__(self, name, description, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.description = description
+        self.label_names = tuple(labels)
+        self.buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        # label values -> [per bucket counts..., +Inf count, sum]
+        self._values = {}
+
+    def observe(self, value, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(label_values)
+            if counts is None:
+                counts = self._values[label_values] = [0] * (len(self.buckets) + 2)
+            counts[index] += 1
+            counts[-1] += value
+
+    @contextmanager
+    def time(self, *label_values):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - started, *label_values)
+
+    def samples(self):
+        with self._lock:
+            values = sorted((label_values, list(counts)) for label_values, counts in self._values.items())
+        for label_values, counts in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'), ), counts):
+                cumulative += count
+                yield f'{self.name}_bucket', _labels(self.label_names, label_values, [('le', _number(bound))]), \
+                    cumulative
+            yield f'{self.name}_sum', _labels(self.label_names, label_values), counts[-1]
+            yield f'{self.name}_count', _labels(self.label_names, label_values), cumulative
+
+
+class Gauge:
+    """
+    A value read when the metrics are rendered: collect() returns a number,
+    or a dict of label values (tuples) to numbers.
+    """
+
+    kind = 'gauge'
+
+    def __init__(self, name, description, collect, labels=()):
+        self.name = name
+        self.description = description
+        self.label_names = tuple(labels)
+        self.collect = collect
+
+    def samples(self):
+        values = self.collect()
+        if not isinstance(values, dict):
+            values = {(): values}
+        for label_values, value in sorted(values.items()):
+            yield self.name, _labels(self.label_names, label_values), value
+
+
+class Registry:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = collections.OrderedDict()
+
+    def register(self, metric):
+        with self._lock:
+            existing = self._metrics.setdefault(metric.name, metric)
+        if existing is not metric and type(existing) is not type(metric):
+            raise ValueError(f'metric {metric.name} is already registered as a {existing.kind}')
+        return existing
+
+    def render(self):
+        """
+        All metrics in the Prometheus text exposition format. A gauge that
+        fails to collect is left out rather than failing the scrape.
+        """
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            try:
+                samples = list(metric.samples())
+            except Exception as e:
+                print(f'[metrics]: failed to collect {metric.name}: {e}')
+                continue
+            lines.append(f'# HELP {metric.name} {metric.description}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            lines.extend(f'{name}{labels} {_number(value)}' for name, labels, value in samples)
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+def counter(name, description, labels=()):
+    return REGISTRY.register(Counter(name, description, labels))
+
+
+def histogram(name, description, labels=(), buckets=DEFAULT_BUCKETS):
+    return REGISTRY.register(Histogram(name, description, labels, buckets))
+
+
+def gauge(name, description, collect, labels=()):
+    return REGISTRY.register(Gauge(name, description, collect, labels))
+
+
+def render():
+    return REGISTRY.render()
+
+
+# shared by the web and worker processes
+JOBS_QUEUED = counter('albumlist_jobs_queued_total', 'Jobs queued, by task and queue', ('task', 'queue'))
+JOB_WAIT = histogram('albumlist_job_wait_seconds', 'Time from queueing a job to starting it, by task', ('task', ))
+JOB_DURATION = histogram('albumlist_job_duration_seconds', 'Time taken to run a job, by task', ('task', ))
+JOBS_FINISHED = counter('albumlist_jobs_total', 'Jobs run, by task and status', ('task', 'status'))
+JOB_ERRORS = counter('albumlist_job_errors_total', 'Jobs that raised, by task', ('task', ))
+DB_QUERY = histogram('albumlist_db_query_seconds', 'Database query time, by model function', ('query', ))
+DB_ERRORS = counter('albumlist_db_errors_total', 'Database queries that raised, by model function', ('query', ))
+HTTP_REQUEST = histogram('albumlist_http_request_seconds', 'Outbound scraper request time, by host and method',
+                         ('host', 'method'))
+HTTP_ERRORS = counter('albumlist_http_errors_total', 'Outbound scraper requests that failed, by host and method',
+                      ('host', 'method'))
+
+
+def register_queue_gauges(broker):
+    """
+    Queue depth gauges read from the broker when the metrics are rendered.
+    """
+    cached = {'at': 0.0, 'stats': None}
+    lock = threading.Lock()
+
+    def stats():
+        # the four gauges are rendered together, so share one round trip
+        with lock:
+            if time.monotonic() - cached['at'] > 1:
+                cached['stats'], cached['at'] = broker.stats(), time.monotonic()
+            return cached['stats']
+
+    def depths(field):
+        def collect():
+            return {(lane, ): values[field] for lane, values in stats()['lanes'].items()}
+        return collect
+
+    gauge('albumlist_queue_depth', 'Jobs waiting to run, by queue', depths('queued'), ('queue', ))
+    gauge('albumlist_queue_retrying', 'Jobs waiting to be retried, by queue', depths('retrying'), ('queue', ))
+    gauge('albumlist_queue_dead', 'Jobs in the dead-letter list', lambda: stats()['dead'])
+    gauge('albumlist_queue_workers', 'Workers with a live heartbeat', lambda: stats()['workers'])
+
+
+def is_authorized(authorization, token):
+    """
+    Whether an Authorization header allows reading the metrics: anyone can
+    if no token is configured, otherwise it must be "Bearer <token>".
+    """
+    if not token:
+        return True
+    return hmac.compare_digest(authorization or '', f'Bearer {token}')
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+
+    token = None
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        if not is_authorized(self.headers.get('Authorization'), self.token):
+            self.send_error(401)
+            return
+        body = render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def serve(port, host='0.0.0.0', token=None):
+    """
+    Serve /metrics from a background thread, for processes without a web app.
+    """
+    handler = type('MetricsHandler', (_MetricsHandler, ), {'token': token})
+    server = _ThreadingHTTPServer((host, port), handler)
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    print(f'[metrics]: serving /metrics on {host}:{port}')
+    return server
@@ -1,13 +1,66 @@
 import os
-from contextlib import closing
+import sys
+import threading
+import time
+from contextlib import contextmanager
 
 import psycopg2
+import psycopg2.extensions
+import psycopg2.extras
 from urllib.parse import urlparse
 
+from albumlist import metrics
+
 
 # urlparse.uses_netloc.append("postgres")
 
-class DatabaseError(Exception): 
+class DatabaseError(Exception):
+    pass
+
+
+def _query_name():
+    # the model function that ran the query, e.g. albums.get_albums
+    frame = sys._getframe(3)
+    while frame is not None:
+        module = frame.f_globals.get('__name__', '')
+        if module.startswith('albumlist.models.'):
+            return f'{module.rsplit(".", 1)[1]}.{frame.f_code.co_name}'
+        frame = frame.f_back
+    return 'other'
+
+
+class TimedCursorMixin:
+    """
+    Records how long each query takes in the albumlist_db_query_seconds
+    metric, labelled with the model function that ran it.
+    """
+
+    def _timed(self, method, *args):
+        query = _query_name()
+        started = time.monotonic()
+        try:
+            return method(*args)
+        except psycopg2.Error:
+            metrics.DB_ERRORS.inc(query)
+            raise
+        finally:
+            metrics.DB_QUERY.observe(time.monotonic() - started, query)
+
+    def execute(self, query, vars=None):
+        return self._timed(super().execute, query, vars)
+
+    def executemany(self, query, vars_list):
+        return self._timed(super().executemany, query, vars_list)
+
+    def copy_expert(self, sql, file, size=8192):
+        return self._timed(super().copy_expert, sql, file, size)
+
+
+class TimedCursor(TimedCursorMixin, psycopg2.extensions.cursor):
+    pass
+
+
+class TimedNamedTupleCursor(TimedCursorMixin, psycopg2.extras.NamedTupleCursor):
     pass
 
 
@@ -19,14 +72,211 @@ def get_connection():
             user=db_url.username,
             password=db_url.password,
             host=db_url.hostname,
-            port=db_url.port
+            port=db_url.port,
+            cursor_factory=TimedCursor,
         )
     except psycopg2.OperationalError as e:
         raise DatabaseError(e)
 
 
+class ConnectionPool:
+    """
+    Thread-safe pool of psycopg2 connections.
+
+    Connections are health checked on checkout if they have been idle for
+    longer than check_after seconds, and idle connections above minconn are
+    closed after max_idle seconds. The pool is discarded (without closing the
+    inherited sockets) when it is used from a forked child process.
+    """
+
+    def __init__(self, minconn=1, maxconn=10, timeout=30, check_after=30, max_idle=300):
+        if minconn < 0 or maxconn < 1 or minconn > maxconn:
+            raise ValueError(f'invalid pool size: min={minconn} max={maxconn}')
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.check_after = check_after
+        self.max_idle = max_idle
+        self._condition = threading.Condition()
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._idle = []  # (connection, returned_at), most recently returned last
+        self._in_use = set()
+        self._size = 0  # idle, in use and being opened or checked
+        self._stats = {
+            'checkouts': 0,
+            'created': 0,
+            'discarded': 0,
+            'failed_checks': 0,
+            'waits': 0,
+            'timeouts': 0,
+        }
+
+    def _check_fork(self):
+        if self._pid != os.getpid():
+            # closing inherited connections would terminate the parent's sessions
+            self._reset()
+
+    def _discard(self, conn):
+        self._size -= 1
+        self._stats['discarded'] += 1
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+    def _is_healthy(self, conn, returned_at):
+        if conn.closed:
+            return False
+        if time.monotonic() - returned_at < self.check_after:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute('SELECT 1;')
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _prune(self):
+        now = time.monotonic()
+        while self._idle and self._size > self.minconn:
+            conn, returned_at = self._idle[0]
+            if now - returned_at < self.max_idle:
+                break
+            self._idle.pop(0)
+            self._discard(conn)
+
+    def _reserve(self, deadline):
+        with self._condition:
+            self._check_fork()
+            self._prune()
+            while not self._idle and self._size >= self.maxconn:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._stats['timeouts'] += 1
+                    raise DatabaseError(f'connection pool exhausted ({self.maxconn} connections in use)')
+                self._stats['waits'] += 1
+                self._condition.wait(remaining)
+                self._check_fork()
+            if self._idle:
+                return self._idle.pop()
+            self._size += 1
+            return None, None
+
+    def getconn(self):
+        deadline = time.monotonic() + self.timeout
+        while True:
+            # network round trips happen outside the lock
+            conn, returned_at = self._reserve(deadline)
+            if conn is None:
+                try:
+                    conn = get_connection()
+                except DatabaseError:
+                    with self._condition:
+                        self._size -= 1
+                        self._condition.notify()
+                    raise
+                with self._condition:
+                    self._stats['created'] += 1
+                    return self._checkout(conn)
+            healthy = self._is_healthy(conn, returned_at)
+            with self._condition:
+                if healthy:
+                    return self._checkout(conn)
+                self._stats['failed_checks'] += 1
+                self._discard(conn)
+                self._condition.notify()
+
+    def _checkout(self, conn):
+        self._in_use.add(conn)
+        self._stats['checkouts'] += 1
+        return conn
+
+    def putconn(self, conn):
+        with self._condition:
+            if conn not in self._in_use:
+                # checked out before a fork, or already returned
+                return
+            self._in_use.discard(conn)
+            try:
+                if conn.closed:
+                    raise psycopg2.InterfaceError('connection already closed')
+                status = conn.get_transaction_status()
+                if status == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+                    raise psycopg2.InterfaceError('connection in unknown state')
+                if status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+                if conn.autocommit:
+                    conn.autocommit = False
+            except psycopg2.Error:
+                self._discard(conn)
+            else:
+                self._idle.append((conn, time.monotonic()))
+            self._condition.notify()
+
+    def closeall(self):
+        with self._condition:
+            self._check_fork()
+            while self._idle:
+                conn, _ = self._idle.pop()
+                self._discard(conn)
+
+    def stats(self):
+        with self._condition:
+            self._check_fork()
+            return dict(
+                self._stats,
+                min=self.minconn,
+                max=self.maxconn,
+                idle=len(self._idle),
+                in_use=len(self._in_use),
+                size=self._size,
+            )
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool(
+                    minconn=int(os.environ.get('DATABASE_POOL_MIN', 1)),
+                    maxconn=int(os.environ.get('DATABASE_POOL_MAX', 10)),
+                    timeout=float(os.environ.get('DATABASE_POOL_TIMEOUT', 30)),
+                    check_after=float(os.environ.get('DATABASE_POOL_CHECK_AFTER', 30)),
+                    max_idle=float(os.environ.get('DATABASE_POOL_MAX_IDLE', 300)),
+                )
+    return _pool
+
+
+def pool_stats():
+    return get_pool().stats()
+
+
+@contextmanager
+def connection():
+    """
+    Check a connection out of the pool for the duration of the block.
+
+    Anything left uncommitted is rolled back when the connection is returned.
+    """
+    pool = get_pool()
+    conn = pool.getconn()
+    try:
+        yield conn
+    finally:
+        pool.putconn(conn)
+
+
 def add_column(table, col, col_type):
-    with closing(get_connection()) as conn:
+    with connection() as conn:
         try:
             cur = conn.cursor()
             cur.execute(f'ALTER TABLE {table} ADD {col} {col_type}')
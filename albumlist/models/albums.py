@@ -1,15 +1,23 @@
 import json
-from contextlib import closing
 from datetime import datetime
 
 import psycopg2
-from psycopg2.extras import NamedTupleCursor
+from psycopg2.extras import execute_values
 
-from albumlist.models import DatabaseError, get_connection
-from albumlist.models.list import get_list
+from albumlist.models import DatabaseError, TimedNamedTupleCursor, connection, events
 
 
 class Album:
+    """
+    An album row. Slotted, since full-table queries build thousands of
+    these at once, and treated as read-only once built: to_dict() is
+    worked out on first use and then reused.
+    """
+
+    FIELDNAMES = ('added', 'album', 'artist', 'channel', 'id', 'img', 'released', 'reviews', 'tags', 'url', 'users')
+
+    __slots__ = ('album_id', 'album_artist', 'album_name', 'album_url', 'album_image', 'channel', 'available', 'added',
+                 'released', 'reviews', 'tags', 'users', '_dict')
 
     def __init__(self, id, name, artist, url, img, available, channel, added, released, tags_json=None, users_json=None, reviews_json=None):
         self.album_id = id
@@ -24,10 +32,20 @@ class Album:
         self.reviews = reviews_json
         self.tags = tags_json
         self.users = users_json
+        self._dict = None
+
+    def __getstate__(self):
+        return {name: getattr(self, name) for name in self.__slots__[:-1]}
+
+    def __setstate__(self, state):
+        # also takes the __dict__ of albums pickled before Album had slots
+        for name in self.__slots__[:-1]:
+            setattr(self, name, state.get(name))
+        self._dict = None
 
     @property
     def fieldnames(self):
-        return list(self.to_dict().keys())
+        return list(self.FIELDNAMES)
 
     @classmethod
     def from_dict(cls, d):
@@ -47,33 +65,52 @@ class Album:
         )
 
     def to_dict(self):
-        return {
-            'added': self.added.isoformat() or '',
-            'album': self.album_name or '',
-            'artist': self.album_artist or '',
-            'channel': self.channel or '',
-            'id': self.album_id or '',
-            'img': self.album_image or '',
-            'released': self.released or '',
-            'reviews': self.reviews if self.reviews else [],
-            'tags': self.tags if self.tags else [],
-            'url': self.album_url or '',
-            'users': self.users if self.users else [],
-        }
+        if self._dict is None:
+            self._dict = {
+                'added': self.added.isoformat() if self.added else '',
+                'album': self.album_name or '',
+                'artist': self.album_artist or '',
+                'channel': self.channel or '',
+                'id': self.album_id or '',
+                'img': self.album_image or '',
+                'released': self.released or '',
+                'reviews': self.reviews if self.reviews else [],
+                'tags': self.tags if self.tags else [],
+                'url': self.album_url or '',
+                'users': self.users if self.users else [],
+            }
+        return self._dict
+
+    @classmethod
+    def from_row(cls, row):
+        """
+        From a plain tuple of (id, name, artist, url, img, available,
+        channel, added, released), optionally followed by tags_json and
+        users_json.
+        """
+        return cls(*row)
+
+    @classmethod
+    def from_record(cls, record):
+        """
+        From a named tuple row, for queries selecting other extra columns.
+        """
+        return cls(**record._asdict())
 
     @classmethod
     def from_values(cls, values):
-        try:
-            return cls(**values._asdict())
-        except AttributeError:
-            return cls(*values) if values else None
+        if not values:
+            return None
+        return cls.from_record(values) if hasattr(values, '_fields') else cls.from_row(values)
 
     @classmethod
     def albums_from_values(cls, list_of_values):
         if not list_of_values:
             return
+        # every row of a query has the same shape, so pick the constructor once
+        make = cls.from_record if hasattr(list_of_values[0], '_fields') else cls.from_row
         for values in list_of_values:
-            yield cls.from_values(values)
+            yield make(values)
 
     @staticmethod
     def details_map_from_albums(albums):
@@ -89,7 +126,7 @@ class Album:
             artist=self.album_artist,
             name=self.album_name,
             url=self.album_url,
-            im=self.album_image,
+            img=self.album_image,
             channel=self.channel,
         )
 
@@ -110,7 +147,7 @@ def create_albums_table():
         users_json jsonb DEFAULT '[]',
         reviews_json jsonb DEFAULT '[]'
         );"""
-    with closing(get_connection()) as conn:
+    with connection() as conn:
         try:
             cur = conn.cursor()
             cur.execute(sql)
@@ -125,7 +162,7 @@ def create_albums_index():
         ON albums (
         LOWER(name)
         );"""
-    with closing(get_connection()) as conn:
+    with connection() as conn:
         try:
             cur = conn.cursor()
             cur.execute(sql)
@@ -139,7 +176,7 @@ def get_albums():
         SELECT id, name, artist, url, img, available, channel, added, released
         FROM albums
     """
-    with closing(get_connection()) as conn:
+    with connection() as conn:
         try:
             cur = conn.cursor()
             cur.execute(sql)
@@ -153,7 +190,7 @@ def get_albums_with_tags():
         SELECT id, name, artist, url, img, available, channel, added, released, tags_json
         FROM albums
     """
-    with closing(get_connection()) as conn:
+    with connection() as conn:
         try:
             cur = conn.cursor()
             cur.execute(sql)
@@ -162,12 +199,44 @@ def get_albums_with_tags():
             raise DatabaseError(e)
 
 
+def get_albums_details_json(channel=None):
+    """
+    The albums with tags, optionally only those from a channel, as the JSON
+    text of a list of {id: details} objects (see Album.to_dict) built by the
+    database, so full-table responses don't go through Album at all.
+    """
+    sql = f"""
+        SELECT COALESCE(json_agg(json_build_object(id, json_build_object(
+            'added', COALESCE(to_char(added, 'YYYY-MM-DD"T"HH24:MI:SS.US'), ''),
+            'album', COALESCE(name, ''),
+            'artist', COALESCE(artist, ''),
+            'channel', COALESCE(channel, ''),
+            'id', id,
+            'img', COALESCE(img, ''),
+            'released', COALESCE(released, ''),
+            'reviews', '[]'::json,
+            'tags', COALESCE(tags_json, '[]'::jsonb),
+            'url', COALESCE(url, ''),
+            'users', '[]'::json
+        ))), '[]')::text
+        FROM albums
+        {'WHERE channel = %s' if channel is not None else ''};
+    """
+    with connection() as conn:
+        try:
+            cur = conn.cursor()
+            cur.execute(sql, (channel, ) if channel is not None else None)
+            return cur.fetchone()[0]
+        except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
+            raise DatabaseError(e)
+
+
 def get_albums_with_users():
     sql = """
         SELECT id, name, artist, url, img, available, channel, added, released, tags_json, users_json
         FROM albums
     """
-    with closing(get_connection()) as conn:
+    with connection() as conn:
         try:
             cur = conn.cursor()
             cur.execute(sql)
@@ -176,13 +245,33 @@ def get_albums_with_users():
             raise DatabaseError(e)
 
 
+def iter_albums_with_users(chunk_size=1000):
+    """
+    Stream every album through a server-side cursor, fetching chunk_size
+    rows at a time, so memory use stays flat however big the table is.
+    """
+    sql = """
+        SELECT id, name, artist, url, img, available, channel, added, released, tags_json, users_json
+        FROM albums
+    """
+    with connection() as conn:
+        try:
+            cur = conn.cursor(name='iter_albums_with_users')
+            cur.itersize = chunk_size
+            cur.execute(sql)
+            for values in cur:
+                yield Album.from_row(values)
+        except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
+            raise DatabaseError(e)
+
+
 def get_albums_by_channel_with_tags(channel):
     sql = """
         SELECT id, name, artist, url, img, available, channel, added, released, tags_json
         FROM albums
         WHERE channel = %s;
     """
-    with closing(get_connection()) as conn:
+    with connection() as conn:
         try:
             cur = conn.cursor()
             cur.execute(sql, (channel,))
@@ -191,13 +280,57 @@ def get_albums_by_channel_with_tags(channel):
             raise DatabaseError(e)
 
 
+def get_albums_page(after=None, limit=100, year=None, mode='added', channel=None, tag=None, available=None):
+    """
+    Albums with tags in (added, id) order, filtered by the year they were
+    added or released (mode), channel, tag and availability. after is the
+    (added, id) of the last album of the previous page. Albums without an
+    added date can't be paged by it, so are left out.
+    """
+    conditions, params = ['added IS NOT NULL'], []
+    if year is not None:
+        if mode == 'released':
+            # released dates are scraped as YYYYMMDD
+            conditions.append('released LIKE %s')
+            params.append(f'{year:04d}%')
+        else:
+            conditions.append('added >= %s AND added < %s')
+            params.extend([datetime(year, 1, 1), datetime(year + 1, 1, 1)])
+    if channel is not None:
+        conditions.append('channel = %s')
+        params.append(channel)
+    if tag is not None:
+        conditions.append('tags_json @> %s')
+        params.append(json.dumps([tag.lower()]))
+    if available is not None:
+        conditions.append('available = %s')
+        params.append(bool(available))
+    if after is not None:
+        conditions.append('(added, id) > (%s, %s)')
+        params.extend(after)
+    sql = f"""
+        SELECT id, name, artist, url, img, available, channel, added, released, tags_json
+        FROM albums
+        WHERE {' AND '.join(conditions)}
+        ORDER BY added, id
+        LIMIT %s;
+    """
+    with connection() as conn:
+        try:
+            cur = conn.cursor()
+            cur.execute(sql, params + [limit])
+            return list(Album.albums_from_values(cur.fetchall()) or [])
+        except (psycopg2.ProgrammingError, psycopg2.InternalError, psycopg2.DataError) as e:
+            raise DatabaseError(e)
+
+
 def get_albums_available():
     sql = """
         SELECT id, name, artist, url, img, available, channel, added, released
         FROM albums
         WHERE available = true;
     """
-    with closing(get_connection()) as conn:
+    with connection() as conn:
         try:
             cur = conn.cursor()
             cur.execute(sql)
@@ -212,7 +345,7 @@ def get_albums_unavailable():
         FROM albums 
         WHERE available = false;
     """
-    with closing(get_connection()) as conn:
+    with connection() as conn:
         try:
             cur = conn.cursor()
             cur.execute(sql)
@@ -227,7 +360,7 @@ def get_albums_without_covers():
         FROM albums
         WHERE img = '';
     """
-    with closing(get_connection()) as conn:
+    with connection() as conn:
         try:
             cur = conn.cursor()
             cur.execute(sql)
@@ -237,11 +370,11 @@ def get_albums_without_covers():
 
 
 def get_albums_count():
-    with closing(get_connection()) as conn:
+    with connection() as conn:
         try:
             cur = conn.cursor()
-            cur.execute('SELECT id FROM albums;')
-            return cur.rowcount
+            cur.execute('SELECT COUNT(*) FROM albums;')
+            return cur.fetchone()[0]
         except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
             raise DatabaseError(e)
 
@@ -254,7 +387,7 @@ def find_album_artist_duplicates():
         WHERE a2.duplicates > 1
         ORDER BY a1.artist, a1.name
     """
-    with closing(get_connection()) as conn:
+    with connection() as conn:
         try:
             cur = conn.cursor()
             cur.execute(sql)
@@ -264,11 +397,11 @@ def find_album_artist_duplicates():
 
 
 def get_albums_unavailable_count():
-    with closing(get_connection()) as conn:
+    with connection() as conn:
         try:
             cur = conn.cursor()
-            cur.execute('SELECT id FROM albums WHERE available = false;')
-            return cur.rowcount
+            cur.execute('SELECT COUNT(*) FROM albums WHERE available = false;')
+            return cur.fetchone()[0]
         except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
             raise DatabaseError(e)
 
@@ -279,7 +412,7 @@ def get_album_details(album_id):
         FROM albums
         WHERE id = %s;
         """
-    with closing(get_connection()) as conn:
+    with connection() as conn:
         try:
             cur = conn.cursor()
             cur.execute(sql, (album_id, ))
@@ -294,7 +427,7 @@ def get_album_details_by_url(album_url):
         FROM albums
         WHERE url = %s;
         """
-    with closing(get_connection()) as conn:
+    with connection() as conn:
         try:
             cur = conn.cursor()
             cur.execute(sql, (album_url, ))
@@ -309,7 +442,7 @@ def get_album_details_with_tags(album_id):
         FROM albums
         WHERE id = %s;
         """
-    with closing(get_connection()) as conn:
+    with connection() as conn:
         try:
             cur = conn.cursor()
             cur.execute(sql, (album_id, ))
@@ -320,11 +453,11 @@ def get_album_details_with_tags(album_id):
 
 def get_album_details_from_ids(album_ids):
     sql = """
-        SELECT id, artist, name, url, img, available, channel, added, released
+        SELECT id, name, artist, url, img, available, channel, added, released
         FROM albums 
         WHERE id IN %s;
         """
-    with closing(get_connection()) as conn:        
+    with connection() as conn:        
         try:
             cur = conn.cursor()
             cur.execute(sql, (album_ids, ))
@@ -339,7 +472,7 @@ def get_albums_by_channel(channel):
         FROM albums
         WHERE channel = %s
     """
-    with closing(get_connection()) as conn:
+    with connection() as conn:
         try:
             cur = conn.cursor()
             cur.execute(sql, (channel,))
@@ -349,7 +482,7 @@ def get_albums_by_channel(channel):
 
 
 def set_album_users(album_id, users):
-    with closing(get_connection()) as conn:
+    with connection() as conn:
         try:
             sql = """
                 UPDATE albums
@@ -361,25 +494,30 @@ def set_album_users(album_id, users):
             conn.commit()
         except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
             raise DatabaseError(e)
+    events.publish(events.ALBUMS_UPDATED, [album_id], {'users': users})
 
 
 def add_user_to_album(album_id, user):
-    with closing(get_connection()) as conn:
+    with connection() as conn:
         try:
             sql = """
                 UPDATE albums
                 SET users_json = users_json || %s
-                WHERE id = %s AND NOT users_json ? %s;
+                WHERE id = %s AND NOT users_json ? %s
+                RETURNING id;
                 """
             cur = conn.cursor()
             cur.execute(sql, (json.dumps([user]), album_id, user))
+            changed = cur.fetchone() is not None
             conn.commit()
         except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
             raise DatabaseError(e)
+    if changed:
+        events.publish(events.ALBUMS_UPDATED, [album_id], {'users': None})
 
 
 def remove_user_from_album(album_id, user):
-    with closing(get_connection()) as conn:
+    with connection() as conn:
         try:
             sql = """
                 UPDATE albums
@@ -391,45 +529,77 @@ def remove_user_from_album(album_id, user):
             conn.commit()
         except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
             raise DatabaseError(e)
+    events.publish(events.ALBUMS_UPDATED, [album_id], {'users': None})
 
 
 def remove_user_from_all_albums(user):
-    with closing(get_connection()) as conn:
+    with connection() as conn:
         try:
             sql = """
                 UPDATE albums
                 SET users_json = users_json - %s
-                WHERE users_json ? %s;
+                WHERE users_json ? %s
+                RETURNING id;
                 """
             cur = conn.cursor()
             cur.execute(sql, (user, user))
+            album_ids = [item[0] for item in cur.fetchall()]
             conn.commit()
         except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
             raise DatabaseError(e)
+    if album_ids:
+        events.publish(events.ALBUMS_UPDATED, album_ids, {'users': None})
 
 
 def reset_users():
-    with closing(get_connection()) as conn:
+    with connection() as conn:
         try:
             cur = conn.cursor()
-            cur.execute("UPDATE albums SET users_json = '[]';")
+            cur.execute("UPDATE albums SET users_json = '[]' WHERE users_json <> '[]' RETURNING id;")
+            album_ids = [item[0] for item in cur.fetchall()]
             conn.commit()
         except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
             raise DatabaseError(e)
+    if album_ids:
+        events.publish(events.ALBUMS_UPDATED, album_ids, {'users': []})
 
 
-def get_albums_by_user(user):
-    sql = """
+def get_albums_by_user(user, after=None, limit=None):
+    """
+    Available albums in a user's list in id order, at most limit of them
+    and starting after the album id after.
+    """
+    sql = f"""
         SELECT id, name, artist, url, img, available, channel, added, released, tags_json
         FROM albums
         WHERE users_json ? %s
+        AND available = true
+        {'AND id > %s' if after is not None else ''}
+        ORDER BY id
+        LIMIT %s;
+        """
+    params = [user] + ([after] if after is not None else []) + [limit]
+    with connection() as conn:
+        try:
+            cur = conn.cursor()
+            cur.execute(sql, params)
+            return Album.albums_from_values(cur.fetchall())
+        except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
+            raise DatabaseError(e)
+
+
+def get_albums_by_user_count(user):
+    sql = """
+        SELECT COUNT(*)
+        FROM albums
+        WHERE users_json ? %s
         AND available = true;
         """
-    with closing(get_connection()) as conn:
+    with connection() as conn:
         try:
             cur = conn.cursor()
             cur.execute(sql, (user, ))
-            return Album.albums_from_values(cur.fetchall())
+            return cur.fetchone()[0]
         except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
             raise DatabaseError(e)
 
@@ -440,7 +610,7 @@ def get_album_details_with_users(album_id):
         FROM albums
         WHERE id = %s;
         """
-    with closing(get_connection()) as conn:
+    with connection() as conn:
         try:
             cur = conn.cursor()
             cur.execute(sql, (album_id, ))
@@ -450,7 +620,7 @@ def get_album_details_with_users(album_id):
 
 
 def add_user_review_to_album(album_id, user, review):
-    with closing(get_connection()) as conn:
+    with connection() as conn:
         try:
             sql = """
                 UPDATE albums
@@ -462,10 +632,11 @@ def add_user_review_to_album(album_id, user, review):
             conn.commit()
         except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
             raise DatabaseError(e)
+    events.publish(events.ALBUMS_UPDATED, [album_id], {'reviews': None})
 
 
 def remove_user_review_from_album(album_id, array_element):
-    with closing(get_connection()) as conn:
+    with connection() as conn:
         try:
             sql = """
                 UPDATE albums
@@ -477,6 +648,7 @@ def remove_user_review_from_album(album_id, array_element):
             conn.commit()
         except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
             raise DatabaseError(e)
+    events.publish(events.ALBUMS_UPDATED, [album_id], {'reviews': None})
 
 def get_album_details_with_reviews(album_id):
     sql = """
@@ -484,9 +656,9 @@ def get_album_details_with_reviews(album_id):
         FROM albums
         WHERE id = %s;
         """
-    with closing(get_connection()) as conn:
+    with connection() as conn:
         try:
-            cur = conn.cursor(cursor_factory=NamedTupleCursor)
+            cur = conn.cursor(cursor_factory=TimedNamedTupleCursor)
             cur.execute(sql, (album_id, ))
             return Album.from_values(cur.fetchone())
         except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
@@ -503,19 +675,30 @@ def add_to_albums(album_id, artist, name, url, img='', channel=''):
         img,
         channel,
         available
-        ) VALUES (%s, %s, %s, %s, %s, %s, %s);"""
-    with closing(get_connection()) as conn:
+        ) VALUES (%s, %s, %s, %s, %s, %s, %s)
+        ON CONFLICT (id) DO NOTHING
+        RETURNING id, channel, added;"""
+    with connection() as conn:
         try:
             cur = conn.cursor()
             cur.execute(sql, (album_id, artist, name, url, img, channel, True))
+            inserted = cur.fetchone()
             conn.commit()
-        except psycopg2.IntegrityError:
-            raise DatabaseError(f'album {album_id} already exists')
         except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
             raise DatabaseError(e)
+    if inserted is None:
+        raise DatabaseError(f'album {album_id} already exists')
+    events.publish(events.ALBUMS_ADDED, [inserted])
 
 
 def add_many_to_albums(albums):
+    """
+    Add (id, artist, name, url, img) rows in one statement, skipping albums
+    that already exist, and return the ids that were added.
+    """
+    albums = list(albums)
+    if not albums:
+        return []
     sql = """
         INSERT INTO albums (
         id, 
@@ -523,18 +706,25 @@ def add_many_to_albums(albums):
         name, 
         url, 
         img
-        ) VALUES (%s, %s, %s, %s, %s);"""
-    with closing(get_connection()) as conn:
+        ) VALUES %s
+        ON CONFLICT (id) DO NOTHING
+        RETURNING id, channel, added"""
+    with connection() as conn:
         try:
             cur = conn.cursor()
-            cur.executemany(sql, albums)
+            # one page so that RETURNING covers every row
+            execute_values(cur, sql, albums, page_size=len(albums))
+            added = cur.fetchall()
             conn.commit()
         except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
             raise DatabaseError(e)
+    if added:
+        events.publish(events.ALBUMS_ADDED, added)
+    return [item[0] for item in added]
 
 
 def add_img_to_album(album_id, album_img):
-    with closing(get_connection()) as conn:
+    with connection() as conn:
         try:
             sql = """
                 UPDATE albums
@@ -546,10 +736,11 @@ def add_img_to_album(album_id, album_img):
             conn.commit()
         except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
             raise DatabaseError(e)
+    events.publish(events.ALBUMS_UPDATED, [album_id], {'img': album_img})
 
 
 def update_album_url(album_id, album_url):
-    with closing(get_connection()) as conn:
+    with connection() as conn:
         try:
             sql = """
                 UPDATE albums
@@ -561,10 +752,11 @@ def update_album_url(album_id, album_url):
             conn.commit()
         except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
             raise DatabaseError(e)
+    events.publish(events.ALBUMS_UPDATED, [album_id], {'url': album_url})
 
 
 def add_added_to_album(album_id, dt):
-    with closing(get_connection()) as conn:
+    with connection() as conn:
         try:
             sql = """
                 UPDATE albums
@@ -576,10 +768,11 @@ def add_added_to_album(album_id, dt):
             conn.commit()
         except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
             raise DatabaseError(e)
+    events.publish(events.ALBUMS_UPDATED, [album_id], {'added': dt})
 
 
 def add_released_to_album(album_id, date):
-    with closing(get_connection()) as conn:
+    with connection() as conn:
         try:
             sql = """
                 UPDATE albums
@@ -591,25 +784,67 @@ def add_released_to_album(album_id, date):
             conn.commit()
         except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
             raise DatabaseError(e)
+    events.publish(events.ALBUMS_UPDATED, [album_id], {'released': date})
+
+
+def update_album_page_details(details):
+    """
+    Write back cover, tags and release date scraped from album pages in a
+    single UPDATE. Takes (album_id, img, tags, released) tuples, where None
+    leaves the existing value in place.
+    """
+    sql = """
+        UPDATE albums
+        SET img = COALESCE(v.img, albums.img),
+        tags_json = COALESCE(v.tags::jsonb, albums.tags_json),
+        released = COALESCE(v.released, albums.released)
+        FROM (VALUES %s) AS v (id, img, tags, released)
+        WHERE albums.id = v.id;
+        """
+    values = [
+        (album_id, img, json.dumps(tags) if tags is not None else None, released)
+        for album_id, img, tags, released in details
+    ]
+    if not values:
+        return
+    with connection() as conn:
+        try:
+            cur = conn.cursor()
+            execute_values(cur, sql, values, template='(%s, %s, %s, %s)')
+            conn.commit()
+        except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
+            raise DatabaseError(e)
+    changes = {
+        field: None
+        for i, field in enumerate(('img', 'tags', 'released'), 1)
+        if any(value[i] is not None for value in values)
+    }
+    if changes:
+        tags = {tag for _, _, album_tags, _ in details for tag in album_tags or []}
+        events.publish(events.ALBUMS_UPDATED, [value[0] for value in values], changes, tags)
 
 
 def update_album_availability(album_id, status):
-    with closing(get_connection()) as conn:
+    with connection() as conn:
         try:
             sql = """
                 UPDATE albums
                 SET available = %s
-                WHERE id = %s;
+                WHERE id = %s AND available IS DISTINCT FROM %s
+                RETURNING tags_json;
                 """
             cur = conn.cursor()
-            cur.execute(sql, (bool(status), album_id))
+            cur.execute(sql, (bool(status), album_id, bool(status)))
+            changed = cur.fetchone()
             conn.commit()
         except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
             raise DatabaseError(e)
+    if changed is not None:
+        events.publish(events.ALBUMS_UPDATED, [album_id], {'available': bool(status)}, changed[0] or [])
 
 
 def update_album_added(album_id, added):
-    with closing(get_connection()) as conn:
+    with connection() as conn:
         try:
             sql = """
                 UPDATE albums
@@ -621,10 +856,11 @@ def update_album_added(album_id, added):
             conn.commit()
         except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
             raise DatabaseError(e)
+    events.publish(events.ALBUMS_UPDATED, [album_id], {'added': added})
 
 
 def set_album_tags(album_id, tags):
-    with closing(get_connection()) as conn:
+    with connection() as conn:
         try:
             sql = """
                 UPDATE albums
@@ -636,10 +872,12 @@ def set_album_tags(album_id, tags):
             conn.commit()
         except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
             raise DatabaseError(e)
+    # caches of the tags it had depend on the album itself
+    events.publish(events.ALBUMS_UPDATED, [album_id], {'tags': None}, tags)
 
 
 def add_tag_to_album(album_id, tag):
-    with closing(get_connection()) as conn:
+    with connection() as conn:
         try:
             sql = """
                 UPDATE albums
@@ -651,10 +889,11 @@ def add_tag_to_album(album_id, tag):
             conn.commit()
         except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
             raise DatabaseError(e)
+    events.publish(events.ALBUMS_UPDATED, [album_id], {'tags': None}, [tag.lower()])
 
 
 def remove_tag_from_album(album_id, tag):
-    with closing(get_connection()) as conn:
+    with connection() as conn:
         try:
             sql = """
                 UPDATE albums
@@ -666,10 +905,11 @@ def remove_tag_from_album(album_id, tag):
             conn.commit()
         except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
             raise DatabaseError(e)
+    events.publish(events.ALBUMS_UPDATED, [album_id], {'tags': None}, [tag])
 
 
 def get_album_ids():
-    with closing(get_connection()) as conn:
+    with connection() as conn:
         try:
             cur = conn.cursor()
             cur.execute('SELECT id FROM albums;')
@@ -678,19 +918,62 @@ def get_album_ids():
             raise DatabaseError(e)
 
 
-def get_random_album():
+def get_random_album(sample_percent=5):
+    """
+    Pick a random available album from a TABLESAMPLE of the table's pages,
+    only sorting the whole table if the sample has no available albums.
+    """
     sql = """
         SELECT id, name, artist, url, img, available, channel, added, released, tags_json, reviews_json
-        FROM albums 
+        FROM albums {sample}
         WHERE available = true
         ORDER BY RANDOM() 
         LIMIT 1;
         """
-    with closing(get_connection()) as conn:
+    with connection() as conn:
         try:
-            cur = conn.cursor(cursor_factory=NamedTupleCursor)
+            cur = conn.cursor(cursor_factory=TimedNamedTupleCursor)
+            cur.execute(sql.format(sample='TABLESAMPLE SYSTEM (%s)'), (sample_percent, ))
+            values = cur.fetchone()
+            if values is None:
+                cur.execute(sql.format(sample=''))
+                values = cur.fetchone()
+            return Album.from_values(values)
+        except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
+            raise DatabaseError(e)
+
+
+def get_available_album_weights():
+    """
+    Ids of available albums with a weight that favours albums users have
+    added to their lists or reviewed.
+    """
+    sql = """
+        SELECT id, 1 + COALESCE(jsonb_array_length(users_json), 0) + COALESCE(jsonb_array_length(reviews_json), 0)
+        FROM albums
+        WHERE available = true;
+        """
+    with connection() as conn:
+        try:
+            cur = conn.cursor()
             cur.execute(sql)
-            return Album.from_values(cur.fetchone())
+            return cur.fetchall()
+        except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
+            raise DatabaseError(e)
+
+
+def get_available_album_ids_by_tag(tag):
+    sql = """
+        SELECT id
+        FROM albums
+        WHERE tags_json ? %s
+        AND available = true;
+        """
+    with connection() as conn:
+        try:
+            cur = conn.cursor()
+            cur.execute(sql, (tag, ))
+            return [c[0] for c in cur.fetchall()]
         except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
             raise DatabaseError(e)
 
@@ -702,7 +985,7 @@ def get_albums_by_tag(tag):
         WHERE tags_json ? %s
         AND available = true;
         """
-    with closing(get_connection()) as conn:
+    with connection() as conn:
         try:
             cur = conn.cursor()
             cur.execute(sql, (tag, ))
@@ -711,76 +994,238 @@ def get_albums_by_tag(tag):
             raise DatabaseError(e)
 
 
-def search_albums(query):
-    sql = """
-        SELECT id, name, artist, url, img, available, channel, added, released, tags_json, reviews_json
+SEARCH_ALBUMS_FILTER = """
         FROM albums
-        WHERE LOWER(name) LIKE %s 
-        OR LOWER(artist) LIKE %s
-        OR tags_json ? %s
-        AND available = true;
+        WHERE available = true
+        AND (
+            LOWER(name) LIKE %(term)s
+            OR LOWER(artist) LIKE %(term)s
+            OR tags_json ? %(query)s
+            OR to_tsvector('simple', COALESCE(name, '') || ' ' || COALESCE(artist, ''))
+            @@ plainto_tsquery('simple', %(query)s)
+        )
         """
-    with closing(get_connection()) as conn:
+
+
+SIMILARITY_RANK = """
+        GREATEST(similarity(LOWER(name), %(query)s), similarity(LOWER(artist), %(query)s))
+        """
+
+# without pg_trgm, exact then partial matches of names and artists rank first
+MATCH_RANK = """
+        CASE
+        WHEN LOWER(name) = %(query)s OR LOWER(artist) = %(query)s THEN 1
+        WHEN LOWER(name) LIKE %(term)s OR LOWER(artist) LIKE %(term)s THEN 0.5
+        ELSE 0
+        END
+        """
+
+_has_pg_trgm = False
+
+
+def has_pg_trgm():
+    """
+    Whether the pg_trgm extension from the first migration is installed yet.
+    """
+    global _has_pg_trgm
+    if not _has_pg_trgm:
+        with connection() as conn:
+            try:
+                cur = conn.cursor()
+                cur.execute("SELECT EXISTS (SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm');")
+                _has_pg_trgm = cur.fetchone()[0]
+            except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
+                raise DatabaseError(e)
+    return _has_pg_trgm
+
+
+def search_albums(query, limit=None, offset=0):
+    """
+    Ranked search over album names, artists and tags, optionally just the
+    limit albums from offset. The LIKE, ? and @@ filters are served by the
+    alb_trgm_*, alb_tags_json and alb_fts indexes (see
+    albumlist.models.migrations). Until migrations have installed pg_trgm,
+    names and artists are ranked without similarity().
+    """
+    sql = f"""
+        SELECT id, name, artist, url, img, available, channel, added, released, tags_json, reviews_json
+        {SEARCH_ALBUMS_FILTER}
+        ORDER BY
+        {SIMILARITY_RANK if has_pg_trgm() else MATCH_RANK}
+        + ts_rank(
+            to_tsvector('simple', COALESCE(name, '') || ' ' || COALESCE(artist, '')),
+            plainto_tsquery('simple', %(query)s)
+        )
+        + CASE WHEN tags_json ? %(query)s THEN 0.5 ELSE 0 END DESC,
+        LOWER(artist), LOWER(name), id
+        LIMIT %(limit)s OFFSET %(offset)s;
+        """
+    with connection() as conn:
         try:
-            cur = conn.cursor(cursor_factory=NamedTupleCursor)
-            term = f'%{query}%'
-            cur.execute(sql, (term, term, query))
+            cur = conn.cursor(cursor_factory=TimedNamedTupleCursor)
+            cur.execute(sql, {'term': f'%{query}%', 'query': query, 'limit': limit, 'offset': offset})
             return Album.albums_from_values(cur.fetchall())
         except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
             raise DatabaseError(e)
 
 
-def search_albums_by_tag(query):
+def search_albums_count(query):
+    sql = f"""
+        SELECT COUNT(*)
+        {SEARCH_ALBUMS_FILTER};
+        """
+    with connection() as conn:
+        try:
+            cur = conn.cursor()
+            cur.execute(sql, {'term': f'%{query}%', 'query': query})
+            return cur.fetchone()[0]
+        except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
+            raise DatabaseError(e)
+
+
+def get_search_documents(added_since=None, album_ids=None):
+    sql = """
+        SELECT id, name, artist, tags_json, added
+        FROM albums
+        WHERE available = true
+        """
+    params = ()
+    if added_since is not None:
+        sql += ' AND added >= %s'
+        params += (added_since, )
+    if album_ids is not None:
+        sql += ' AND id = ANY(%s)'
+        params += (list(album_ids), )
+    with connection() as conn:
+        try:
+            cur = conn.cursor()
+            cur.execute(sql, params)
+            return cur.fetchall()
+        except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
+            raise DatabaseError(e)
+
+
+def get_album_details_with_tags_from_ids(album_ids):
+    """
+    Album details for the given ids, in the order the ids were given.
+    """
+    if not album_ids:
+        return []
     sql = """
+        SELECT id, name, artist, url, img, available, channel, added, released, tags_json, reviews_json
+        FROM albums
+        WHERE id = ANY(%s);
+        """
+    with connection() as conn:
+        try:
+            cur = conn.cursor(cursor_factory=TimedNamedTupleCursor)
+            cur.execute(sql, (list(album_ids), ))
+            albums = {album.album_id: album for album in Album.albums_from_values(cur.fetchall())}
+            return [albums[album_id] for album_id in album_ids if album_id in albums]
+        except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
+            raise DatabaseError(e)
+
+
+def search_albums_by_tag(query, after=None, limit=None):
+    """
+    Available albums tagged query in id order, at most limit of them and
+    starting after the album id after.
+    """
+    sql = f"""
         SELECT id, name, artist, url, img, available, channel, added, released, tags_json, reviews_json
         FROM albums 
         WHERE tags_json ? %s
-        AND available = true;
+        AND available = true
+        {'AND id > %s' if after is not None else ''}
+        ORDER BY id
+        LIMIT %s;
         """
-    with closing(get_connection()) as conn:
+    params = [query] + ([after] if after is not None else []) + [limit]
+    with connection() as conn:
         try:
-            cur = conn.cursor(cursor_factory=NamedTupleCursor)
+            cur = conn.cursor(cursor_factory=TimedNamedTupleCursor)
             # term = f'%{query}%' TODO
-            cur.execute(sql, (query, ))
+            cur.execute(sql, params)
             return Album.albums_from_values(cur.fetchall())
         except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
             raise DatabaseError(e)
 
 
+def search_albums_by_tag_count(query):
+    sql = """
+        SELECT COUNT(*)
+        FROM albums
+        WHERE tags_json ? %s
+        AND available = true;
+        """
+    with connection() as conn:
+        try:
+            cur = conn.cursor()
+            cur.execute(sql, (query, ))
+            return cur.fetchone()[0]
+        except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
+            raise DatabaseError(e)
+
+
 def _reset_albums():
-    with closing(get_connection()) as conn:
+    with connection() as conn:
         try:
             cur = conn.cursor()
             cur.execute('DELETE FROM albums')
             conn.commit()
         except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
             raise DatabaseError(e)
+    events.publish(events.ALBUMS_RESET)
+
+
+DELETE_ALBUM_SQL = """
+    DELETE FROM albums WHERE id = %s
+    RETURNING id, channel, added, available, released, tags_json;
+    """
 
 
 def delete_from_albums(album_id):
-    with closing(get_connection()) as conn:
+    with connection() as conn:
         try:
             cur = conn.cursor()
-            cur.execute('DELETE FROM albums where id = %s;', (album_id,))
+            cur.execute(DELETE_ALBUM_SQL, (album_id,))
+            deleted = cur.fetchall()
             conn.commit()
         except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
             raise DatabaseError(e)
+    if deleted:
+        events.publish(events.ALBUMS_DELETED, deleted)
 
 
 def delete_from_list_and_albums(album_id):
-    with closing(get_connection()) as conn:
+    with connection() as conn:
         try:
             cur = conn.cursor()
-            cur.execute('DELETE FROM albums where id = %s;', (album_id,))
-            cur.execute('DELETE FROM list where album = %s;', (album_id,))
+            cur.execute(DELETE_ALBUM_SQL, (album_id,))
+            deleted = cur.fetchall()
+            cur.execute('DELETE FROM list where album = %s RETURNING album;', (album_id,))
+            removed = [item[0] for item in cur.fetchall()]
             conn.commit()
         except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
             raise DatabaseError(e)
+    if deleted:
+        events.publish(events.ALBUMS_DELETED, deleted)
+    if removed:
+        events.publish(events.LIST_DELETED, removed)
 
 
 def check_for_new_albums():
-    return [
-        str(album_id)
-        for album_id in set(get_list()).difference(set(get_album_ids()))
-        if album_id is not None
-    ]
+    """
+    Ids in the list that have no album details yet.
+    """
+    with connection() as conn:
+        try:
+            cur = conn.cursor()
+            cur.execute("""
+                SELECT DISTINCT list.album FROM list
+                WHERE list.album IS NOT NULL
+                AND NOT EXISTS (SELECT 1 FROM albums WHERE albums.id = list.album);
+                """)
+            return [str(item[0]) for item in cur.fetchall()]
+        except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
+            raise DatabaseError(e)
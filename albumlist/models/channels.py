@@ -0,0 +1,44 @@
+import psycopg2
+
+from albumlist.models import DatabaseError, connection
+
+
+def get_channel_cursor(channel_id):
+    """
+    Timestamp of the newest message already scraped from a channel, or None.
+    """
+    with connection() as conn:
+        try:
+            cur = conn.cursor()
+            cur.execute('SELECT latest_ts FROM channel_cursors WHERE channel = %s;', (channel_id, ))
+            row = cur.fetchone()
+            return str(row[0]) if row and row[0] is not None else None
+        except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
+            raise DatabaseError(e)
+
+
+def set_channel_cursor(channel_id, latest_ts):
+    sql = """
+        INSERT INTO channel_cursors (channel, latest_ts, scraped)
+        VALUES (%s, %s, now())
+        ON CONFLICT (channel) DO UPDATE
+        SET latest_ts = GREATEST(channel_cursors.latest_ts, EXCLUDED.latest_ts),
+        scraped = now();
+        """
+    with connection() as conn:
+        try:
+            cur = conn.cursor()
+            cur.execute(sql, (channel_id, latest_ts))
+            conn.commit()
+        except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
+            raise DatabaseError(e)
+
+
+def reset_channel_cursor(channel_id):
+    with connection() as conn:
+        try:
+            cur = conn.cursor()
+            cur.execute('DELETE FROM channel_cursors WHERE channel = %s;', (channel_id, ))
+            conn.commit()
+        except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
+            raise DatabaseError(e)
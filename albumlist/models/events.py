@@ -0,0 +1,39 @@
+import collections
+
+
+# album ids added to or deleted from the list, or the list emptied
+LIST_ADDED = 'list_added'
+LIST_DELETED = 'list_deleted'
+LIST_RESET = 'list_reset'
+# (id, channel, added) rows of new albums
+ALBUMS_ADDED = 'albums_added'
+# album ids, {field: new value, or None if it differs between them} and the
+# tags whose albums changed: tags added or removed, or the tags of albums whose
+# availability changed
+ALBUMS_UPDATED = 'albums_updated'
+# (id, channel, added, available, released, tags) rows of deleted albums
+ALBUMS_DELETED = 'albums_deleted'
+# the albums table was emptied or bulk loaded, so anything derived from it is stale
+ALBUMS_RESET = 'albums_reset'
+
+_handlers = collections.defaultdict(list)
+
+
+def subscribe(event, handler):
+    """
+    Call handler(*args) whenever event is published in this process.
+    """
+    if handler not in _handlers[event]:
+        _handlers[event].append(handler)
+
+
+def publish(event, *args):
+    """
+    Call the handlers for an event once the change has been committed. A
+    failing handler is logged rather than failing the write.
+    """
+    for handler in list(_handlers[event]):
+        try:
+            handler(*args)
+        except Exception as e:
+            print(f'[db]: {event} handler {handler.__name__} failed: {e}')
@@ -1,13 +1,11 @@
-import collections
-from contextlib import closing
-
 import psycopg2
+from psycopg2.extras import execute_values
 
-from albumlist.models import DatabaseError, get_connection
+from albumlist.models import DatabaseError, connection, events
 
 
 def create_list_table():
-    with closing(get_connection()) as conn:
+    with connection() as conn:
         try:
             cur = conn.cursor()
             cur.execute('CREATE TABLE IF NOT EXISTS list (id serial PRIMARY KEY, album varchar);')
@@ -17,7 +15,7 @@ def create_list_table():
 
 
 def get_list():
-    with closing(get_connection()) as conn:
+    with connection() as conn:
         try:
             cur = conn.cursor()
             cur.execute('SELECT album FROM list;')
@@ -27,80 +25,118 @@ def get_list():
 
 
 def get_list_count():
-    with closing(get_connection()) as conn:
+    with connection() as conn:
         try:
             cur = conn.cursor()
-            cur.execute('SELECT album FROM list;')
-            return cur.rowcount
+            cur.execute('SELECT COUNT(*) FROM list;')
+            return cur.fetchone()[0]
         except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
             raise DatabaseError(e)
 
 
 def add_to_list(album_id):
-    with closing(get_connection()) as conn:
+    with connection() as conn:
         try:
             cur = conn.cursor()
-            cur.execute('INSERT INTO list (album) VALUES (%s)', (album_id,))
+            cur.execute('INSERT INTO list (album) VALUES (%s) ON CONFLICT DO NOTHING RETURNING album;', (album_id,))
+            inserted = cur.fetchone()
             conn.commit()
-        except psycopg2.IntegrityError:
-            raise DatabaseError(f'list item {album_id} already exists')
         except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
             raise DatabaseError(e)
+    if inserted is None:
+        raise DatabaseError(f'list item {album_id} already exists')
+    events.publish(events.LIST_ADDED, [album_id])
 
 
 def add_many_to_list(album_ids):
-    with closing(get_connection()) as conn:
+    """
+    Add (album_id,) rows to the list in one statement, skipping any already
+    in it, and return the ids that were added.
+    """
+    album_ids = list(album_ids)
+    if not album_ids:
+        return []
+    with connection() as conn:
         try:
             cur = conn.cursor()
-            cur.executemany('INSERT INTO list (album) VALUES (%s)', album_ids)
+            # one page so that RETURNING covers every row
+            execute_values(cur, 'INSERT INTO list (album) VALUES %s ON CONFLICT DO NOTHING RETURNING album',
+                           album_ids, page_size=len(album_ids))
+            added = [item[0] for item in cur.fetchall()]
             conn.commit()
         except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
             raise DatabaseError(e)
+    events.publish(events.LIST_ADDED, added)
+    return added
 
 
 def delete_from_list(album_id):
-    with closing(get_connection()) as conn:
+    with connection() as conn:
         try:
             cur = conn.cursor()
-            cur.execute('DELETE FROM list where album = %s;', (album_id,))
+            cur.execute('DELETE FROM list where album = %s RETURNING album;', (album_id,))
+            removed = [item[0] for item in cur.fetchall()]
             conn.commit()
         except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
             raise DatabaseError(e)
+    if removed:
+        events.publish(events.LIST_DELETED, removed)
+
+
+def is_in_list(album_id):
+    with connection() as conn:
+        try:
+            cur = conn.cursor()
+            cur.execute('SELECT EXISTS (SELECT 1 FROM list WHERE album = %s);', (album_id,))
+            return cur.fetchone()[0]
+        except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
+            raise DatabaseError(e)
+
+
+def get_existing_list_ids(album_ids):
+    """
+    Which of the given album ids are already in the list, using the index on list.album.
+    """
+    with connection() as conn:
+        try:
+            cur = conn.cursor()
+            cur.execute('SELECT album FROM list WHERE album = ANY(%s);', (list(album_ids), ))
+            return {item[0] for item in cur.fetchall()}
+        except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
+            raise DatabaseError(e)
 
 
 def check_for_new_list_ids(results):
+    album_ids = {str(album_id) for album_id in results if album_id is not None}
+    if not album_ids:
+        return []
     return [
-        (str(album_id),)
-        for album_id in set(
-            results
-        ).difference(
-            set(get_list())
-        )
-        if album_id is not None
+        (album_id,)
+        for album_id in album_ids.difference(get_existing_list_ids(album_ids))
     ]
 
 
 def _reset_list():
-    with closing(get_connection()) as conn:
+    with connection() as conn:
         try:
             cur = conn.cursor()
             cur.execute('DELETE FROM list')
             conn.commit()
         except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
             raise DatabaseError(e)
+    events.publish(events.LIST_RESET)
 
 
 def de_dup():
-    duplicates = [
-        (album_id, )
-        for album_id, count in collections.Counter(get_list()).items()
-        if count > 1
-    ]
-    with closing(get_connection()) as conn:
+    """
+    Remove duplicate list items, keeping the first of each. The list_album_key
+    constraint stops new duplicates, so this only matters before migrating.
+    """
+    with connection() as conn:
         try:
             cur = conn.cursor()
-            cur.executemany('DELETE FROM list where album = %s;', duplicates)
-            cur.executemany('INSERT INTO list (album) VALUES (%s)', duplicates)
+            cur.execute('DELETE FROM list a USING list b WHERE a.album = b.album AND a.id > b.id;')
             conn.commit()
+            return cur.rowcount
         except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
             raise DatabaseError(e)
\ No newline at end of file
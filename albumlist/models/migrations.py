@@ -0,0 +1,144 @@
+import collections
+
+import psycopg2
+
+from albumlist.models import DatabaseError, connection
+
+
+Migration = collections.namedtuple('Migration', 'version name sql index')
+
+# arbitrary key for the advisory lock that stops two processes migrating at once
+MIGRATIONS_LOCK_ID = 7316240
+
+# migrations with an index name are run outside a transaction so that they
+# can use CREATE INDEX CONCURRENTLY without blocking writes
+MIGRATIONS = [
+    Migration(1, 'enable pg_trgm', 'CREATE EXTENSION IF NOT EXISTS pg_trgm;', None),
+    Migration(2, 'trigram index on album names', """
+        CREATE INDEX CONCURRENTLY IF NOT EXISTS alb_trgm_name
+        ON albums USING gin (LOWER(name) gin_trgm_ops);""", 'alb_trgm_name'),
+    Migration(3, 'trigram index on album artists', """
+        CREATE INDEX CONCURRENTLY IF NOT EXISTS alb_trgm_artist
+        ON albums USING gin (LOWER(artist) gin_trgm_ops);""", 'alb_trgm_artist'),
+    Migration(4, 'full text index on album names and artists', """
+        CREATE INDEX CONCURRENTLY IF NOT EXISTS alb_fts
+        ON albums USING gin (to_tsvector('simple', COALESCE(name, '') || ' ' || COALESCE(artist, '')));""",
+              'alb_fts'),
+    Migration(5, 'gin index on album tags', """
+        CREATE INDEX CONCURRENTLY IF NOT EXISTS alb_tags_json
+        ON albums USING gin (tags_json);""", 'alb_tags_json'),
+    Migration(6, 'gin index on album users', """
+        CREATE INDEX CONCURRENTLY IF NOT EXISTS alb_users_json
+        ON albums USING gin (users_json);""", 'alb_users_json'),
+    Migration(7, 'partial index on unavailable albums', """
+        CREATE INDEX CONCURRENTLY IF NOT EXISTS alb_unavailable
+        ON albums (id) WHERE available = false;""", 'alb_unavailable'),
+    Migration(8, 'index on album urls', """
+        CREATE INDEX CONCURRENTLY IF NOT EXISTS alb_url
+        ON albums (url);""", 'alb_url'),
+    Migration(9, 'channel scrape cursors', """
+        CREATE TABLE IF NOT EXISTS channel_cursors (
+        channel varchar PRIMARY KEY,
+        latest_ts numeric,
+        scraped timestamp DEFAULT now()
+        );""", None),
+    Migration(10, 'index on list albums', """
+        CREATE INDEX CONCURRENTLY IF NOT EXISTS list_album
+        ON list (album);""", 'list_album'),
+    Migration(11, 'unique list albums', """
+        DELETE FROM list a USING list b WHERE a.album = b.album AND a.id > b.id;
+        ALTER TABLE list ADD CONSTRAINT list_album_key UNIQUE (album);
+        DROP INDEX IF EXISTS list_album;""", None),
+    Migration(12, 'keyset index on album added dates', """
+        CREATE INDEX CONCURRENTLY IF NOT EXISTS alb_added_id
+        ON albums (added, id);""", 'alb_added_id'),
+    Migration(13, 'prefix index on album release dates', """
+        CREATE INDEX CONCURRENTLY IF NOT EXISTS alb_released
+        ON albums (released varchar_pattern_ops);""", 'alb_released'),
+]
+
+
+def create_migrations_table():
+    sql = """
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+        version integer PRIMARY KEY,
+        name varchar DEFAULT '',
+        applied timestamp DEFAULT now()
+        );"""
+    with connection() as conn:
+        try:
+            cur = conn.cursor()
+            cur.execute(sql)
+            conn.commit()
+        except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
+            raise DatabaseError(e)
+
+
+def get_applied_migrations():
+    with connection() as conn:
+        try:
+            cur = conn.cursor()
+            cur.execute('SELECT version, applied FROM schema_migrations;')
+            return dict(cur.fetchall())
+        except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
+            raise DatabaseError(e)
+
+
+def migration_status():
+    applied = get_applied_migrations()
+    return [(migration, applied.get(migration.version)) for migration in MIGRATIONS]
+
+
+def _drop_invalid_index(cur, index):
+    # a failed concurrent build leaves an invalid index that IF NOT EXISTS would skip
+    cur.execute("""
+        SELECT NOT i.indisvalid
+        FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid
+        WHERE c.relname = %s;
+        """, (index, ))
+    row = cur.fetchone()
+    if row and row[0]:
+        print(f'[db]: dropping invalid index {index}')
+        cur.execute(f'DROP INDEX CONCURRENTLY IF EXISTS {index};')
+
+
+def apply_migrations():
+    """
+    Apply any migrations that have not been recorded in schema_migrations,
+    in version order, and return the ones that were applied.
+    """
+    create_migrations_table()
+    applied = []
+    with connection() as conn:
+        try:
+            conn.autocommit = True
+            cur = conn.cursor()
+            cur.execute('SELECT pg_advisory_lock(%s);', (MIGRATIONS_LOCK_ID, ))
+            try:
+                cur.execute('SELECT version FROM schema_migrations;')
+                done = {row[0] for row in cur.fetchall()}
+                for migration in sorted(MIGRATIONS):
+                    if migration.version in done:
+                        continue
+                    print(f'[db]: applying migration {migration.version}: {migration.name}')
+                    if migration.index:
+                        _drop_invalid_index(cur, migration.index)
+                        cur.execute(migration.sql)
+                        cur.execute('INSERT INTO schema_migrations (version, name) VALUES (%s, %s);',
+                                    (migration.version, migration.name))
+                    else:
+                        conn.autocommit = False
+                        cur.execute(migration.sql)
+                        cur.execute('INSERT INTO schema_migrations (version, name) VALUES (%s, %s);',
+                                    (migration.version, migration.name))
+                        conn.commit()
+                        conn.autocommit = True
+                    applied.append(migration)
+            finally:
+                if not conn.autocommit:
+                    conn.rollback()
+                    conn.autocommit = True
+                cur.execute('SELECT pg_advisory_unlock(%s);', (MIGRATIONS_LOCK_ID, ))
+        except psycopg2.Error as e:
+            raise DatabaseError(e)
+    return applied
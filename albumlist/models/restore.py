@@ -0,0 +1,208 @@
+import ast
+import csv
+import io
+import json
+import re
+from datetime import datetime
+
+import psycopg2
+
+from albumlist.models import DatabaseError, connection, events
+
+
+STAGING_COLUMNS = (
+    'id', 'artist', 'name', 'url', 'img', 'channel', 'added', 'released',
+    'tags_json', 'users_json', 'reviews_json',
+)
+
+ALBUM_ID_REGEX = re.compile(r'^\d+$')
+
+ADDED_FORMATS = ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d %H:%M:%S.%f', '%Y-%m-%d %H:%M:%S')
+
+
+class InvalidRow(ValueError):
+    pass
+
+
+def _parse_added(value):
+    if not value:
+        return None
+    for added_format in ADDED_FORMATS:
+        try:
+            return datetime.strptime(value, added_format)
+        except ValueError:
+            continue
+    raise InvalidRow(f'invalid added date: {value}')
+
+
+def _parse_list(value, name):
+    # dumps write lists with str(), older exports used JSON
+    if not value:
+        return []
+    try:
+        items = ast.literal_eval(value)
+    except (ValueError, SyntaxError):
+        try:
+            items = json.loads(value)
+        except ValueError:
+            raise InvalidRow(f'invalid {name}: {value}')
+    if not isinstance(items, list):
+        raise InvalidRow(f'invalid {name}: {value}')
+    return items
+
+
+def staging_row_from_dict(d):
+    """
+    Validate a row of an albums dump and return it as a tuple of
+    STAGING_COLUMNS, or raise InvalidRow.
+    """
+    album_id = (d.get('id') or '').strip()
+    if not ALBUM_ID_REGEX.match(album_id):
+        raise InvalidRow(f'invalid album id: {album_id}')
+    added = _parse_added((d.get('added') or '').strip())
+    tags = [
+        tag[1:].lower() if tag.startswith('#') else tag.lower()
+        for tag in _parse_list(d.get('tags'), 'tags')
+        if isinstance(tag, str) and tag
+    ]
+    return (
+        album_id,
+        d.get('artist') or '',
+        d.get('album') or '',
+        d.get('url') or '',
+        d.get('img') or '',
+        d.get('channel') or '',
+        added.isoformat() if added else '',
+        d.get('released') or '',
+        json.dumps(tags),
+        json.dumps(_parse_list(d.get('users'), 'users')),
+        json.dumps(_parse_list(d.get('reviews'), 'reviews')),
+    )
+
+
+def _copy_rows(cur, rows):
+    buffer = io.StringIO()
+    # quote everything so empty strings aren't read as NULL
+    csv.writer(buffer, quoting=csv.QUOTE_ALL).writerows(rows)
+    buffer.seek(0)
+    cur.copy_expert(f'COPY restore_staging ({", ".join(STAGING_COLUMNS)}) FROM STDIN WITH (FORMAT csv)', buffer)
+
+
+RESTORED_ALBUMS = """
+    SELECT DISTINCT ON (id)
+        id, artist, name, url, img, channel, NULLIF(added, '')::timestamp AS added, released,
+        tags_json::jsonb AS tags_json, users_json::jsonb AS users_json, reviews_json::jsonb AS reviews_json
+    FROM restore_staging
+    ORDER BY id
+    """
+
+UPDATE_ALBUMS_SQL = f"""
+    UPDATE albums SET
+        added = COALESCE(restored.added, albums.added),
+        img = COALESCE(NULLIF(albums.img, ''), restored.img),
+        released = COALESCE(NULLIF(albums.released, ''), restored.released),
+        tags_json = CASE WHEN jsonb_array_length(restored.tags_json) > 0
+            THEN restored.tags_json ELSE albums.tags_json END,
+        users_json = CASE WHEN jsonb_array_length(restored.users_json) > 0
+            THEN restored.users_json ELSE albums.users_json END,
+        reviews_json = CASE WHEN jsonb_array_length(restored.reviews_json) > 0
+            THEN restored.reviews_json ELSE albums.reviews_json END
+    FROM ({RESTORED_ALBUMS}) AS restored
+    WHERE albums.id = restored.id;
+    """
+
+INSERT_ALBUMS_SQL = f"""
+    INSERT INTO albums (id, artist, name, url, img, channel, added, released, tags_json, users_json, reviews_json)
+    SELECT id, artist, name, url, img, channel, COALESCE(added, now()), released, tags_json, users_json, reviews_json
+    FROM ({RESTORED_ALBUMS}) AS restored
+    WHERE url <> '' AND name <> '' AND artist <> ''
+    ON CONFLICT (id) DO NOTHING;
+    """
+
+MERGE_LIST_SQL = """
+    INSERT INTO list (album)
+    SELECT DISTINCT id FROM restore_staging
+    ON CONFLICT DO NOTHING
+    RETURNING album;
+    """
+
+MISSING_DETAILS_SQL = """
+    SELECT albums.id, albums.img = '', jsonb_array_length(albums.tags_json) = 0, albums.released = ''
+    FROM albums
+    WHERE albums.id IN (SELECT id FROM restore_staging)
+    AND (albums.img = '' OR jsonb_array_length(albums.tags_json) = 0 OR albums.released = '');
+    """
+
+MISSING_ALBUMS_SQL = """
+    SELECT COUNT(DISTINCT id) FROM restore_staging
+    WHERE NOT EXISTS (SELECT 1 FROM albums WHERE albums.id = restore_staging.id);
+    """
+
+
+def restore_albums(rows, batch_size=5000, progress=None):
+    """
+    Load rows of STAGING_COLUMNS into a staging table with COPY, then merge
+    them into the albums and list tables in one transaction.
+
+    Existing albums keep their image and release date, and only have their
+    tags, users and reviews replaced by non-empty ones. Rows without a name,
+    artist or url are only added to the list, so that their details are
+    scraped later. progress(n) is called with the number of rows loaded
+    after each batch.
+
+    Returns a dict with the number of rows loaded, list items added, albums
+    still without details, and (album id, missing img, missing tags,
+    missing released) for restored albums that have gaps to scrape.
+    """
+    loaded = 0
+    with connection() as conn:
+        try:
+            cur = conn.cursor()
+            cur.execute("""
+                CREATE TEMP TABLE restore_staging (
+                id varchar NOT NULL,
+                artist varchar,
+                name varchar,
+                url varchar,
+                img varchar,
+                channel varchar,
+                added varchar,
+                released varchar,
+                tags_json varchar,
+                users_json varchar,
+                reviews_json varchar
+                ) ON COMMIT DROP;
+                """)
+            batch = []
+            for row in rows:
+                batch.append(row)
+                if len(batch) >= batch_size:
+                    _copy_rows(cur, batch)
+                    loaded += len(batch)
+                    batch = []
+                    if progress:
+                        progress(loaded)
+            if batch:
+                _copy_rows(cur, batch)
+                loaded += len(batch)
+                if progress:
+                    progress(loaded)
+            cur.execute(UPDATE_ALBUMS_SQL)
+            cur.execute(INSERT_ALBUMS_SQL)
+            cur.execute(MERGE_LIST_SQL)
+            added = [item[0] for item in cur.fetchall()]
+            cur.execute(MISSING_DETAILS_SQL)
+            missing_details = cur.fetchall()
+            cur.execute(MISSING_ALBUMS_SQL)
+            missing_albums = cur.fetchone()[0]
+            conn.commit()
+        except (psycopg2.ProgrammingError, psycopg2.InternalError, psycopg2.DataError) as e:
+            raise DatabaseError(e)
+    events.publish(events.LIST_ADDED, added)
+    events.publish(events.ALBUMS_RESET)
+    return {
+        'loaded': loaded,
+        'added_to_list': len(added),
+        'missing_albums': missing_albums,
+        'missing_details': missing_details,
+    }
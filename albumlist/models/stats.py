@@ -0,0 +1,71 @@
+import re
+
+import psycopg2
+
+from albumlist.models import DatabaseError, connection
+
+
+# released dates are scraped as YYYYMMDD
+RELEASED_YEAR_REGEX = re.compile(r'^(\d{4})')
+
+BREAKDOWNS = {
+    'channels': """
+        SELECT channel, COUNT(*) FROM albums GROUP BY channel;
+        """,
+    'added_years': """
+        SELECT EXTRACT(YEAR FROM added)::int::varchar, COUNT(*) FROM albums
+        WHERE added IS NOT NULL
+        GROUP BY 1;
+        """,
+    'released_years': """
+        SELECT substring(released from '^(\\d{4})'), COUNT(*) FROM albums
+        WHERE released ~ '^\\d{4}'
+        GROUP BY 1;
+        """,
+    'tags': """
+        SELECT tag, COUNT(*) FROM albums, jsonb_array_elements_text(tags_json) AS tag
+        GROUP BY tag;
+        """,
+}
+
+
+def added_year(added):
+    return str(added.year) if added else None
+
+
+def released_year(released):
+    match = RELEASED_YEAR_REGEX.match(released or '')
+    return match.group(1) if match else None
+
+
+def get_totals():
+    """
+    The number of albums, list items and unavailable albums, in one round trip.
+    """
+    sql = """
+        SELECT
+        (SELECT COUNT(*) FROM albums),
+        (SELECT COUNT(*) FROM list),
+        (SELECT COUNT(*) FROM albums WHERE available = false);
+        """
+    with connection() as conn:
+        try:
+            cur = conn.cursor()
+            cur.execute(sql)
+            albums, list_items, unavailable = cur.fetchone()
+            return {'albums': albums, 'list': list_items, 'unavailable': unavailable}
+        except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
+            raise DatabaseError(e)
+
+
+def get_breakdown(name):
+    """
+    Album counts grouped by one of BREAKDOWNS, as a dict of group to count.
+    """
+    with connection() as conn:
+        try:
+            cur = conn.cursor()
+            cur.execute(BREAKDOWNS[name])
+            return {group or '': count for group, count in cur.fetchall()}
+        except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
+            raise DatabaseError(e)
@@ -0,0 +1,137 @@
+import collections
+import random
+import threading
+import time
+
+from albumlist.models import albums as albums_model
+
+
+class _Choices:
+    """
+    Constant time uniform or weighted choice from a fixed list of album ids.
+
+    Weighted choices use Vose's alias method, built the first time they are
+    needed.
+    """
+
+    def __init__(self, album_ids, weights=None):
+        self.album_ids = album_ids
+        self.weights = weights
+        self._alias = None
+
+    def __len__(self):
+        return len(self.album_ids)
+
+    def _build_alias(self):
+        n = len(self.album_ids)
+        total = float(sum(self.weights))
+        scaled = [weight * n / total for weight in self.weights]
+        probability, alias = [1.0] * n, list(range(n))
+        small = [i for i, p in enumerate(scaled) if p < 1.0]
+        large = [i for i, p in enumerate(scaled) if p >= 1.0]
+        while small and large:
+            less, more = small.pop(), large.pop()
+            probability[less], alias[less] = scaled[less], more
+            scaled[more] -= 1.0 - scaled[less]
+            (small if scaled[more] < 1.0 else large).append(more)
+        return probability, alias
+
+    def choice(self, rng, weighted=False):
+        if not self.album_ids:
+            return None
+        i = rng.randrange(len(self.album_ids))
+        if weighted and self.weights:
+            if self._alias is None:
+                self._alias = self._build_alias()
+            probability, alias = self._alias
+            if rng.random() >= probability[i]:
+                i = alias[i]
+        return self.album_ids[i]
+
+
+class RandomAlbumPicker:
+    """
+    Picks random available albums from a cached array of their ids instead
+    of sorting the albums table on every request.
+
+    The array (and a per-tag array for tag-filtered picks) is reloaded once
+    it is older than refresh_interval seconds. Picks can be weighted towards
+    albums that have been added to My Lists or reviewed, and can exclude a
+    set of recently picked ids.
+    """
+
+    def __init__(self, refresh_interval=300, max_tags=256, rng=None):
+        self.refresh_interval = refresh_interval
+        self.max_tags = max_tags
+        self.rng = rng or random.SystemRandom()
+        self._lock = threading.Lock()
+        self._all = None
+        self._tags = collections.OrderedDict()  # tag -> (loaded_at, choices), least recently used first
+
+    def _stale(self, loaded_at):
+        return time.monotonic() - loaded_at >= self.refresh_interval
+
+    def _load_all(self):
+        rows = albums_model.get_available_album_weights()
+        return time.monotonic(), _Choices([row[0] for row in rows], [row[1] for row in rows])
+
+    def _load_tag(self, tag):
+        _, choices = self._choices()
+        weights = dict(zip(choices.album_ids, choices.weights))
+        album_ids = albums_model.get_available_album_ids_by_tag(tag)
+        return time.monotonic(), _Choices(album_ids, [weights.get(album_id, 1) for album_id in album_ids])
+
+    def _choices(self, tag=None):
+        if tag is None:
+            entry = self._all
+            if entry is None or self._stale(entry[0]):
+                entry = self._all = self._load_all()
+            return entry
+        with self._lock:
+            entry = self._tags.get(tag)
+            if entry is not None:
+                self._tags.move_to_end(tag)
+        if entry is None or self._stale(entry[0]):
+            entry = self._load_tag(tag)
+            with self._lock:
+                self._tags[tag] = entry
+                self._tags.move_to_end(tag)
+                while len(self._tags) > self.max_tags:
+                    self._tags.popitem(last=False)
+        return entry
+
+    def invalidate(self):
+        with self._lock:
+            self._all = None
+            self._tags.clear()
+
+    def pick(self, tag=None, weighted=False, exclude=None, attempts=10):
+        """
+        A random available album id, or None if there are none to pick from.
+        """
+        _, choices = self._choices(tag.lower() if tag else None)
+        exclude = exclude or set()
+        for _ in range(attempts):
+            album_id = choices.choice(self.rng, weighted=weighted)
+            if album_id not in exclude:
+                return album_id
+        # the exclusion window covers most of the albums, so pick from what's left
+        remaining = [album_id for album_id in choices.album_ids if album_id not in exclude]
+        return self.rng.choice(remaining) if remaining else None
+
+    def random_album(self, tag=None, weighted=False, exclude=None):
+        """
+        A random available Album with its tags and reviews, or None.
+        """
+        for _ in range(2):
+            album_id = self.pick(tag=tag, weighted=weighted, exclude=exclude)
+            if album_id is None:
+                break
+            albums = albums_model.get_album_details_with_tags_from_ids([album_id])
+            if albums and albums[0].available:
+                return albums[0]
+            # the cached ids are out of date
+            self.invalidate()
+        if tag is None and not exclude:
+            return albums_model.get_random_album()
+        return None
@@ -1,2 +1,6 @@
 class NotFoundError(Exception):
     pass
+
+
+class FetchError(NotFoundError):
+    pass
@@ -1,10 +1,7 @@
-import functools
 import json
 import lxml.html as lxh
 
-import requests
-
-from albumlist.scrapers import NotFoundError, links
+from albumlist.scrapers import FetchError, NotFoundError, fetch, links
 
 
 def scrape_bandcamp_album_ids_from_attachments(message):
@@ -25,7 +22,7 @@ def scrape_bandcamp_album_ids_from_url(url, force=False):
     if ('http' in url and 'bandcamp.com' in url) or force:
         url = url.replace('<', '').replace('>', '')
         url = url.replace('\\', '').split('|')[0]
-        response = requests.get(url)
+        response = fetch.get(url)
         if response.ok:
             content = response.text
             if comment in content:
@@ -35,23 +32,45 @@ def scrape_bandcamp_album_ids_from_url(url, force=False):
     raise NotFoundError
 
 
-scrape_bandcamp_album_ids_from_url_forced = functools.partial(scrape_bandcamp_album_ids_from_url, force=True)
+def scrape_bandcamp_album_ids_from_url_forced(url):
+    # a named function rather than a partial so it can be passed to jobs by reference
+    return scrape_bandcamp_album_ids_from_url(url, force=True)
+
+
+def _album_cover_url_from_html(html):
+    try:
+        img = html.cssselect('div#tralbumArt')[0].cssselect('img')[0]
+        return img.attrib['src']
+    except (IndexError, KeyError):
+        raise NotFoundError
+
+
+def _album_tags_from_html(html):
+    try:
+        return [element.text for element in html.cssselect('a.tag')]
+    except AttributeError:
+        return []
+
+
+def _album_released_from_html(html):
+    try:
+        data = html.cssselect('div.tralbum-credits')[0].cssselect('meta')[0].attrib
+        if data['itemprop'] == 'datePublished':
+            return data['content']  # YYYYMMDD
+    except (IndexError, KeyError):
+        raise NotFoundError
+    raise NotFoundError
 
 
 def scrape_bandcamp_album_cover_url_from_url(url):
-    response = requests.get(url)
+    response = fetch.get(url)
     if response.ok:
-        html = lxh.fromstring(response.text)
-        try:
-            img = html.cssselect('div#tralbumArt')[0].cssselect('img')[0]
-            return img.attrib['src']
-        except (IndexError, KeyError):
-            raise NotFoundError
+        return _album_cover_url_from_html(lxh.fromstring(response.text))
     raise NotFoundError
 
 
 def scrape_bandcamp_album_ids_from_artist_page(url):
-    response = requests.get(url if url.endswith('/music') else f'{url}/music')
+    response = fetch.get(url if url.endswith('/music') else f'{url}/music')
     if response.ok:
         html = lxh.fromstring(response.text)
         try:
@@ -62,13 +81,9 @@ def scrape_bandcamp_album_ids_from_artist_page(url):
 
 
 def scrape_bandcamp_tags_from_url(url):
-    response = requests.get(url)
+    response = fetch.get(url)
     if response.ok:
-        html = lxh.fromstring(response.text)
-        try:
-            return [element.text for element in html.cssselect('a.tag')]
-        except AttributeError:
-            pass
+        return _album_tags_from_html(lxh.fromstring(response.text))
     return []
 
 
@@ -87,9 +102,12 @@ def scrape_bandcamp_album_ids_from_messages(messages, do_requests=True):
                     continue
 
 
-def scrape_bandcamp_album_details_from_id(album_id):
+def _embedded_player_url(album_id):
+    return 'https://bandcamp.com/EmbeddedPlayer/v=2/album=%s' % album_id
+
+
+def _album_details_from_player_response(response):
     variable_text = 'var playerdata = '
-    response = requests.get('https://bandcamp.com/EmbeddedPlayer/v=2/album=%s' % album_id)
     if response.ok:
         content = response.text
         player_data_pos = content.find(variable_text)
@@ -103,8 +121,33 @@ def scrape_bandcamp_album_details_from_id(album_id):
                 pass
 
 
+def scrape_bandcamp_album_details_from_id(album_id):
+    try:
+        response = fetch.get(_embedded_player_url(album_id))
+    except FetchError as e:
+        print(f'[scraper]: {e}')
+        return
+    return _album_details_from_player_response(response)
+
+
+def scrape_bandcamp_album_details_from_ids(album_ids):
+    """
+    (album, artist, url) for each album id, or None where it couldn't be
+    scraped, fetching the players concurrently.
+    """
+    urls = {_embedded_player_url(album_id): album_id for album_id in album_ids}
+    details = {}
+    for url, response in fetch.fetch_many(urls):
+        if isinstance(response, FetchError):
+            print(f'[scraper]: {response}')
+            details[urls[url]] = None
+        else:
+            details[urls[url]] = _album_details_from_player_response(response)
+    return details
+
+
 def scrape_bandcamp_album_details_from_search(query):
-    response = requests.get(f'https://bandcamp.com/search?q={query.replace(" ", "%20")}')
+    response = fetch.get(f'https://bandcamp.com/search?q={query.replace(" ", "%20")}')
     if response.ok:
         html = lxh.fromstring(response.text)
         for album in html.cssselect('li.searchresult.album'):
@@ -121,13 +164,46 @@ def scrape_bandcamp_album_details_from_search(query):
 
 
 def scrape_bandcamp_album_released_from_url(url):
-    response = requests.get(url)
+    response = fetch.get(url)
     if response.ok:
-        html = lxh.fromstring(response.text)
-        try:
-            data = html.cssselect('div.tralbum-credits')[0].cssselect('meta')[0].attrib
-            if data['itemprop'] == 'datePublished':
-                return data['content']  # YYYYMMDD
-        except (IndexError, KeyError):
-            raise NotFoundError
+        return _album_released_from_html(lxh.fromstring(response.text))
     raise NotFoundError
+
+
+def _album_page_details_from_response(response):
+    if not response.ok:
+        raise NotFoundError
+    html = lxh.fromstring(response.text)
+    try:
+        cover = _album_cover_url_from_html(html)
+    except NotFoundError:
+        cover = None
+    try:
+        released = _album_released_from_html(html)
+    except NotFoundError:
+        released = None
+    return cover, _album_tags_from_html(html) or None, released
+
+
+def scrape_bandcamp_album_page_details_from_url(url):
+    """
+    Scrape the cover URL, tags and release date from a single download of
+    an album page. Any detail that cannot be found is returned as None.
+    """
+    return _album_page_details_from_response(fetch.get(url))
+
+
+def scrape_bandcamp_album_page_details_from_urls(urls):
+    """
+    Fetch many album pages concurrently and return a dict of url to
+    (cover, tags, released), or to None if the page could not be scraped.
+    """
+    details = {}
+    for url, response in fetch.fetch_many(urls):
+        try:
+            if isinstance(response, FetchError):
+                raise response
+            details[url] = _album_page_details_from_response(response)
+        except NotFoundError:
+            details[url] = None
+    return details
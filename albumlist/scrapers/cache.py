@@ -0,0 +1,234 @@
+import base64
+import collections
+import hashlib
+import json
+import os
+import threading
+import time
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+
+# how long a cached response is used before it is revalidated, by resource type
+TTLS = {
+    'player': int(os.environ.get('SCRAPER_CACHE_TTL_PLAYER', 60 * 60 * 24)),
+    'album': int(os.environ.get('SCRAPER_CACHE_TTL_ALBUM', 60 * 60 * 6)),
+    'search': int(os.environ.get('SCRAPER_CACHE_TTL_SEARCH', 60 * 10)),
+    'head': int(os.environ.get('SCRAPER_CACHE_TTL_HEAD', 60 * 15)),
+}
+
+KEPT_HEADERS = ('content-type', 'etag', 'last-modified', 'location')
+
+
+def resource_type(method, url):
+    if method == 'HEAD':
+        return 'head'
+    if 'EmbeddedPlayer' in url:
+        return 'player'
+    if '/search' in url:
+        return 'search'
+    return 'album'
+
+
+def cache_key(method, url):
+    return hashlib.sha1(f'{method} {url}'.encode('utf-8')).hexdigest()
+
+
+def entry_from_response(response):
+    return {
+        'url': response.url,
+        'status': response.status_code,
+        'reason': response.reason,
+        'headers': {k.lower(): v for k, v in response.headers.items() if k.lower() in KEPT_HEADERS},
+        'encoding': response.encoding,
+        'content': base64.b64encode(response.content or b'').decode('ascii'),
+        'stored': time.time(),
+    }
+
+
+def response_from_entry(entry):
+    response = requests.models.Response()
+    response.url = entry['url']
+    response.status_code = entry['status']
+    response.reason = entry['reason']
+    response.headers = CaseInsensitiveDict(entry['headers'])
+    response.encoding = entry['encoding']
+    response._content = base64.b64decode(entry['content'])
+    response.from_cache = True
+    return response
+
+
+class DiskCache:
+    """
+    Cached responses as JSON files in a directory, with the least recently
+    used files removed once there are more than max_entries.
+    """
+
+    def __init__(self, directory, max_entries=2000):
+        self.directory = directory
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._writes = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, f'{key}.json')
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, 'r') as f:
+                entry = json.load(f)
+            os.utime(path)  # mark as recently used
+            return entry
+        except (OSError, ValueError):
+            return None
+
+    def set(self, key, entry):
+        path = self._path(key)
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(entry, f)
+        os.replace(tmp_path, path)
+        with self._lock:
+            self._writes += 1
+            # listing the directory is slow, so only check the size every so often
+            if self._writes % 50:
+                return 0
+        return self.evict()
+
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.json'):
+                try:
+                    entries.append((os.stat(os.path.join(self.directory, name)).st_mtime, name))
+                except OSError:
+                    continue
+        excess = len(entries) - self.max_entries
+        if excess <= 0:
+            return 0
+        for _, name in sorted(entries)[:excess]:
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+        return excess
+
+
+class RedisCache:
+    """
+    Cached responses in Redis, with a sorted set of last-used times so that
+    the least recently used entries are removed once there are more than
+    max_entries.
+    """
+
+    def __init__(self, redis_connection, prefix='scraper-cache', max_entries=200):
+        self.redis = redis_connection
+        self.prefix = prefix
+        self.max_entries = max_entries
+        self.lru_key = f'{prefix}:lru'
+
+    def get(self, key):
+        value = self.redis.get(f'{self.prefix}:{key}')
+        if value is None:
+            return None
+        self.redis.zadd(self.lru_key, key, time.time())
+        try:
+            return json.loads(value)
+        except ValueError:
+            return None
+
+    def set(self, key, entry):
+        pipe = self.redis.pipeline()
+        pipe.set(f'{self.prefix}:{key}', json.dumps(entry))
+        pipe.zadd(self.lru_key, key, time.time())
+        pipe.zcard(self.lru_key)
+        excess = pipe.execute()[-1] - self.max_entries
+        if excess <= 0:
+            return 0
+        oldest = [key.decode('utf-8') for key in self.redis.zrange(self.lru_key, 0, excess - 1)]
+        if oldest:
+            pipe = self.redis.pipeline()
+            pipe.delete(*[f'{self.prefix}:{key}' for key in oldest])
+            pipe.zrem(self.lru_key, *oldest)
+            pipe.execute()
+        return len(oldest)
+
+
+class ResponseCache:
+    """
+    Serves GET and HEAD responses from a backend while they are fresh, and
+    revalidates stale ones with If-None-Match/If-Modified-Since so that an
+    unchanged page costs a 304 instead of a full download.
+    """
+
+    def __init__(self, backend, ttls=None):
+        self.backend = backend
+        self.ttls = dict(TTLS, **(ttls or {}))
+        self._lock = threading.Lock()
+        self._stats = collections.Counter()
+
+    def _count(self, stat, n=1):
+        with self._lock:
+            self._stats[stat] += n
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, backend=type(self.backend).__name__)
+
+    def request(self, method, url, send, **kwargs):
+        """
+        Return a response for the request, calling send(headers) for a fresh
+        or conditional response when the cached one can't be used as is.
+        """
+        if method not in ('GET', 'HEAD') or kwargs.get('params'):
+            return send({})
+        key = cache_key(method, url)
+        try:
+            entry = self.backend.get(key)
+        except Exception as e:
+            print(f'[scraper]: failed to read from cache: {e}')
+            entry = None
+        if entry is not None and time.time() - entry['stored'] < self.ttls[resource_type(method, url)]:
+            self._count('hits')
+            return response_from_entry(entry)
+        headers = {}
+        if entry is not None:
+            if entry['headers'].get('etag'):
+                headers['If-None-Match'] = entry['headers']['etag']
+            if entry['headers'].get('last-modified'):
+                headers['If-Modified-Since'] = entry['headers']['last-modified']
+        response = send(headers)
+        if entry is not None and response.status_code == 304:
+            self._count('revalidated')
+            entry['stored'] = time.time()
+            self._store(key, entry)
+            return response_from_entry(entry)
+        self._count('misses')
+        if response.status_code == 200:
+            self._store(key, entry_from_response(response))
+        return response
+
+    def _store(self, key, entry):
+        try:
+            self._count('evictions', self.backend.set(key, entry))
+        except Exception as e:
+            print(f'[scraper]: failed to write to cache: {e}')
+
+
+def create_cache():
+    backend = os.environ.get('SCRAPER_CACHE', 'disk')
+    if backend == 'disk':
+        return ResponseCache(DiskCache(
+            os.environ.get('SCRAPER_CACHE_DIR', '/tmp/albumlist-scraper-cache'),
+            max_entries=int(os.environ.get('SCRAPER_CACHE_MAX_ENTRIES', 2000)),
+        ))
+    if backend == 'redis':
+        from albumlist.delayed import redis_connection
+        return ResponseCache(RedisCache(
+            redis_connection,
+            max_entries=int(os.environ.get('SCRAPER_CACHE_MAX_ENTRIES', 200)),
+        ))
+    return None
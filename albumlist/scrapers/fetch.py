@@ -0,0 +1,148 @@
+import os
+import threading
+import time
+from concurrent import futures
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from albumlist import metrics
+from albumlist.scrapers import FetchError, cache
+
+
+CONNECT_TIMEOUT = float(os.environ.get('FETCH_CONNECT_TIMEOUT', 5))
+READ_TIMEOUT = float(os.environ.get('FETCH_READ_TIMEOUT', 20))
+MAX_PER_HOST = int(os.environ.get('FETCH_MAX_PER_HOST', 4))
+MAX_WORKERS = int(os.environ.get('FETCH_MAX_WORKERS', 8))
+RETRIES = int(os.environ.get('FETCH_RETRIES', 3))
+RETRY_BACKOFF = float(os.environ.get('FETCH_RETRY_BACKOFF', 0.5))
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+_local = threading.local()
+_host_limits = {}
+_host_limits_lock = threading.Lock()
+_executor = (None, None)
+_executor_lock = threading.Lock()
+_response_cache = None
+_response_cache_lock = threading.Lock()
+
+
+def _new_session():
+    retry = Retry(
+        total=RETRIES,
+        backoff_factor=RETRY_BACKOFF,
+        status_forcelist=RETRY_STATUSES,
+        method_whitelist=frozenset(['GET', 'HEAD']),
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=MAX_PER_HOST, pool_maxsize=MAX_PER_HOST, max_retries=retry)
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def get_session():
+    """
+    A keep-alive session for the current thread (requests sessions are not
+    thread-safe), replaced after a fork.
+    """
+    pid, session = getattr(_local, 'session', (None, None))
+    if pid != os.getpid():
+        session = _new_session()
+        _local.session = (os.getpid(), session)
+    return session
+
+
+def _host_limit(url):
+    host = urlparse(url).hostname or ''
+    with _host_limits_lock:
+        if host not in _host_limits:
+            _host_limits[host] = threading.BoundedSemaphore(MAX_PER_HOST)
+        return _host_limits[host]
+
+
+def get_response_cache():
+    global _response_cache
+    with _response_cache_lock:
+        if _response_cache is None:
+            _response_cache = cache.create_cache() or False
+    return _response_cache or None
+
+
+def cache_stats():
+    response_cache = get_response_cache()
+    return response_cache.stats() if response_cache else {}
+
+
+def fetch(url, method='GET', **kwargs):
+    """
+    Make a request with a pooled session, a timeout, retries with backoff on
+    429 and 5xx responses, and at most MAX_PER_HOST requests to the same
+    host in flight at once. HEAD requests don't follow redirects unless
+    allow_redirects is passed. GET and HEAD responses go through the response
+    cache (see albumlist.scrapers.cache). Raises FetchError if no response
+    is received.
+    """
+    kwargs.setdefault('timeout', (CONNECT_TIMEOUT, READ_TIMEOUT))
+    if method == 'HEAD':
+        # like requests.head, so a moved or removed album isn't reported as the page it redirects to
+        kwargs.setdefault('allow_redirects', False)
+    host = urlparse(url).hostname or ''
+
+    def send(headers):
+        if headers:
+            kwargs['headers'] = dict(kwargs.get('headers') or {}, **headers)
+        with _host_limit(url):
+            # timed once a slot for the host is free, so waiting on the limit isn't counted
+            started = time.monotonic()
+            try:
+                return get_session().request(method, url, **kwargs)
+            except requests.RequestException as e:
+                metrics.HTTP_ERRORS.inc(host, method)
+                raise FetchError(f'{method} {url} failed: {e}')
+            finally:
+                metrics.HTTP_REQUEST.observe(time.monotonic() - started, host, method)
+
+    response_cache = get_response_cache()
+    if response_cache is None:
+        return send({})
+    return response_cache.request(method, url, send, **kwargs)
+
+
+def get(url, **kwargs):
+    return fetch(url, 'GET', **kwargs)
+
+
+def head(url, **kwargs):
+    return fetch(url, 'HEAD', **kwargs)
+
+
+def _get_executor():
+    # long-lived threads keep their sessions, and so their connections, alive between batches
+    global _executor
+    with _executor_lock:
+        pid, executor = _executor
+        if pid != os.getpid():
+            executor = futures.ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix='fetch')
+            _executor = (os.getpid(), executor)
+        return executor
+
+
+def fetch_many(urls, method='GET', **kwargs):
+    """
+    Fetch many URLs concurrently. Returns (url, response) pairs in the order
+    given, where response is a FetchError if the request failed.
+    """
+    urls = list(urls)
+
+    def _fetch(url):
+        try:
+            return fetch(url, method, **kwargs)
+        except FetchError as e:
+            return e
+
+    return list(zip(urls, _get_executor().map(_fetch, urls)))
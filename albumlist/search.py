@@ -0,0 +1,309 @@
+import bisect
+import heapq
+import re
+import threading
+import time
+from datetime import timedelta
+
+import redis
+
+from albumlist.models import DatabaseError, events
+from albumlist.models import albums as albums_model
+
+
+TOKEN_REGEX = re.compile(r'\w+')
+# updates to these fields change what searches return
+INDEXED_FIELDS = {'name', 'artist', 'tags', 'available'}
+
+
+def tokenize(text):
+    return TOKEN_REGEX.findall((text or '').lower())
+
+
+def _document(name, artist, tags):
+    name = (name or '').lower()
+    artist = (artist or '').lower()
+    return name, artist, set(tokenize(name)), set(tokenize(artist)), {tag.lower() for tag in tags or []}
+
+
+class _Postings:
+    """
+    Album documents and the token and tag postings built from them.
+    """
+
+    def __init__(self):
+        self.documents = {}  # album id -> (name, artist, name tokens, artist tokens, tags)
+        self.postings = {}  # token -> set of album ids
+        self.tags = {}  # tag -> set of album ids
+        self.tokens = []  # sorted tokens of postings
+
+    def prefix_matches(self, prefix):
+        matches = set()
+        start = bisect.bisect_left(self.tokens, prefix)
+        for token in self.tokens[start:]:
+            if not token.startswith(prefix):
+                break
+            matches |= self.postings[token]
+        return matches
+
+    def add(self, album_id, document, keep_sorted=True):
+        self.documents[album_id] = document
+        _, _, name_tokens, artist_tokens, tags = document
+        for token in name_tokens | artist_tokens:
+            if token not in self.postings:
+                self.postings[token] = set()
+                if keep_sorted:
+                    bisect.insort(self.tokens, token)
+                else:
+                    self.tokens.append(token)
+            self.postings[token].add(album_id)
+        for tag in tags:
+            self.tags.setdefault(tag, set()).add(album_id)
+
+    def discard(self, album_id):
+        document = self.documents.pop(album_id, None)
+        if document is None:
+            return
+        _, _, name_tokens, artist_tokens, tags = document
+        for token in name_tokens | artist_tokens:
+            self.postings[token].discard(album_id)
+            if not self.postings[token]:
+                del self.postings[token]
+                del self.tokens[bisect.bisect_left(self.tokens, token)]
+        for tag in tags:
+            self.tags[tag].discard(album_id)
+            if not self.tags[tag]:
+                del self.tags[tag]
+
+    def update(self, rows, removed_ids=()):
+        """
+        Index the given rows and drop the removed ids that aren't among them.
+        Returns whether any document changed.
+        """
+        changed = False
+        documents = {album_id: _document(name, artist, tags) for album_id, name, artist, tags, _ in rows}
+        for album_id in set(removed_ids) - set(documents):
+            changed |= album_id in self.documents
+            self.discard(album_id)
+        for album_id, document in documents.items():
+            if self.documents.get(album_id) != document:
+                self.discard(album_id)
+                self.add(album_id, document)
+                changed = True
+        return changed
+
+
+def _build(rows):
+    index = _Postings()
+    for album_id, name, artist, tags, _ in rows:
+        index.add(album_id, _document(name, artist, tags), keep_sorted=False)
+    index.tokens.sort()
+    return index
+
+
+class AlbumIndex:
+    """
+    In-memory index of available albums' name and artist tokens and tags,
+    built in the background and refreshed from the album changes recorded in Redis.
+    """
+
+    def __init__(self, refresh_interval=60, rebuild_interval=3600, refresh_overlap=3600, on_change=None,
+                 redis_connection=None, changes_key='search-index:changed', changes_ttl=3600,
+                 resets_key='search-index:resets'):
+        self.refresh_interval = refresh_interval
+        self.rebuild_interval = rebuild_interval
+        self.refresh_overlap = timedelta(seconds=refresh_overlap)
+        self._index = None
+        self._lock = threading.Lock()
+        self._thread = None
+        self._latest_added = None
+        self.on_change = on_change
+        self.redis = redis_connection
+        self.changes_key = changes_key
+        # longer than refresh_interval
+        self.changes_ttl = changes_ttl
+        self._changes_seen = None
+        self.resets_key = resets_key
+        self._resets_seen = None
+        self._reset = False
+        events.subscribe(events.ALBUMS_ADDED, self._albums_added)
+        events.subscribe(events.ALBUMS_UPDATED, self._albums_updated)
+        events.subscribe(events.ALBUMS_DELETED, self._albums_deleted)
+        events.subscribe(events.ALBUMS_RESET, self._albums_reset)
+
+    def __len__(self):
+        index = self._index
+        return len(index.documents) if index else 0
+
+    @property
+    def ready(self):
+        return self._index is not None
+
+    def _changed(self):
+        if self.on_change:
+            try:
+                self.on_change()
+            except Exception as e:
+                print(f'[search]: failed to report index change: {e}')
+
+    def _albums_added(self, rows):
+        self._record_changes([row[0] for row in rows])
+
+    def _albums_updated(self, album_ids, changes, tags=()):
+        if INDEXED_FIELDS & set(changes):
+            self._record_changes(album_ids)
+
+    def _albums_deleted(self, rows):
+        self._record_changes([row[0] for row in rows])
+
+    def _albums_reset(self):
+        # rebuilt on the next refresh here, and in other processes once they see the count go up
+        self._reset = True
+        if self.redis is not None:
+            try:
+                self.redis.incr(self.resets_key)
+            except redis.RedisError as e:
+                print(f'[redis]: failed to record search index reset: {e}')
+
+    def _record_changes(self, album_ids):
+        if self.redis is None or not album_ids:
+            return
+        now = time.time()
+        try:
+            pipe = self.redis.pipeline()
+            for album_id in album_ids:
+                pipe.zadd(self.changes_key, album_id, now)
+            pipe.expire(self.changes_key, self.changes_ttl)
+            pipe.execute()
+        except redis.RedisError as e:
+            print(f'[redis]: failed to record search index changes: {e}')
+
+    def _recorded_changes(self):
+        """
+        Ids of albums recorded as changed since the last refresh, the time of
+        the newest one and the number of resets recorded.
+        """
+        if self.redis is None:
+            return set(), self._changes_seen, self._resets_seen
+        try:
+            pipe = self.redis.pipeline()
+            pipe.zremrangebyscore(self.changes_key, '-inf', time.time() - self.changes_ttl)
+            # inclusive, since more albums can be recorded with the newest time
+            pipe.zrangebyscore(self.changes_key, self._changes_seen or '-inf', '+inf', withscores=True)
+            pipe.get(self.resets_key)
+            _, changes, resets = pipe.execute()
+        except redis.RedisError as e:
+            print(f'[redis]: search index changes unavailable: {e}')
+            return set(), self._changes_seen, self._resets_seen
+        album_ids = {album_id.decode('utf-8') for album_id, _ in changes}
+        return album_ids, max([score for _, score in changes], default=self._changes_seen), resets
+
+    def rebuild(self):
+        self._reset = False
+        _, changes_seen, resets_seen = self._recorded_changes()
+        rows = albums_model.get_search_documents()
+        index = _build(rows)
+        with self._lock:
+            previous, self._index = self._index, index
+            self._latest_added = max((row[4] for row in rows if row[4]), default=None)
+            self._changes_seen = changes_seen
+            self._resets_seen = resets_seen
+        if previous is None or previous.documents != index.documents:
+            self._changed()
+
+    def refresh(self):
+        """
+        Re-index albums added since the newest album already indexed, with
+        some overlap so tags scraped shortly after an album was added are
+        picked up, and the albums recorded as added, updated or deleted since
+        the last refresh. Those no longer available are dropped. Rebuilds
+        instead if the albums have been reset since the last build.
+        """
+        if self._index is None or self._latest_added is None or self._reset:
+            return self.rebuild()
+        changed_ids, changes_seen, resets_seen = self._recorded_changes()
+        if resets_seen != self._resets_seen:
+            return self.rebuild()
+        rows = albums_model.get_search_documents(added_since=self._latest_added - self.refresh_overlap)
+        if changed_ids:
+            rows = list(rows) + list(albums_model.get_search_documents(album_ids=changed_ids))
+        with self._lock:
+            changed = self._index.update(rows, changed_ids)
+            self._latest_added = max([self._latest_added] + [row[4] for row in rows if row[4]])
+            self._changes_seen = changes_seen
+        if changed:
+            self._changed()
+
+    def _run(self):
+        last_rebuild = None
+        while True:
+            try:
+                if last_rebuild is None or time.monotonic() - last_rebuild >= self.rebuild_interval:
+                    self.rebuild()
+                    last_rebuild = time.monotonic()
+                    print(f'[search]: indexed {len(self)} albums')
+                else:
+                    self.refresh()
+            except DatabaseError as e:
+                print('[db]: failed to refresh search index')
+                print(f'[db]: {e}')
+            time.sleep(self.refresh_interval)
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            with self._lock:
+                if self._thread is None or not self._thread.is_alive():
+                    self._thread = threading.Thread(target=self._run, name='album-index', daemon=True)
+                    self._thread.start()
+
+    def search(self, query, limit=None):
+        """
+        Album ids matching query, best match first, or None if the index has
+        not been built yet. With a limit only the best `limit` ids are
+        ranked and returned.
+
+        An album matches if every query token is a prefix of one of its name
+        or artist tokens, or if the whole query is one of its tags.
+        """
+        self.start()
+        if self._index is None:
+            return None
+        query = query.lower().strip()
+        query_tokens = tokenize(query)
+        if not query_tokens:
+            return []
+        # refreshes patch the index in place, so read it under the lock and rank outside it
+        with self._lock:
+            index = self._index
+            token_matches = None
+            for token in query_tokens:
+                matches = index.prefix_matches(token)
+                token_matches = matches if token_matches is None else token_matches & matches
+                if not token_matches:
+                    break
+            token_matches = token_matches or set()
+            tag_matches = set(index.tags.get(query, ()))
+            documents = {album_id: index.documents[album_id] for album_id in token_matches | tag_matches}
+        query_tokens = set(query_tokens)
+        ranked = []
+        for album_id in token_matches:
+            name, artist, name_tokens, artist_tokens, tags = documents[album_id]
+            if query == name or query == artist:
+                score = 8
+            elif query in name or query in artist:
+                score = 4
+            else:
+                score = 0
+            score += 2 * len(query_tokens & (name_tokens | artist_tokens))
+            if album_id in tag_matches:
+                score += 3
+            # best score first, then alphabetically by artist and name
+            ranked.append((-score, artist, name, album_id))
+        for album_id in tag_matches - token_matches:
+            name, artist = documents[album_id][:2]
+            ranked.append((-3, artist, name, album_id))
+        if limit is not None and limit < len(ranked):
+            ranked = heapq.nsmallest(limit, ranked)
+        else:
+            ranked.sort()
+        return [album_id for _, _, _, album_id in ranked]
@@ -1,13 +1,15 @@
 import logging
 import os
 import sys
+import threading
 
 import flask
 from flask_cacheify import init_cacheify
 from pathlib import Path
 
+from albumlist import invalidation, membership, randomizer, search, stats
 from albumlist.models import DatabaseError
-from albumlist.models import albums as albums_model, list as list_model
+from albumlist.models import albums as albums_model, list as list_model, migrations
 
 
 def add_blueprints(application):
@@ -24,6 +26,14 @@ def add_blueprints(application):
     slack_blueprint.config = application.config.copy()
 
 
+def apply_migrations(app):
+    try:
+        for migration in migrations.apply_migrations():
+            app.logger.info(f'[db]: applied migration {migration.version}: {migration.name}')
+    except DatabaseError as e:
+        app.logger.error(f'[db]: migration ERROR - {e}')
+
+
 def create_tables(app):
     try:
         list_model.create_list_table()
@@ -31,6 +41,9 @@ def create_tables(app):
         albums_model.create_albums_index()
     except DatabaseError as e:
         app.logger.error(f'[db]: ERROR - {e}')
+    else:
+        # concurrent index builds can outlast the boot timeout, so run them in the background
+        threading.Thread(target=apply_migrations, args=(app, ), name='migrations', daemon=True).start()
 
 
 def create_app():
@@ -50,19 +63,25 @@ def create_app():
 
     add_blueprints(app)
 
+    from albumlist.delayed import redis_connection
+
     app.cache = init_cacheify(app)
+    # deletes cached responses as this process's writes change the albums they were built from
+    app.cache_dependencies = invalidation.CacheDependencies(app.cache, redis_connection)
 
     app.db_error_message = f'{LIST_NAME} error - check with admin'
     app.not_found_message = f'Album not found in the {LIST_NAME}'
 
     def get_and_set_album_details(album_id):
+        token = flask.current_app.cache_dependencies.token()
         try:
             details = albums_model.get_album_details(album_id)
         except DatabaseError as e:
             flask.current_app.cache.delete('alb-' + album_id)
             raise e
         else:
-            flask.current_app.cache.set('alb-' + album_id, details, 60 * 15)
+            flask.current_app.cache_dependencies.set('alb-' + album_id, details, 60 * 60 * 24, token,
+                                                     albums=[album_id])
         return details
 
     def get_cached_album_details(album_id):
@@ -71,6 +90,22 @@ def create_app():
     app.get_and_set_album_details = get_and_set_album_details
     app.get_cached_album_details = get_cached_album_details
 
+    # records the albums this process updates or deletes for every process's index to re-read
+    app.album_index = search.AlbumIndex(
+        refresh_interval=app.config['SEARCH_INDEX_REFRESH'],
+        rebuild_interval=app.config['SEARCH_INDEX_REBUILD'],
+        on_change=lambda: app.cache_dependencies.invalidate(collections=['search']),
+        redis_connection=redis_connection,
+    )
+    # subscribes the Redis mirror of list ids to list changes made by this process
+    app.list_membership = membership.ListMembership(
+        redis_connection if app.config['LIST_MEMBERSHIP_REDIS'] else None,
+        ttl=app.config['LIST_MEMBERSHIP_TTL'],
+    )
+    # likewise kept up to date by this process's writes
+    app.album_stats = stats.AlbumStats(redis_connection, ttl=app.config['ALBUM_STATS_TTL'])
+    app.random_albums = randomizer.RandomAlbumPicker(refresh_interval=app.config['RANDOM_ALBUMS_REFRESH'])
+
     app.logger.info(f'[app]: created with {os.environ["APP_SETTINGS"]}')
 
     from albumlist.delayed import queued
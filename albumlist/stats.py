@@ -0,0 +1,142 @@
+import collections
+import threading
+
+import redis
+
+from albumlist.models import events
+from albumlist.models import stats as stats_model
+
+
+class AlbumStats:
+    """
+    Album and list counts, and album counts by channel, year and tag, kept
+    in Redis hashes and updated from the model events.
+    """
+
+    SECTIONS = ('totals', ) + tuple(stats_model.BREAKDOWNS)
+
+    def __init__(self, redis_connection, prefix='album-stats', ttl=3600):
+        self.redis = redis_connection
+        self.prefix = prefix
+        self.ttl = ttl
+        self._load_lock = threading.Lock()
+        events.subscribe(events.LIST_ADDED, self._list_added)
+        events.subscribe(events.LIST_DELETED, self._list_deleted)
+        events.subscribe(events.LIST_RESET, self._list_reset)
+        events.subscribe(events.ALBUMS_ADDED, self._albums_added)
+        events.subscribe(events.ALBUMS_UPDATED, self._albums_updated)
+        events.subscribe(events.ALBUMS_DELETED, self._albums_deleted)
+        events.subscribe(events.ALBUMS_RESET, self._albums_reset)
+
+    def key(self, section):
+        return f'{self.prefix}:{section}'
+
+    def ready_key(self, section):
+        return f'{self.prefix}:{section}:ready'
+
+    @staticmethod
+    def _query(section):
+        if section == 'totals':
+            return stats_model.get_totals()
+        return stats_model.get_breakdown(section)
+
+    def _load(self, sections):
+        loaded = {section: self._query(section) for section in sections}
+        pipe = self.redis.pipeline()
+        for section, values in loaded.items():
+            pipe.delete(self.key(section))
+            if values:
+                pipe.hmset(self.key(section), values)
+            pipe.set(self.ready_key(section), 1, ex=self.ttl)
+        pipe.execute()
+        return loaded
+
+    def get(self, sections=SECTIONS):
+        """
+        A dict of the given sections, each a dict of group (or total) to count.
+        """
+        try:
+            pipe = self.redis.pipeline(transaction=False)
+            for section in sections:
+                pipe.exists(self.ready_key(section))
+                pipe.hgetall(self.key(section))
+            results = pipe.execute()
+        except redis.RedisError as e:
+            print(f'[redis]: album stats unavailable: {e}')
+            return {section: self._query(section) for section in sections}
+        stats, missing = {}, []
+        for i, section in enumerate(sections):
+            if results[2 * i]:
+                stats[section] = {
+                    k.decode('utf-8'): int(v) for k, v in results[2 * i + 1].items() if int(v) > 0
+                }
+            else:
+                missing.append(section)
+        if missing:
+            with self._load_lock:
+                try:
+                    stats.update(self._load(missing))
+                except redis.RedisError as e:
+                    print(f'[redis]: failed to store album stats: {e}')
+                    stats.update({section: self._query(section) for section in missing})
+        return stats
+
+    def totals(self):
+        return self.get(('totals', ))['totals']
+
+    def invalidate(self, *sections):
+        self.redis.delete(*[self.ready_key(section) for section in sections or self.SECTIONS])
+
+    def _increment(self, increments):
+        pipe = self.redis.pipeline()
+        for (section, group), amount in increments.items():
+            if amount:
+                pipe.hincrby(self.key(section), group, amount)
+        pipe.execute()
+
+    def _list_added(self, album_ids):
+        if album_ids:
+            self._increment({('totals', 'list'): len(album_ids)})
+
+    def _list_deleted(self, album_ids):
+        if album_ids:
+            self._increment({('totals', 'list'): -len(album_ids)})
+
+    def _list_reset(self):
+        self.invalidate('totals')
+
+    def _albums_added(self, rows):
+        increments = collections.Counter({('totals', 'albums'): len(rows)})
+        for _, channel, added in rows:
+            increments['channels', channel or ''] += 1
+            year = stats_model.added_year(added)
+            if year:
+                increments['added_years', year] += 1
+        self._increment(increments)
+
+    def _albums_updated(self, album_ids, changes, tags=()):
+        available = changes.get('available')
+        if available is not None:
+            self._increment({('totals', 'unavailable'): -len(album_ids) if available else len(album_ids)})
+        stale = [section for field, section in (('added', 'added_years'), ('released', 'released_years'),
+                                                ('tags', 'tags'), ('channel', 'channels')) if field in changes]
+        if stale:
+            self.invalidate(*stale)
+
+    def _albums_deleted(self, rows):
+        increments = collections.Counter({('totals', 'albums'): -len(rows)})
+        for _, channel, added, available, released, tags in rows:
+            increments['channels', channel or ''] -= 1
+            if not available:
+                increments['totals', 'unavailable'] -= 1
+            for section, year in (('added_years', stats_model.added_year(added)),
+                                  ('released_years', stats_model.released_year(released))):
+                if year:
+                    increments[section, year] -= 1
+            for tag in tags or []:
+                increments['tags', tag] -= 1
+        self._increment(increments)
+
+    def _albums_reset(self):
+        self.invalidate()
+
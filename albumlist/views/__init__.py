@@ -1,3 +1,6 @@
+import json
+
+
 def get_embedded_url(album_id):
     return f'https://bandcamp.com/EmbeddedPlayer/album={album_id}/size=large/bgcol=000000'
 
@@ -152,6 +155,26 @@ def build_my_list_attachment():
     ]
 
 
+def build_next_page_attachment(kind, query, after, offset):
+    return [
+        {
+            "text": f"Results {offset + 1} onwards",
+            "fallback": "Next page is not accessible",
+            "callback_id": "next_page_action",
+            "color": "#3AA3E3",
+            "attachment_type": "default",
+            "actions": [
+                {
+                    'name': 'next_page',
+                    'text': 'Next page',
+                    'type': 'button',
+                    'value': json.dumps({'kind': kind, 'query': query, 'after': after, 'offset': offset}),
+                },
+            ]
+        }
+    ]
+
+
 def build_slack_modal(trigger_id, album_url):
     return {
         "trigger_id": trigger_id,
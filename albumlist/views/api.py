@@ -1,13 +1,17 @@
+import base64
+import binascii
 import csv
 import flask
 import io
 import itertools
+import zlib
+from datetime import datetime
 
-from albumlist import constants
+from albumlist import constants, delayed
 from albumlist.delayed import queued
-from albumlist.models import DatabaseError
+from albumlist.models import DatabaseError, pool_stats
 from albumlist.models import albums as albums_model, list as list_model
-from albumlist.scrapers import bandcamp, links
+from albumlist.scrapers import bandcamp, fetch, links
 
 
 api_blueprint = flask.Blueprint(name='api',
@@ -35,66 +39,187 @@ def api_list_albums():
 @api_blueprint.route('/list/count', methods=['GET'])
 def api_id_count():
     try:
-        return flask.jsonify({'count': list_model.get_list_count()}), 200
+        return flask.jsonify({'count': flask.current_app.album_stats.totals().get('list', 0)}), 200
     except DatabaseError as e:
         print('[db]: failed to get list count')
         print(f'[db]: {e}')
         return flask.jsonify({'text': 'failed'}), 500
 
 
+ALBUMS_PAGE_SIZE = 100
+ALBUMS_MAX_PAGE_SIZE = 500
+ALBUMS_PAGE_PARAMS = ('after', 'limit', 'year', 'mode', 'tag', 'available')
+ALBUMS_MODES = ('added', 'released')
+
+
+class InvalidParameter(ValueError):
+    pass
+
+
+def encode_cursor(album):
+    if album.added is None:
+        # get_albums_page only returns albums with added dates, which the cursor is built from
+        return None
+    cursor = f'{album.added.isoformat()}|{album.album_id}'
+    return base64.urlsafe_b64encode(cursor.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    try:
+        added, album_id = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode('utf-8').split('|', 1)
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise InvalidParameter('invalid cursor')
+    for added_format in ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S'):
+        try:
+            return datetime.strptime(added, added_format), album_id
+        except ValueError:
+            continue
+    raise InvalidParameter('invalid cursor')
+
+
+def _albums_page_filters(args):
+    filters = {'channel': args.get('channel'), 'tag': args.get('tag'), 'mode': args.get('mode', 'added')}
+    if filters['mode'] not in ALBUMS_MODES:
+        raise InvalidParameter(f'mode must be one of {", ".join(ALBUMS_MODES)}')
+    try:
+        filters['year'] = int(args['year']) if args.get('year') else None
+        limit = int(args.get('limit', ALBUMS_PAGE_SIZE))
+    except ValueError:
+        raise InvalidParameter('year and limit must be numbers')
+    if filters['year'] is not None and not 1 <= filters['year'] < 9999:
+        raise InvalidParameter('year must be between 1 and 9998')
+    filters['limit'] = max(1, min(limit, ALBUMS_MAX_PAGE_SIZE))
+    available = args.get('available')
+    if available is not None and available not in ('true', 'false'):
+        raise InvalidParameter('available must be true or false')
+    filters['available'] = None if available is None else available == 'true'
+    filters['after'] = decode_cursor(args['after']) if args.get('after') else None
+    return filters
+
+
+def api_albums_page():
+    """
+    A page of albums filtered by year (of the mode, added or released),
+    channel, tag and availability, with the cursor of the next page.
+    """
+    args = flask.request.args
+    try:
+        filters = _albums_page_filters(args)
+    except InvalidParameter as e:
+        return flask.jsonify({'text': str(e)}), 400
+    key = 'api-albums-page-' + '&'.join(f'{name}={args[name]}' for name in sorted(args))
+    try:
+        page = flask.current_app.cache.get(key)
+        if not page:
+            token = flask.current_app.cache_dependencies.token()
+            albums = albums_model.get_albums_page(**filters)
+            page = {
+                'albums': [album.to_dict() for album in albums],
+                'next': encode_cursor(albums[-1]) if len(albums) == filters['limit'] else None,
+            }
+            flask.current_app.cache_dependencies.set(key, page, 60 * 60, token, collections=['albums'])
+        return flask.jsonify(page), 200
+    except DatabaseError as e:
+        print('[db]: failed to get albums page')
+        print(f'[db]: {e}')
+        return flask.jsonify({'text': 'failed'}), 500
+
+
 @api_blueprint.route('/albums', methods=['GET'])
 def api_list_album_details():
-    channel = flask.request.args.get('channel')
-    if channel:
-        albums = albums_model.get_albums_by_channel_with_tags(channel)
-        key = f'api-albums-{channel}'
-    else:
-        albums = albums_model.get_albums_with_tags()
-        key = 'api-albums'
+    if any(name in flask.request.args for name in ALBUMS_PAGE_PARAMS):
+        return api_albums_page()
+    channel = flask.request.args.get('channel') or None
+    key = f'api-albums-json-{channel}' if channel else 'api-albums-json'
     try:
         details = flask.current_app.cache.get(key)
         if not details:
-            details = albums_model.Album.details_map_from_albums(albums)
-            details = [{key: d} for key, d in details.items()]
-            flask.current_app.cache.set(key, details, 60 * 5)
-        return flask.jsonify(details), 200
+            token = flask.current_app.cache_dependencies.token()
+            # built as JSON by the database rather than through thousands of Albums
+            details = albums_model.get_albums_details_json(channel)
+            flask.current_app.cache_dependencies.set(key, details, 60 * 60, token, collections=['albums'])
+        return flask.Response(details, mimetype='application/json'), 200
     except DatabaseError as e:
         print('[db]: failed to get albums')
         print(f'[db]: {e}')
         return flask.jsonify({'text': 'failed'}), 500
 
 
+@api_blueprint.route('/albums/years', methods=['GET'])
+def api_album_years():
+    mode = flask.request.args.get('mode', 'added')
+    if mode not in ALBUMS_MODES:
+        return flask.jsonify({'text': f'mode must be one of {", ".join(ALBUMS_MODES)}'}), 400
+    section = f'{mode}_years'
+    try:
+        years = flask.current_app.album_stats.get((section, ))[section]
+        return flask.jsonify({'mode': mode, 'years': sorted(int(year) for year in years)}), 200
+    except DatabaseError as e:
+        print('[db]: failed to get album years')
+        print(f'[db]: {e}')
+        return flask.jsonify({'text': 'failed'}), 500
+
+
 @api_blueprint.route('/albums/count', methods=['GET'])
 def api_count_albums():
     try:
-        return flask.jsonify({'count': albums_model.get_albums_count()}), 200
+        return flask.jsonify({'count': flask.current_app.album_stats.totals().get('albums', 0)}), 200
     except DatabaseError as e:
         print('[db]: failed to get albums count')
         print(f'[db]: {e}')
         return flask.jsonify({'text': 'failed'}), 500
 
 
-@api_blueprint.route('/albums/dump', methods=['GET'])
-def api_dump_album_details():
-    # need StringIO for csv.writer
+def stream_csv(albums, fieldnames, compress=False, rows_per_chunk=500):
+    # csv.writer needs a file, so write rows into a small buffer and drain it
     proxy = io.StringIO()
-    albums = albums_model.get_albums_with_users()
-    first_album = next(albums)
-    csv_writer = csv.DictWriter(proxy, fieldnames=first_album.fieldnames)
+    csv_writer = csv.DictWriter(proxy, fieldnames=fieldnames, extrasaction='ignore')
+    compressor = zlib.compressobj(wbits=zlib.MAX_WBITS | 16) if compress else None
+
+    def drain():
+        chunk = proxy.getvalue().encode('utf-8')
+        proxy.seek(0)
+        proxy.truncate()
+        return compressor.compress(chunk) if compressor else chunk
+
     csv_writer.writeheader()
-    for album in itertools.chain([first_album], albums):
+    for i, album in enumerate(albums, 1):
         csv_writer.writerow(album.to_dict())
-    # and BytesIO for flask.send_file
-    mem = io.BytesIO()
-    mem.write(proxy.getvalue().encode('utf-8'))
-    mem.seek(0)
-    proxy.close()
-    # see: https://stackoverflow.com/a/45111660
-    return flask.send_file(mem,
-                           as_attachment=True,
-                           attachment_filename="albums.csv",
-                           mimetype='text/csv',
-                           cache_timeout=0 if flask.request.args.get('fresh') else None)
+        if i % rows_per_chunk == 0:
+            yield drain()
+    yield drain()
+    if compressor:
+        yield compressor.flush()
+
+
+@api_blueprint.route('/albums/dump', methods=['GET'])
+def api_dump_album_details():
+    fieldnames = albums_model.Album.FIELDNAMES
+    columns = flask.request.args.get('columns')
+    if columns:
+        columns = [column.strip() for column in columns.split(',') if column.strip()]
+        unknown = [column for column in columns if column not in fieldnames]
+        if unknown or not columns:
+            return flask.jsonify({'text': f'unknown columns: {", ".join(unknown)}', 'columns': fieldnames}), 400
+        fieldnames = columns
+    compress = bool(flask.request.args.get('gzip'))
+    albums = albums_model.iter_albums_with_users()
+    try:
+        # start the query before committing to a 200 response
+        first_album = next(albums, None)
+    except DatabaseError as e:
+        print('[db]: failed to dump albums')
+        print(f'[db]: {e}')
+        return flask.jsonify({'text': 'failed'}), 500
+    if first_album is not None:
+        albums = itertools.chain([first_album], albums)
+    response = flask.Response(stream_csv(albums, fieldnames, compress=compress),
+                              mimetype='application/gzip' if compress else 'text/csv')
+    filename = 'albums.csv.gz' if compress else 'albums.csv'
+    response.headers['Content-Disposition'] = f'attachment; filename={filename}'
+    if flask.request.args.get('fresh'):
+        response.headers['Cache-Control'] = 'no-cache'
+    return response
 
 
 @api_blueprint.route('/album/<album_id>', methods=['GET'])
@@ -140,10 +265,12 @@ def api_album_by_tag(tag):
     try:
         details = flask.current_app.cache.get(key)
         if not details:
-            albums = albums_model.get_albums_by_tag(tag)
+            token = flask.current_app.cache_dependencies.token()
+            albums = list(albums_model.get_albums_by_tag(tag))
             details = albums_model.Album.details_map_from_albums(albums)
             details = [{key: d} for key, d in details.items()]
-            flask.current_app.cache.set(key, details, 60 * 30)
+            flask.current_app.cache_dependencies.set(key, details, 60 * 60 * 24, token,
+                                                     albums=[album.album_id for album in albums], tags=[tag])
         return flask.jsonify(details), 200
     except DatabaseError as e:
         print(f'[db]: failed to get tag: {tag}')
@@ -159,7 +286,10 @@ def api_bc(album_id):
 @api_blueprint.route('/albums/random', methods=['GET'])
 def api_random():
     try:
-        album = albums_model.get_random_album()
+        album = flask.current_app.random_albums.random_album(
+            tag=flask.request.args.get('tag'),
+            weighted=bool(flask.request.args.get('weighted')),
+        )
         if album is None:
             return flask.jsonify({'text': 'not found'}), 404
         response = {
@@ -179,8 +309,9 @@ def available_urls():
         key = 'api-albums-available-urls'
         urls = flask.current_app.cache.get(key)
         if not urls:
+            token = flask.current_app.cache_dependencies.token()
             urls = [album.album_url for album in albums_model.get_albums_available()]
-            flask.current_app.cache.set(key, urls, 60 * 30)
+            flask.current_app.cache_dependencies.set(key, urls, 60 * 60 * 24, token, collections=['album-urls'])
         return flask.jsonify(urls), 200
     except DatabaseError as e:
         print('[db]: failed to get album urls')
@@ -191,13 +322,23 @@ def available_urls():
 @api_blueprint.route('/albums/unavailable/count', methods=['GET'])
 def unavailable_count():
     try:
-        return flask.jsonify({'count': albums_model.get_albums_unavailable_count()}), 200
+        return flask.jsonify({'count': flask.current_app.album_stats.totals().get('unavailable', 0)}), 200
     except DatabaseError as e:
         print('[db]: failed to get unavailable albums count')
         print(f'[db]: {e}')
         return flask.jsonify({'text': 'failed'}), 500
 
 
+@api_blueprint.route('/stats', methods=['GET'])
+def api_stats():
+    try:
+        return flask.jsonify(flask.current_app.album_stats.get()), 200
+    except DatabaseError as e:
+        print('[db]: failed to get album stats')
+        print(f'[db]: {e}')
+        return flask.jsonify({'text': 'failed'}), 500
+
+
 @api_blueprint.route('/albums/scrape', methods=['POST'])
 def scrape_album():
     form_data = flask.request.form
@@ -211,6 +352,36 @@ def scrape_album():
     return 'OK', 200
 
 
+@api_blueprint.route('/db/pool', methods=['GET'])
+def db_pool():
+    return flask.jsonify(pool_stats()), 200
+
+
+@api_blueprint.route('/scrapers/cache', methods=['GET'])
+def scraper_cache():
+    return flask.jsonify(fetch.cache_stats()), 200
+
+
+def _public_group(group):
+    # the response url lets anyone post to the channel it came from
+    return {k: v for k, v in group.items() if k != 'response_url'}
+
+
+@api_blueprint.route('/jobs', methods=['GET'])
+def job_groups():
+    limit = flask.request.args.get('limit', 20, type=int)
+    groups = delayed.broker.groups.recent(limit=max(1, min(limit, 100)))
+    return flask.jsonify({'groups': [_public_group(group) for group in groups]}), 200
+
+
+@api_blueprint.route('/jobs/<group_id>', methods=['GET'])
+def job_group(group_id):
+    group = delayed.broker.groups.get(group_id)
+    if group is None:
+        return flask.jsonify({'text': 'not found'}), 404
+    return flask.jsonify(_public_group(group)), 200
+
+
 @api_blueprint.route('', methods=['GET'])
 def all_endpoints():
     rules = [ 
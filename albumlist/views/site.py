@@ -1,8 +1,8 @@
 import flask
 import jinja2
 
+from albumlist import metrics
 from albumlist.models import DatabaseError
-from albumlist.models import albums as albums_model
 
 
 site_blueprint = flask.Blueprint(name='site',
@@ -14,13 +14,14 @@ site_blueprint = flask.Blueprint(name='site',
 def covers_view():
     list_name = site_blueprint.config['LIST_NAME']
     albums_url = flask.url_for('api.api_list_album_details', _external=True, _scheme="https")
-    return flask.render_template('covers.html', list_name=list_name, albums_url=albums_url)
+    years_url = flask.url_for('api.api_album_years', _external=True, _scheme="https")
+    return flask.render_template('covers.html', list_name=list_name, albums_url=albums_url, years_url=years_url)
 
 
 @site_blueprint.route('/', methods=['GET'])
 def embedded_random():
     try:
-        album = albums_model.get_random_album()
+        album = flask.current_app.random_albums.random_album()
     except DatabaseError as e:
         print('[db]: failed to get random album')
         print(f'[db]: {e}')
@@ -41,6 +42,13 @@ def embedded_random():
     return '', 200
 
 
+@site_blueprint.route('/metrics', methods=['GET'])
+def metrics_view():
+    if not metrics.is_authorized(flask.request.headers.get('Authorization'), site_blueprint.config.get('METRICS_TOKEN')):
+        return 'Unauthorized', 401
+    return flask.Response(metrics.render(), mimetype=metrics.CONTENT_TYPE)
+
+
 @site_blueprint.route('/js/bookmarklet', methods=['GET'])
 def bookmarklet():
     template = jinja2.Template("""
@@ -8,11 +8,12 @@ import requests
 import slacker
 
 from albumlist import constants
+from albumlist import delayed
 from albumlist.delayed import queued
 from albumlist.models import DatabaseError
 from albumlist.models import albums as albums_model, list as list_model
 from albumlist.scrapers import NotFoundError, bandcamp, links
-from albumlist.views import build_attachment, build_my_list_attachment, build_slack_modal
+from albumlist.views import build_attachment, build_my_list_attachment, build_next_page_attachment, build_slack_modal
 
 
 slack_blueprint = flask.Blueprint(name='slack',
@@ -142,7 +143,42 @@ def scrape_artist():
 @slack_blueprint.route('/count', methods=['POST'])
 @slack_check
 def album_count():
-    return str(albums_model.get_albums_count()), 200
+    try:
+        return str(flask.current_app.album_stats.totals().get('albums', 0)), 200
+    except DatabaseError as e:
+        print('[db]: failed to get albums count')
+        print(f'[db]: {e}')
+        return flask.current_app.db_error_message, 200
+
+
+STATS_TOP = 5
+
+
+def _top(counts, n=STATS_TOP):
+    return ', '.join(f'{group or "unknown"} ({count})'
+                     for group, count in sorted(counts.items(), key=lambda item: (-item[1], item[0]))[:n])
+
+
+@slack_blueprint.route('/stats', methods=['POST'])
+@slack_check
+def album_stats():
+    try:
+        stats = flask.current_app.album_stats.get()
+    except DatabaseError as e:
+        print('[db]: failed to get album stats')
+        print(f'[db]: {e}')
+        return flask.current_app.db_error_message, 200
+    totals = stats['totals']
+    list_name = slack_blueprint.config['LIST_NAME']
+    lines = [
+        f'*{list_name}*: {totals.get("list", 0)} in the list, {totals.get("albums", 0)} albums, '
+        f'{totals.get("unavailable", 0)} unavailable',
+        f'*Channels*: {_top(stats["channels"])}',
+        f'*Tags*: {_top(stats["tags"], n=STATS_TOP * 2)}',
+        f'*Added*: {", ".join(f"{year} ({count})" for year, count in sorted(stats["added_years"].items()))}',
+        f'*Released*: {_top(stats["released_years"])}',
+    ]
+    return '\n'.join(lines), 200
 
 
 @slack_blueprint.route('/delete', methods=['POST'])
@@ -204,6 +240,7 @@ def scrape():
                 slack_token,
                 channel_name=channel_name,
                 response_url=response,
+                full='full' in contents.split(),
             )
             flask.current_app.logger.info(f'[slack]: scrape request sent for #{channel_name}')
     return 'Scrape request(s) sent', 200
@@ -290,10 +327,42 @@ def process_attribution():
     slack_token = slack_blueprint.config['SLACK_OAUTH_TOKEN']
     if not slack_token:
         return 'Requires API scope', 200
-    queued.deferred_attribute_users_to_all_album_urls(slack_token, response_url=response)
+    queued.deferred_attribute_users_to_all_album_urls.delay(slack_token, response_url=response)
     return 'Process request sent', 200
 
 
+@slack_blueprint.route('/jobs/dead', methods=['POST'])
+@slack_check
+@admin_only
+def dead_jobs():
+    try:
+        limit = int(flask.request.form.get('text', '').strip() or 10)
+    except ValueError:
+        return 'Usage: /dead_jobs [count]', 200
+    entries, total = delayed.broker.dead_letters(limit=limit)
+    stats = delayed.broker.stats()
+    lines = [f'{total} dead jobs, {stats["queued"]} queued, {stats["retrying"]} waiting to retry']
+    for entry in entries:
+        if isinstance(entry, delayed.jobs.Job):
+            lines.append(f'• `{entry.task}` {entry.args} failed {entry.attempts} times: {entry.error}')
+        else:
+            lines.append(f'• undecodable job ({len(entry)} bytes)')
+    return '\n'.join(lines), 200
+
+
+@slack_blueprint.route('/jobs/requeue', methods=['POST'])
+@slack_check
+@admin_only
+def requeue_dead_jobs():
+    text = flask.request.form.get('text', '').strip()
+    try:
+        limit = None if text in ('', 'all') else int(text)
+    except ValueError:
+        return 'Usage: /requeue_jobs [count|all]', 200
+    requeued = delayed.broker.requeue_dead(limit=limit)
+    return f'Requeued {requeued} dead jobs', 200
+
+
 @slack_blueprint.route('/link', methods=['POST'])
 @slack_check
 def link():
@@ -321,8 +390,13 @@ def link():
 @slack_check
 def random_album():
     form_data = flask.request.form
+    text = form_data.get('text', '')
+    tags = [word[1:].lower() for word in text.split() if word.startswith('#') and len(word) > 1]
     try:
-        album = albums_model.get_random_album()
+        album = flask.current_app.random_albums.random_album(
+            tag=tags[0] if tags else None,
+            weighted='weighted' in text,
+        )
         if album is None:
             return flask.current_app.not_found_message, 404
     except DatabaseError as e:
@@ -330,7 +404,7 @@ def random_album():
         flask.current_app.logger.error(f'[db]: {e}')
         return flask.current_app.db_error_message, 500
     else:
-        if 'post' in form_data.get('text', ''):
+        if 'post' in text:
             response = {
                 'response_type': 'in_channel',
                 'text': f'{album.album_url}',
@@ -353,24 +427,91 @@ def random_album():
 
 
 def build_search_response(albums, list_name, max_attachments=None, delete=False, add_to_my_list=False,
-                          remove_from_my_list=False):
-    details = albums_model.Album.details_map_from_albums(albums)
+                          remove_from_my_list=False, total=None, offset=0, next_page=None):
+    """
+    Attachments for at most max_attachments of albums. When albums is one
+    page of a search, total is the number of albums that matched, offset
+    the number on earlier pages and next_page the (kind, query) passed to
+    search_page for a button that shows the following page.
+    """
+    details = list(albums_model.Album.details_map_from_albums(albums).items())
+    total = len(details) if total is None else total
+    shown = details[:max_attachments]
     attachments = [
         build_attachment(album_id, album_details, list_name,
                          add_to_my_list=add_to_my_list,
                          remove_from_my_list=remove_from_my_list,
                          delete=delete)
-        for album_id, album_details in details.items()
+        for album_id, album_details in shown
     ]
-    text = f'Your {list_name} search returned {len(details)} results'
-    if max_attachments and len(details) > max_attachments:
+    text = f'Your {list_name} search returned {total} results'
+    if next_page and shown and offset + len(shown) < total:
+        text += f' (showing {offset + 1} to {offset + len(shown)})'
+        attachments += build_next_page_attachment(*next_page, after=shown[-1][0], offset=offset + len(shown))
+    elif max_attachments and total > max_attachments:
         text += f' (but we can only show you {max_attachments})'
     return {
         'text': text,
-        'attachments': attachments[:max_attachments],
+        'attachments': attachments,
     }
 
 
+def search_page(kind, query, limit, after=None, offset=0):
+    """
+    One page of a 'search', 'tag' or 'my_list' (query is the user id)
+    search: at most limit albums, and how many albums matched in all.
+    Ranked searches are paged by offset, the others by album id, after
+    being the last album id of the previous page.
+    """
+    if kind == 'search':
+        album_ids = flask.current_app.album_index.search(query)
+        if album_ids is None:
+            albums = list(albums_model.search_albums(query, limit=limit, offset=offset))
+            total = albums_model.search_albums_count(query)
+        else:
+            albums = albums_model.get_album_details_with_tags_from_ids(album_ids[offset:offset + limit])
+            total = len(album_ids)
+    elif kind == 'tag':
+        albums = list(albums_model.search_albums_by_tag(query, after=after, limit=limit))
+        total = albums_model.search_albums_by_tag_count(query)
+    elif kind == 'my_list':
+        albums = list(albums_model.get_albums_by_user(query, after=after, limit=limit))
+        total = albums_model.get_albums_by_user_count(query)
+    else:
+        raise ValueError(f'unknown search: {kind}')
+    return albums, total
+
+
+def build_search_page_response(kind, query, list_name, after=None, offset=0, reserved=1, **options):
+    """
+    The albums of one page of a search and its Slack response, leaving room
+    for `reserved` attachments of buttons within SLACK_MAX_ATTACHMENTS.
+    """
+    limit = max(1, slack_blueprint.config['SLACK_MAX_ATTACHMENTS'] - reserved)
+    albums, total = search_page(kind, query, limit, after=after, offset=offset)
+    response = build_search_response(albums, list_name, limit, total=total, offset=offset,
+                                     next_page=(kind, query), **options)
+    return albums, response
+
+
+def build_my_list_response(user, after=None, offset=0):
+    albums, response = build_search_page_response('my_list', user, 'My List', after=after, offset=offset,
+                                                  reserved=2, add_to_my_list=False, remove_from_my_list=True)
+    response['attachments'] += build_my_list_attachment()
+    return response
+
+
+def get_tag_search_response(query):
+    response = flask.current_app.cache.get(f't-{query}')
+    if not response:
+        token = flask.current_app.cache_dependencies.token()
+        list_name = slack_blueprint.config['LIST_NAME']
+        albums, response = build_search_page_response('tag', query, list_name)
+        flask.current_app.cache_dependencies.set(f't-{query}', response, 60 * 60 * 24, token,
+                                                  albums=[album.album_id for album in albums], tags=[query])
+    return response
+
+
 def build_bandcamp_search_response(album_details, max_attachments=None):
     album_map = {
         result_id: {
@@ -402,17 +543,18 @@ def search():
     if query:
         response = flask.current_app.cache.get(f'q-{query}')
         if not response:
+            token = flask.current_app.cache_dependencies.token()
             try:
-                albums = albums_model.search_albums(query)
+                list_name = slack_blueprint.config['LIST_NAME']
+                albums, response = build_search_page_response('search', query, list_name)
             except DatabaseError as e:
                 flask.current_app.logger.error('[db]: failed to build album details')
                 flask.current_app.logger.error(f'[db]: {e}')
                 return 'failed to perform search', 500
             else:
-                max_attachments = slack_blueprint.config['SLACK_MAX_ATTACHMENTS']
-                list_name = slack_blueprint.config['LIST_NAME']
-                response = build_search_response(albums, list_name, max_attachments)
-                flask.current_app.cache.set(f'q-{query}', response, 60 * 5)
+                flask.current_app.cache_dependencies.set(f'q-{query}', response, 60 * 60, token,
+                                                          albums=[album.album_id for album in albums],
+                                                          tags=[query], collections=['search'])
         return flask.jsonify(response), 200
     return '', 200
 
@@ -442,19 +584,12 @@ def search_tags():
     form_data = flask.request.form
     query = form_data.get('text').lower()
     if query:
-        response = flask.current_app.cache.get(f't-{query}')
-        if not response:
-            try:
-                albums = albums_model.search_albums_by_tag(query)
-            except DatabaseError as e:
-                flask.current_app.logger.error('[db]: failed to build album details')
-                flask.current_app.logger.error(f'[db]: {e}')
-                return 'failed to perform search', 500
-            else:
-                max_attachments = slack_blueprint.config['SLACK_MAX_ATTACHMENTS']
-                list_name = slack_blueprint.config['LIST_NAME']
-                response = build_search_response(albums, list_name, max_attachments)
-                flask.current_app.cache.set(f't-{query}', response, 60 * 15)
+        try:
+            response = get_tag_search_response(query)
+        except DatabaseError as e:
+            flask.current_app.logger.error('[db]: failed to build album details')
+            flask.current_app.logger.error(f'[db]: {e}')
+            return 'failed to perform search', 500
         return flask.jsonify(response), 200
     return '', 200
 
@@ -525,7 +660,7 @@ def handle_message_action(payload):
             album = albums_model.get_album_details_by_url(url)
             if album:
                 random_tag_to_use = random.choice(album.tags)
-                first_result = next(albums_model.search_albums_by_tag(random_tag_to_use))
+                first_result = next(albums_model.search_albums_by_tag(random_tag_to_use, limit=1))
                 slack = slacker.Slacker(slack_blueprint.config['SLACK_OAUTH_TOKEN'])
                 slack.chat.post_message(payload['user']['id'],
                                         f'Your requested similar album: {first_result.album_url}',
@@ -577,19 +712,12 @@ def handle_interactive_message(payload):
         flask.current_app.logger.debug(f'[access]: handling interactive message: {action["name"]}')
         if 'tag' in action['name']:
             query = action['value'].lower()
-            search_response = flask.current_app.cache.get(f't-{query}')
-            if not search_response:
-                try:
-                    albums = albums_model.search_albums_by_tag(query)
-                except DatabaseError as e:
-                    flask.current_app.logger.error('[db]: failed to build album details')
-                    flask.current_app.logger.error(f'[db]: {e}')
-                    return 'failed to perform search', 500
-                else:
-                    max_attachments = slack_blueprint.config['SLACK_MAX_ATTACHMENTS']
-                    list_name = slack_blueprint.config['LIST_NAME']
-                    search_response = build_search_response(albums, list_name, max_attachments)
-                    flask.current_app.cache.set(f't-{query}', search_response, 60 * 5)
+            try:
+                search_response = get_tag_search_response(query)
+            except DatabaseError as e:
+                flask.current_app.logger.error('[db]: failed to build album details')
+                flask.current_app.logger.error(f'[db]: {e}')
+                return 'failed to perform search', 500
             response = {
                 'response_type': 'ephemeral',
                 'text': f'Your #{query} results',
@@ -683,19 +811,33 @@ def handle_interactive_message(payload):
             response = flask.current_app.cache.get(f'u-{user}')
             if not response:
                 try:
-                    albums = albums_model.get_albums_by_user(user)
+                    response = build_my_list_response(user)
                 except DatabaseError as e:
                     flask.current_app.logger.error('[db]: failed to build album details')
                     flask.current_app.logger.error(f'[db]: {e}')
                     return 'failed to perform search', 500
                 else:
-                    response = build_search_response(albums, 'My List',
-                                                     max_attachments=slack_blueprint.config['SLACK_MAX_ATTACHMENTS'],
-                                                     add_to_my_list=False,
-                                                     remove_from_my_list=True)
-                    response['attachments'] += build_my_list_attachment()
                     flask.current_app.cache.set(f'u-{user}', response, 5)
             return flask.jsonify(response)
+        elif 'next_page' in action['name']:
+            page = json.loads(action['value'])
+            try:
+                if page['kind'] == 'my_list':
+                    response = build_my_list_response(payload['user']['id'], page['after'], page['offset'])
+                else:
+                    _, response = build_search_page_response(page['kind'], page['query'],
+                                                             slack_blueprint.config['LIST_NAME'],
+                                                             page['after'], page['offset'])
+            except DatabaseError as e:
+                flask.current_app.logger.error('[db]: failed to build album details')
+                flask.current_app.logger.error(f'[db]: {e}')
+                return 'failed to perform search', 500
+            response.update({
+                'response_type': 'ephemeral',
+                'replace_original': True,
+                'unfurl_links': True,
+            })
+            return flask.jsonify(response)
     except KeyError as missing_key:
         flask.current_app.logger.warn(f'[slack]: missing key in interactive payload: {missing_key}')
     return '', 200
@@ -705,10 +847,12 @@ def handle_interactive_message(payload):
 @slack_check
 @admin_only
 def restore_albums():
-    contents = flask.request.form.get('text', '')
+    form_data = flask.request.form
+    response = None if 'silence' in form_data else form_data.get('response_url')
+    contents = form_data.get('text', '')
     try:
         url = links.scrape_links_from_text(contents)[0]
-        queued.deferred_fetch_and_restore.delay(url)
+        queued.deferred_fetch_and_restore.delay(url, response_url=response)
     except IndexError:
         flask.abort(401)
     return 'Restore request sent...', 200
@@ -722,17 +866,12 @@ def my_albums():
         response = flask.current_app.cache.get(f'u-{user}')
         if not response:
             try:
-                albums = albums_model.get_albums_by_user(user)
+                response = build_my_list_response(user)
             except DatabaseError as e:
                 flask.current_app.logger.error('[db]: failed to build album details')
                 flask.current_app.logger.error(f'[db]: {e}')
                 return 'failed to perform search', 500
             else:
-                max_attachments = slack_blueprint.config['SLACK_MAX_ATTACHMENTS']
-                response = build_search_response(albums, 'My List', max_attachments,
-                                                 add_to_my_list=False,
-                                                 remove_from_my_list=True)
-                response['attachments'] += build_my_list_attachment()
                 flask.current_app.cache.set(f'u-{user}', response, 5)
         return flask.jsonify(response), 200
     return '', 200
@@ -0,0 +1,80 @@
+import argparse
+import json
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+from albumlist.models import albums as albums_model
+
+
+def synthetic_rows(n):
+    added = datetime(2015, 1, 1)
+    return [
+        (
+            str(1000000000 + i),
+            f'Album {i}',
+            f'Artist {i % 5000}',
+            f'https://artist{i % 5000}.bandcamp.com/album/album-{i}',
+            f'https://f4.bcbits.com/img/a{i}_16.jpg',
+            i % 20 != 0,
+            'C0ABCDEFG',
+            added + timedelta(minutes=17 * i),
+            f'{2000 + i % 20}0101',
+            ['rock', 'post-rock', f'tag{i % 300}'],
+            [f'U{i % 40:08d}'],
+        )
+        for i in range(n)
+    ]
+
+
+def timed(label, n, func):
+    started = time.perf_counter()
+    result = func()
+    elapsed = time.perf_counter() - started
+    print(f'[bench]: {label:<40} {n / elapsed:>12,.0f} rows/s ({elapsed * 1000:.1f}ms)')
+    return result
+
+
+def memory_per_album(rows):
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    albums = list(albums_model.Album.albums_from_values(rows))
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    size = sum(stat.size_diff for stat in after.compare_to(before, 'filename'))
+    # the list holding them is counted too, 8 bytes a pointer
+    print(f'[bench]: {"memory per album":<40} {(size - 8 * len(albums)) / len(albums):>12,.0f} bytes')
+    return albums
+
+
+def bench_rows(n):
+    rows = synthetic_rows(n)
+    memory_per_album(rows)
+    albums = timed('rows to albums', n, lambda: list(albums_model.Album.albums_from_values(rows)))
+    details = timed('albums to details map', n, lambda: albums_model.Album.details_map_from_albums(albums))
+    timed('details map to json', n, lambda: json.dumps([{key: d} for key, d in details.items()]))
+    timed('details map again (cached dicts)', n, lambda: albums_model.Album.details_map_from_albums(albums))
+
+
+def bench_database():
+    n = albums_model.get_albums_count()
+    print(f'[bench]: {n} albums in the database')
+
+    def through_albums():
+        details = albums_model.Album.details_map_from_albums(albums_model.get_albums_with_tags())
+        return json.dumps([{key: d} for key, d in details.items()])
+
+    timed('/api/albums through Album', n, through_albums)
+    timed('/api/albums as database json', n, albums_model.get_albums_details_json)
+    timed('/api/albums/dump rows', n, lambda: sum(1 for album in albums_model.iter_albums_with_users()
+                                                  if album.to_dict()))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark building albums from rows and the full-table endpoints.')
+    parser.add_argument('--rows', type=int, default=50000, help='number of synthetic rows')
+    parser.add_argument('--db', action='store_true', help='also time the full-table queries against DATABASE_URL')
+    args = parser.parse_args()
+    bench_rows(args.rows)
+    if args.db:
+        bench_database()
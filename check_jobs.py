@@ -0,0 +1,47 @@
+import sys
+
+from albumlist.delayed import jobs, queued
+from albumlist.models import list as list_model
+from albumlist.scrapers import bandcamp
+
+
+def check_references():
+    """
+    Every registered job reference survives being encoded and decoded.
+    """
+    failures = []
+    for name, f in sorted(jobs.REFERENCES.items()):
+        try:
+            if jobs.loads_value(jobs.dumps_value(f)) is not f:
+                failures.append(f'{name} decoded as a different function')
+        except (TypeError, jobs.JobError) as e:
+            failures.append(f'{name}: {e}')
+    return failures
+
+
+def check_consume_job():
+    """
+    A deferred_consume job, as the views queue it, round-trips through dumps() and loads().
+    """
+    args = ['https://example.bandcamp.com/album/example', bandcamp.scrape_bandcamp_album_ids_from_url_forced,
+            list_model.add_to_list]
+    kwargs = {'channel': 'C0123', 'slack_token': 'token', 'response_url': None}
+    job = jobs.Job(queued.deferred_consume.__name__, args=args, kwargs=kwargs)
+    try:
+        loaded = jobs.Job.loads(job.dumps())
+    except jobs.JobError as e:
+        return [f'deferred_consume: {e}']
+    failures = []
+    if loaded.func is not jobs.TASKS['deferred_consume']:
+        failures.append('deferred_consume decoded as a different task')
+    if loaded.args != args or loaded.kwargs != kwargs:
+        failures.append(f'deferred_consume arguments decoded as {loaded.args} {loaded.kwargs}')
+    return failures
+
+
+if __name__ == '__main__':
+    failures = check_references() + check_consume_job()
+    for failure in failures:
+        print(f'[jobs]: FAILED - {failure}')
+    print(f'[jobs]: {len(jobs.REFERENCES)} references and {len(jobs.TASKS)} tasks checked, {len(failures)} failures')
+    sys.exit(1 if failures else 0)
@@ -7,6 +7,19 @@ class Config(object):
     CSRF_ENABLED = True
     SECRET_KEY = os.environ.get('SECRET_KEY', 'change-me')
     REDIS_QUEUE_KEY = 'deferred_queue'
+    JOB_MAX_PAYLOAD_BYTES = int(os.environ.get('JOB_MAX_PAYLOAD_BYTES', 64 * 1024))
+    # queue name:weight, highest priority first
+    JOB_QUEUE_WEIGHTS = [
+        (lane, int(weight))
+        for lane, weight in (
+            item.split(':') for item in os.environ.get('JOB_QUEUE_WEIGHTS', 'interactive:6,default:3,bulk:1').split(',')
+        )
+    ]
+    JOB_DEDUP_WINDOW = int(os.environ.get('JOB_DEDUP_WINDOW', 60 * 60))
+    JOB_MAX_ATTEMPTS = int(os.environ.get('JOB_MAX_ATTEMPTS', 5))
+    JOB_RETRY_BACKOFF = int(os.environ.get('JOB_RETRY_BACKOFF', 10))
+    JOB_RETRY_MAX_DELAY = int(os.environ.get('JOB_RETRY_MAX_DELAY', 60 * 60))
+    WORKER_HEARTBEAT_TTL = int(os.environ.get('WORKER_HEARTBEAT_TTL', 60))
     APP_TOKENS = [
         token for key, token in os.environ.items()
         if key.startswith('APP_TOKEN')
@@ -15,6 +28,16 @@ class Config(object):
     LIST_NAME = os.environ.get('LIST_NAME', 'Albumlist')
     SLACK_MAX_ATTACHMENTS = int(os.environ.get('SLACK_MAX_ATTACHMENTS', 100))
     ALBUMLISTBOT_URL = os.environ.get('ALBUMLISTBOT_URL')
+    WORKER_CONCURRENCY = int(os.environ.get('WORKER_CONCURRENCY', 8))
+    WORKER_POOL = os.environ.get('WORKER_POOL', 'thread')
+    WORKER_METRICS_PORT = int(os.environ.get('WORKER_METRICS_PORT', 0))
+    METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+    SEARCH_INDEX_REFRESH = int(os.environ.get('SEARCH_INDEX_REFRESH', 60))
+    SEARCH_INDEX_REBUILD = int(os.environ.get('SEARCH_INDEX_REBUILD', 60 * 60))
+    RANDOM_ALBUMS_REFRESH = int(os.environ.get('RANDOM_ALBUMS_REFRESH', 60 * 5))
+    LIST_MEMBERSHIP_REDIS = os.environ.get('LIST_MEMBERSHIP_REDIS', '').lower() in ('1', 'true', 'yes')
+    LIST_MEMBERSHIP_TTL = int(os.environ.get('LIST_MEMBERSHIP_TTL', 60 * 60))
+    ALBUM_STATS_TTL = int(os.environ.get('ALBUM_STATS_TTL', 60 * 60))
 
 
 class ProductionConfig(Config):
@@ -1,6 +1,7 @@
 from albumlist.models import DatabaseError
 from albumlist.models.albums import create_albums_table, create_albums_index
 from albumlist.models.list import create_list_table
+from albumlist.models.migrations import apply_migrations
 
 
 if __name__ == '__main__':
@@ -8,5 +9,6 @@ if __name__ == '__main__':
         create_list_table()
         create_albums_table()
         create_albums_index()
+        apply_migrations()
     except DatabaseError as e:
         print(f'[db]: ERROR - {e}')
\ No newline at end of file
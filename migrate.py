@@ -0,0 +1,19 @@
+import sys
+
+from albumlist.models import DatabaseError
+from albumlist.models.migrations import apply_migrations, create_migrations_table, migration_status
+
+
+if __name__ == '__main__':
+    try:
+        if '--status' in sys.argv:
+            create_migrations_table()
+            for migration, applied in migration_status():
+                print(f'[db]: {migration.version:>3} {"applied " + applied.isoformat() if applied else "pending"}'
+                      f' - {migration.name}')
+        else:
+            applied = apply_migrations()
+            print(f'[db]: applied {len(applied)} migration{"s" if len(applied) != 1 else ""}')
+    except DatabaseError as e:
+        print(f'[db]: ERROR - {e}')
+        sys.exit(1)
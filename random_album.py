@@ -1,7 +1,7 @@
 import os
 
-from albumlist.models import albums as albums_model
 from albumlist.models import DatabaseError
+from albumlist.randomizer import RandomAlbumPicker
 from albumlist.views import build_attachment
 import slacker
 
@@ -9,15 +9,36 @@ import slacker
 channel = os.environ.get('AOTD_CHANNEL_ID')
 slack_token = os.environ.get('SLACK_OAUTH_TOKEN')
 list_name = os.environ.get('LIST_NAME', 'Albumlist')
+aotd_tag = os.environ.get('AOTD_TAG')
+aotd_weighted = bool(os.environ.get('AOTD_WEIGHTED'))
+no_repeat_window = int(os.environ.get('AOTD_NO_REPEAT_WINDOW', 365))
+recent_key = 'aotd-recent'
 slack = slacker.Slacker(slack_token)
 
 
+def get_recent_album_ids():
+    from albumlist.delayed import redis_connection
+    return {album_id.decode('utf-8') for album_id in redis_connection.lrange(recent_key, 0, no_repeat_window - 1)}
+
+
+def add_recent_album_id(album_id):
+    from albumlist.delayed import redis_connection
+    pipe = redis_connection.pipeline()
+    pipe.lpush(recent_key, album_id)
+    pipe.ltrim(recent_key, 0, no_repeat_window - 1)
+    pipe.execute()
+
+
 def post_random_album():
     if not channel or not slack_token:
         print('[random]: missing environment variables')
         return
     try:
-        album = albums_model.get_random_album()
+        album = RandomAlbumPicker().random_album(
+            tag=aotd_tag,
+            weighted=aotd_weighted,
+            exclude=get_recent_album_ids() if no_repeat_window else None,
+        )
         if album is None:
             print('[random]: no random album found')
             return
@@ -36,6 +57,8 @@ def post_random_album():
         print(f'[random]: posting random album to {channel}')
         text = f":new_moon_with_face: Today's album of the day is:"
         slack.chat.post_message(channel, text, attachments=[attachment])
+        if no_repeat_window:
+            add_recent_album_id(album.album_id)
 
 
 if __name__ == '__main__':